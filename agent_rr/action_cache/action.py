@@ -1,8 +1,42 @@
+import time
 from typing import Dict, List
 from PIL import Image
 from skimage.metrics import structural_similarity as ssim
 import numpy as np
 
+# hamming distance (of 64 bits) between difference hashes
+HASH_SAME_DISTANCE = 4
+HASH_CHANGED_DISTANCE = 20
+# mean absolute error between 16x16 grayscale thumbnails, pixels in [0, 1]
+THUMBNAIL_SAME_MAE = 0.02
+THUMBNAIL_CHANGED_MAE = 0.15
+THUMBNAIL_SIZE = 16
+# 1 - intersection of normalized rgb histograms, catches colour-only changes
+HISTOGRAM_CHANGED_DISTANCE = 0.4
+HISTOGRAM_BINS = 8
+SSIM_THRESHOLD = 0.9
+
+class UIElementFeatures:
+    # cheap summaries of a sub image, compared before falling back to ssim
+    def __init__(self, img: Image.Image):
+        gray = img.convert("L")
+        small = np.asarray(gray.resize((9, 8), Image.Resampling.BILINEAR), dtype=np.int16)
+        self.dhash = np.packbits((small[:, 1:] > small[:, :-1]).flatten())
+        thumbnail = gray.resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.Resampling.BILINEAR)
+        self.thumbnail = np.asarray(thumbnail, dtype=np.float32) / 255
+        rgb = img.convert("RGB").resize((32, 32), Image.Resampling.BILINEAR)
+        histogram = np.asarray(rgb.histogram(), dtype=np.float32).reshape(3, HISTOGRAM_BINS, -1).sum(axis=2)
+        self.histogram = histogram / histogram.sum(axis=1, keepdims=True)
+
+    def hash_distance(self, other):
+        return int(np.unpackbits(self.dhash ^ other.dhash).sum())
+
+    def thumbnail_mae(self, other):
+        return float(np.abs(self.thumbnail - other.thumbnail).mean())
+
+    def histogram_distance(self, other):
+        return float(1 - np.minimum(self.histogram, other.histogram).sum(axis=1).mean())
+
 class UIElement:
     def __init__(self, bbox: List[int], content: str = None, sub_img: Image.Image = None):
         # bbox: [x1, y1, x2, y2], round(relative * 1000) format
@@ -11,21 +45,79 @@ class UIElement:
         self.content = content
         # sub_img: cropped image of the UI element
         self.sub_img = sub_img
+        # computed on first comparison and kept, stored elements are
+        # compared against every time their action is a cache candidate
+        self.features = None
 
-    def __eq__(self, other):
-        if self.sub_img is not None and other.sub_img is not None:
-            img1 = np.array(self.sub_img)
-            img2 = np.array(other.sub_img)
-
-            if img1.shape != img2.shape:
-                img2_pil_resized = other.sub_img.resize(self.sub_img.size, Image.Resampling.LANCZOS)
-                img2 = np.array(img2_pil_resized)
-    
-            similarity = ssim(img1, img2, channel_axis=2, data_range=255)
-            return similarity > 0.9
+    def get_features(self):
+        if self.features is None and self.sub_img is not None:
+            self.features = UIElementFeatures(self.sub_img)
+        return self.features
+
+    def drop_sub_img(self):
+        # keep the features, comparisons fall back to them without the crop
+        self.get_features()
+        self.sub_img = None
+
+    def nbytes(self):
+        n = 0
+        if self.sub_img is not None:
+            n += self.sub_img.width * self.sub_img.height * len(self.sub_img.getbands())
+        if self.features is not None:
+            n += self.features.dhash.nbytes + self.features.thumbnail.nbytes + self.features.histogram.nbytes
+        return n
+
+    @staticmethod
+    def _ssim_equal(sub_img1, sub_img2):
+        img1 = np.array(sub_img1)
+        img2 = np.array(sub_img2)
+
+        if img1.shape != img2.shape:
+            img2_pil_resized = sub_img2.resize(sub_img1.size, Image.Resampling.LANCZOS)
+            img2 = np.array(img2_pil_resized)
+
+        similarity = ssim(img1, img2, channel_axis=2, data_range=255)
+        return similarity > SSIM_THRESHOLD
+
+    def compare(self, other, tier_counter=None):
+        # returns (equal, tier that decided), escalating from the cheapest
+        # tier; tier_counter accumulates the seconds spent in each tier
+        def _account(tier, start_time):
+            if tier_counter is not None:
+                tier_counter[tier] = tier_counter.get(tier, 0.0) + time.time() - start_time
+
+        start_time = time.time()
+        features1, features2 = self.get_features(), other.get_features()
+        if features1 is not None and features2 is not None:
+            distance = features1.hash_distance(features2)
+            _account("hash", start_time)
+            if distance >= HASH_CHANGED_DISTANCE:
+                return False, "hash"
+
+            start_time = time.time()
+            mae = features1.thumbnail_mae(features2)
+            histogram_distance = features1.histogram_distance(features2)
+            _account("thumbnail", start_time)
+            if mae >= THUMBNAIL_CHANGED_MAE or histogram_distance >= HISTOGRAM_CHANGED_DISTANCE:
+                return False, "thumbnail"
+            if distance <= HASH_SAME_DISTANCE and mae <= THUMBNAIL_SAME_MAE:
+                return True, "thumbnail"
+
+            # read once, the crop may be dropped by eviction meanwhile
+            sub_img1, sub_img2 = self.sub_img, other.sub_img
+            if sub_img1 is None or sub_img2 is None:
+                # crop already dropped, decide on the thumbnail alone
+                return mae < (THUMBNAIL_SAME_MAE + THUMBNAIL_CHANGED_MAE) / 2, "thumbnail"
+            start_time = time.time()
+            equal = self._ssim_equal(sub_img1, sub_img2)
+            _account("ssim", start_time)
+            return equal, "ssim"
         if self.content is not None and other.content is not None:
-            return self.content == other.content
-        return True
+            return self.content == other.content, "content"
+        return True, "content"
+
+    def __eq__(self, other):
+        return self.compare(other)[0]
 
 class Action:
     def __init__(self, name: str, param: Dict[str, str], extra: Dict[str, str] = None):
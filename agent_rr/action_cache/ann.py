@@ -0,0 +1,154 @@
+import bisect
+import math
+import torch
+
+from .buffer import EmbeddingBuffer
+
+# k-means is trained on a sample of at most this many embeddings per list
+KMEANS_SAMPLES_PER_LIST = 64
+KMEANS_ITERATIONS = 10
+# the index is retrained once it holds this many times the embeddings it
+# was trained on, new embeddings may not follow the old clusters
+RETRAIN_GROWTH = 2.0
+
+def segment_max(scores, segment_ids, num_segments):
+    # per-segment max of scores and the (first) row index reaching it
+    num_rows = scores.shape[0]
+    max_scores = torch.full((num_segments,), float("-inf"), dtype=scores.dtype, device=scores.device)
+    max_scores = max_scores.scatter_reduce(0, segment_ids, scores, reduce="amax", include_self=True)
+    rows = torch.arange(num_rows, device=scores.device)
+    candidates = torch.where(scores == max_scores[segment_ids], rows, torch.full_like(rows, num_rows))
+    max_rows = torch.full((num_segments,), num_rows, dtype=rows.dtype, device=scores.device)
+    max_rows = max_rows.scatter_reduce(0, segment_ids, candidates, reduce="amin", include_self=True)
+    return max_scores, max_rows
+
+def kmeans(embeddings, num_lists, iterations=KMEANS_ITERATIONS, seed=0):
+    # spherical k-means, the embeddings are normalized so that the inner
+    # product is the cosine similarity used for lookups
+    generator = torch.Generator().manual_seed(seed)
+    perm = torch.randperm(embeddings.shape[0], generator=generator).to(embeddings.device)
+    embeddings = embeddings[perm[:num_lists * KMEANS_SAMPLES_PER_LIST]]
+    centroids = embeddings[:num_lists].clone()
+    for _ in range(iterations):
+        assign = torch.mm(embeddings, centroids.T).argmax(dim=1)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, embeddings)
+        counts = torch.bincount(assign, minlength=num_lists)
+        # an empty list keeps its centroid
+        sums[counts == 0] = centroids[counts == 0]
+        centroids = torch.nn.functional.normalize(sums, dim=1)
+    return centroids
+
+class IVFIndex:
+    # inverted file index over the task embeddings of one fuzzy node: every
+    # embedding is filed under its nearest centroid and a lookup only scores
+    # the lists of the nprobe centroids nearest to the query
+    def __init__(self, embeddings, entries, num_lists=None, nprobe=8):
+        # entries: (edge, task, keyword) of every row of embeddings
+        n = embeddings.shape[0]
+        self.num_lists = min(n, num_lists or max(1, int(math.sqrt(n))))
+        self.nprobe = nprobe
+        self.centroids = kmeans(embeddings.float(), self.num_lists).to(embeddings.dtype)
+        self.num_trained = n
+        self.size = 0
+        self.vectors = [EmbeddingBuffer() for _ in range(self.num_lists)]
+        # edge number of every row, (n, 1) so that it fits an EmbeddingBuffer
+        self.edge_numbers = [EmbeddingBuffer() for _ in range(self.num_lists)]
+        # (edge, task, keyword) of every row, None for removed rows
+        self.entries = [[] for _ in range(self.num_lists)]
+        self.next_edge_number = 0
+        self.edge_number = {}
+        # (id(edge), id(task)) -> [(list, row)]
+        self.locations = {}
+        self.add(embeddings, entries)
+
+    def needs_retrain(self):
+        return self.size > RETRAIN_GROWTH * self.num_trained
+
+    def nbytes(self):
+        return sum(b.nbytes() for b in self.vectors + self.edge_numbers) + self.centroids.nelement() * self.centroids.element_size()
+
+    def _get_edge_number(self, edge):
+        if id(edge) not in self.edge_number:
+            self.edge_number[id(edge)] = self.next_edge_number
+            self.next_edge_number += 1
+        return self.edge_number[id(edge)]
+
+    def add(self, embeddings, entries):
+        embeddings = embeddings.to(device=self.centroids.device, dtype=self.centroids.dtype)
+        assign = torch.mm(embeddings, self.centroids.T).argmax(dim=1)
+        numbers = torch.tensor([[self._get_edge_number(edge)] for edge, _, _ in entries], device=embeddings.device)
+        for l in assign.unique().tolist():
+            idx = (assign == l).nonzero()[:, 0]
+            rows = self.vectors[l].append(embeddings[idx])
+            self.edge_numbers[l].append(numbers[idx])
+            for i, row in zip(idx.tolist(), rows):
+                edge, task, _ = entries[i]
+                self.entries[l].append(entries[i])
+                self.locations.setdefault((id(edge), id(task)), []).append((l, row))
+        self.size += len(entries)
+
+    def remove(self, edge, task):
+        # one copy of task on edge, like ActionTreeEdge.remove_task
+        key = (id(edge), id(task))
+        locations = self.locations.get(key)
+        if not locations:
+            return
+        l, row = locations.pop()
+        if not locations:
+            del self.locations[key]
+        self.vectors[l].remove(row)
+        self.edge_numbers[l].remove(row)
+        self.entries[l][row] = None
+        self.size -= 1
+        if self.vectors[l].needs_compaction():
+            self._compact(l)
+
+    def remove_edge(self, edge):
+        for task in list(edge.tasks):
+            self.remove(edge, task)
+        self.edge_number.pop(id(edge), None)
+
+    def _compact(self, l):
+        kept = [(row, entry) for row, entry in enumerate(self.entries[l]) if entry is not None]
+        self.vectors[l].compact()
+        self.edge_numbers[l].compact()
+        self.entries[l] = [entry for _, entry in kept]
+        for new_row, (old_row, (edge, task, _)) in enumerate(kept):
+            locations = self.locations[(id(edge), id(task))]
+            locations[locations.index((l, old_row))] = (l, new_row)
+
+    def reset_keyword(self, keyword):
+        for entries in self.entries:
+            for row, entry in enumerate(entries):
+                if entry is not None and entry[2] == keyword:
+                    entries[row] = (entry[0], entry[1], "")
+
+    def query(self, query, threshold):
+        # best (edge, task, keyword, score) of every edge scoring at least
+        # threshold within the probed lists
+        query = query.to(device=self.centroids.device, dtype=self.centroids.dtype)
+        probe = torch.mm(query, self.centroids.T)[0].topk(min(self.nprobe, self.num_lists)).indices.tolist()
+        scores, numbers, lists, offsets = [], [], [], [0]
+        for l in probe:
+            if len(self.vectors[l]) == 0:
+                continue
+            s = torch.mm(query, self.vectors[l].view().T)[0]
+            scores.append(s.masked_fill(~self.vectors[l].valid_mask(), float("-inf")))
+            numbers.append(self.edge_numbers[l].view()[:, 0])
+            lists.append(l)
+            offsets.append(offsets[-1] + s.shape[0])
+        if not scores:
+            return []
+        scores = torch.cat(scores)
+        numbers = torch.cat(numbers)
+        rows = (scores >= threshold).nonzero()[:, 0]
+        if rows.shape[0] == 0:
+            return []
+        unique_numbers, segment_ids = torch.unique(numbers[rows], return_inverse=True)
+        max_scores, max_rows = segment_max(scores[rows], segment_ids, unique_numbers.shape[0])
+        ret = []
+        for score, row in zip(max_scores.tolist(), rows[max_rows].tolist()):
+            i = bisect.bisect_right(offsets, row) - 1
+            edge, task, keyword = self.entries[lists[i]][row - offsets[i]]
+            ret.append((edge, task, keyword, score))
+        return ret
@@ -0,0 +1,26 @@
+import torch
+
+# inference backends of the embedder and the reranker:
+#   torch: the model as loaded, on cuda/npu when available
+#   int8: cpu only, linear layers dynamically quantized to int8, for hosts
+#         without an accelerator
+BACKENDS = ("torch", "int8")
+
+def check_backend(backend):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}, expected one of {BACKENDS}")
+
+def set_num_threads(num_threads):
+    # intra-op threads of torch on cpu; process wide, the last model
+    # configured wins
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+def quantize_int8(model):
+    # weights are quantized once, activations per batch at runtime
+    model = model.float().cpu()
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def model_id(path, backend):
+    # identifies cached outputs, the int8 ones differ slightly from fp32
+    return path if backend == "torch" else f"{path}:{backend}"
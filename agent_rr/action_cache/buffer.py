@@ -0,0 +1,143 @@
+import torch
+
+MIN_CAPACITY = 16
+# compact once tombstones make up this fraction of the used rows
+COMPACT_RATIO = 0.5
+
+class EmbeddingBuffer:
+    def __init__(self, embeddings=None):
+        self.data = None
+        # rows [0, size) are in use, rows marked invalid there are tombstones
+        self.size = 0
+        self.valid = None
+        self.num_tombstones = 0
+        if embeddings is not None and embeddings.shape[0] > 0:
+            self.append(embeddings)
+
+    @classmethod
+    def wrap(cls, data):
+        # use data (e.g. a view of a memory-mapped array) as storage without
+        # copying it, the first append moves the rows into a new allocation
+        buffer = cls()
+        buffer.data = data
+        buffer.size = data.shape[0]
+        buffer.valid = torch.ones(buffer.size, dtype=torch.bool, device=data.device)
+        return buffer
+
+    def __len__(self):
+        return self.size - self.num_tombstones
+
+    @property
+    def capacity(self):
+        return 0 if self.data is None else self.data.shape[0]
+
+    def _grow(self, min_capacity, like):
+        capacity = max(MIN_CAPACITY, self.capacity)
+        while capacity < min_capacity:
+            capacity *= 2
+        data = torch.empty((capacity, like.shape[1]), dtype=like.dtype, device=like.device)
+        valid = torch.zeros(capacity, dtype=torch.bool, device=like.device)
+        if self.data is not None:
+            data[:self.size] = self.data[:self.size]
+            valid[:self.size] = self.valid[:self.size]
+        self.data = data
+        self.valid = valid
+
+    def append(self, embeddings):
+        # embeddings: (n, dim), returns the physical rows they were written to
+        n = embeddings.shape[0]
+        if self.size + n > self.capacity:
+            self._grow(self.size + n, embeddings)
+        start = self.size
+        self.data[start:start + n] = embeddings.to(device=self.data.device, dtype=self.data.dtype)
+        self.valid[start:start + n] = True
+        self.size += n
+        return list(range(start, start + n))
+
+    def remove(self, row):
+        if row >= self.size or not self.valid[row]:
+            raise IndexError(f"Row {row} is not a live row")
+        self.valid[row] = False
+        self.num_tombstones += 1
+
+    def needs_compaction(self):
+        return self.num_tombstones > 0 and self.num_tombstones >= COMPACT_RATIO * self.size
+
+    def compact(self):
+        # move live rows to the front, keeping their order, returns whether
+        # any row moved
+        if self.num_tombstones == 0:
+            return False
+        live = self.data[:self.size][self.valid[:self.size]]
+        n = live.shape[0]
+        self.data[:n] = live
+        self.valid[:n] = True
+        self.valid[n:self.size] = False
+        self.size = n
+        self.num_tombstones = 0
+        return True
+
+    def shrink(self):
+        # compact and give back the capacity beyond the live rows, returns
+        # whether any row moved, freeing capacity keeps the row numbers
+        compacted = self.compact()
+        if self.capacity > self.size:
+            self.data = self.data[:self.size].clone()
+            self.valid = self.valid[:self.size].clone()
+        return compacted
+
+    def nbytes(self):
+        if self.data is None:
+            return 0
+        return self.data.nelement() * self.data.element_size() + self.valid.nelement()
+
+    def view(self):
+        # used prefix, may still contain tombstones
+        if self.data is None:
+            return None
+        return self.data[:self.size]
+
+    def valid_mask(self):
+        if self.valid is None:
+            return None
+        return self.valid[:self.size]
+
+    def live(self):
+        if self.data is None:
+            return None
+        if self.num_tombstones == 0:
+            return self.data[:self.size]
+        return self.data[:self.size][self.valid[:self.size]]
+
+class PackedEmbeddings:
+    # the live rows of several buffers (the edges of a node) in one matrix,
+    # so that a lookup is a single matmul. rows are appended in place with
+    # the amortized growth of EmbeddingBuffer; packed row i belongs to
+    # segment segment_ids[i] and is row source_rows[i] of its own buffer
+    def __init__(self):
+        self.embeddings = EmbeddingBuffer()
+        self.segment_ids = None
+        self.source_rows = []
+
+    def __len__(self):
+        return self.embeddings.size
+
+    def append(self, segment_id, embeddings, source_rows):
+        if embeddings.shape[0] == 0:
+            return
+        start = self.embeddings.size
+        self.embeddings.append(embeddings)
+        end = self.embeddings.size
+        data = self.embeddings.data
+        if self.segment_ids is None or self.segment_ids.shape[0] < data.shape[0]:
+            segment_ids = torch.empty(data.shape[0], dtype=torch.long, device=data.device)
+            if self.segment_ids is not None:
+                segment_ids[:start] = self.segment_ids[:start]
+            self.segment_ids = segment_ids
+        self.segment_ids[start:end] = segment_id
+        self.source_rows.extend(source_rows)
+
+    def view(self):
+        # (embeddings, segment_ids) of the used rows
+        size = self.embeddings.size
+        return self.embeddings.data[:size], self.segment_ids[:size]
@@ -1,19 +1,164 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import torch
 from sentence_transformers import SentenceTransformer
+from .backend import check_backend, set_num_threads, quantize_int8, model_id
+
+class EmbeddingCache:
+    # in-process LRU in front of an optional sqlite store on disk
+    def __init__(self, max_size=4096, path=None):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db = None
+        if path is not None:
+            dirname = os.path.dirname(path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, dtype TEXT, data BLOB)")
+            self.db.commit()
+
+    def _put_memory(self, key, embedding):
+        self.entries[key] = embedding
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, key, device=None, dtype=None):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            if self.db is not None:
+                row = self.db.execute("SELECT dtype, data FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    embedding = torch.from_numpy(np.frombuffer(row[1], dtype=row[0]).copy()).to(device=device, dtype=dtype)
+                    self._put_memory(key, embedding)
+                    self.disk_hits += 1
+                    return embedding
+            self.misses += 1
+            return None
+
+    def put_many(self, items):
+        with self.lock:
+            for key, embedding in items:
+                self._put_memory(key, embedding)
+            if self.db is not None:
+                rows = []
+                for key, embedding in items:
+                    array = embedding.detach().float().cpu().numpy()
+                    rows.append((key, array.dtype.str, array.tobytes()))
+                self.db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+                self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class StepEmbeddingStream:
+    # step embeddings of one task, computed in chunks on the embedder's
+    # worker thread: a small first chunk so that step 1 is ready early,
+    # then larger chunks scheduled ahead of the step being consumed
+    def __init__(self, embedder, task, first_chunk=4, chunk_size=16):
+        self.embedder = embedder
+        self.task = task
+        self.chunk_size = chunk_size
+        # (first step, future of the chunk's embeddings)
+        self.chunks = []
+        self.next_step = 1
+        self._schedule(first_chunk)
+        self._schedule(chunk_size - first_chunk)
+
+    def _schedule(self, n):
+        if n <= 0:
+            return
+        steps = range(self.next_step, self.next_step + n)
+        future = self.embedder.executor.submit(self.embedder.embed, [self.task] * n, steps=steps)
+        self.chunks.append((self.next_step, future))
+        self.next_step += n
+
+    def get(self, step):
+        # blocks only if the chunk holding step has not finished yet
+        while step + self.chunk_size // 2 >= self.next_step:
+            self._schedule(self.chunk_size)
+        for first_step, future in reversed(self.chunks):
+            if first_step <= step:
+                return future.result()[step - first_step].unsqueeze(0)
+        raise ValueError(f"Invalid step: {step}")
+
+    def close(self):
+        for _, future in self.chunks:
+            future.cancel()
 
 class Qwen3Embedder:
     def __init__(self, config):
         path = config.get("path", "Qwen/Qwen3-Embedding-0.6B")
-        self.model = SentenceTransformer(path)
+        self.path = path
+        # backend: see action_cache/backend.py; num_threads: torch cpu threads;
+        # batch_size: texts per forward pass
+        self.backend = config.get("backend", "torch")
+        check_backend(self.backend)
+        set_num_threads(config.get("num_threads", None))
+        self.batch_size = config.get("batch_size", 32)
+        if self.backend == "int8":
+            self.model = quantize_int8(SentenceTransformer(path, device="cpu"))
+        else:
+            self.model = SentenceTransformer(path)
+        self.dtype = next(self.model.parameters()).dtype
         self.instruct_fmt = config.get("instruct_fmt",
                                     #    "Instruct: Given a phone-use task, retrieve similar tasks that shares at least **{n}** steps with the given task\nQuery:{query}")
                                        "Instruct: Represent this phone-use task for level **{n}**\nQuery:{query}")
+        # cache_size: max number of embeddings kept in memory, 0 disables caching
+        # cache_path: optional sqlite file shared across runs
+        cache_size = config.get("cache_size", 4096)
+        if cache_size > 0:
+            self.cache = EmbeddingCache(cache_size, config.get("cache_path", None))
+        else:
+            self.cache = None
+        # stream_first_chunk/stream_chunk_size: see StepEmbeddingStream
+        self.stream_first_chunk = config.get("stream_first_chunk", 4)
+        self.stream_chunk_size = config.get("stream_chunk_size", 16)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="step-embedding")
+
+    def stream(self, task):
+        return StepEmbeddingStream(self, task, self.stream_first_chunk, self.stream_chunk_size)
+
+    def _cache_key(self, task, step):
+        # model path is part of the key, the disk store may outlive the model
+        fmt = self.instruct_fmt if step is not None else None
+        return hashlib.sha1(json.dumps([model_id(self.path, self.backend), fmt, task, step], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _encode(self, tasks, steps):
+        if steps is None:
+            return self.model.encode(tasks, batch_size=self.batch_size, convert_to_tensor=True, normalize_embeddings=True)
+        input_texts = [self.instruct_fmt.format(n=step, query=task) for task, step in zip(tasks, steps)]
+        return self.model.encode(input_texts, batch_size=self.batch_size, convert_to_tensor=True, normalize_embeddings=True)
 
     @torch.no_grad()
     def embed(self, tasks, steps=None):
-        if steps is None:
-            return self.model.encode(tasks, convert_to_tensor=True, normalize_embeddings=True)
-        if len(tasks) != len(steps):
+        if steps is not None and len(tasks) != len(steps):
             raise ValueError("Tasks and steps must have the same length")
-        input_texts = [self.instruct_fmt.format(n=step, query=task) for task, step in zip(tasks, steps)]
-        return self.model.encode(input_texts, convert_to_tensor=True, normalize_embeddings=True)
+        if self.cache is None:
+            return self._encode(tasks, steps)
+        steps_or_none = list(steps) if steps is not None else [None] * len(tasks)
+        keys = [self._cache_key(task, step) for task, step in zip(tasks, steps_or_none)]
+        embeddings = [self.cache.get(key, self.model.device, self.dtype) for key in keys]
+        missing = [i for i, e in enumerate(embeddings) if e is None]
+        if missing:
+            missing_steps = [steps_or_none[i] for i in missing] if steps is not None else None
+            encoded = self._encode([tasks[i] for i in missing], missing_steps)
+            for i, embedding in zip(missing, encoded):
+                embeddings[i] = embedding
+            self.cache.put_many([(keys[i], embeddings[i]) for i in missing])
+        return torch.stack(embeddings)
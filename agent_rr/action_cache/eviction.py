@@ -0,0 +1,162 @@
+import heapq
+import threading
+
+# rough bookkeeping cost of one task on an edge (Task object, list slots,
+# index entries), on top of its description and embedding row
+TASK_OVERHEAD_BYTES = 256
+
+# eviction order, each step only runs while the tree is still over budget:
+#   0. unused capacity of embedding buffers, nothing is lost
+#   1. target_elem crops of the coldest edges, their features are kept so
+#      that UI change detection still works without the crop
+#   2. cold tasks on edges that keep at least their most recently used
+#      task, no cached action is lost
+#   3. cold leaves, a parent whose last edge got evicted becomes a leaf
+# coldness is the last hit (or insertion) time of an edge or a task
+
+class MemoryCounter:
+    # running estimate of memory_usage, shared by all nodes of a tree and
+    # updated as edges and tasks come and go, so that the budget check after
+    # every execute does not have to walk the tree. lazily computed element
+    # features are not tracked, evict measures again and resets it
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def add(self, n):
+        with self.lock:
+            self.value += n
+
+    def set(self, n):
+        with self.lock:
+            self.value = n
+
+def collect_edges(tree):
+    # (node, edge) pairs in bfs order
+    return _collect_edges(tree.root)
+
+def _collect_edges(root):
+    pairs = []
+    queue = [root]
+    while queue:
+        node = queue.pop(0)
+        for e in node.get_edges():
+            pairs.append((node, e))
+            queue.append(e.to)
+    return pairs
+
+def _usage(pairs):
+    # fuzzy nodes may also hold an ann index with a copy of the embeddings
+    nodes = {id(node): node for node, _ in pairs}
+    indexes = [n.ann_index for n in nodes.values() if getattr(n, "ann_index", None) is not None]
+    return sum(e.nbytes() for _, e in pairs) + sum(index.nbytes() for index in indexes)
+
+def memory_usage(tree):
+    return _usage(collect_edges(tree))
+
+def subtree_usage(node):
+    return _usage(_collect_edges(node))
+
+def _shrink_buffers(pairs, usage, budget):
+    for node, e in pairs:
+        if usage <= budget:
+            break
+        if not hasattr(e, "shrink") or e.embedding_buffer.capacity == len(e.embedding_buffer):
+            continue
+        with node.lock:
+            before = e.nbytes()
+            e.shrink()
+            usage -= before - e.nbytes()
+    return usage
+
+def _evict_crops(pairs, usage, budget, evicted):
+    for node, e in sorted(pairs, key=lambda p: p[1].last_hit):
+        if usage <= budget:
+            break
+        elem = e.action.target_elem
+        if elem is None or elem.sub_img is None:
+            continue
+        before = elem.nbytes()
+        elem.drop_sub_img()
+        usage -= before - elem.nbytes()
+        evicted["crops"] += 1
+    return usage
+
+def _evict_leaves(tree, pairs, usage, budget, evicted):
+    heap = [(e.last_hit, i, node, e) for i, (node, e) in enumerate(pairs) if len(e.to.edges) == 0]
+    heapq.heapify(heap)
+    count = len(pairs)
+    while heap and usage > budget:
+        _, _, node, e = heapq.heappop(heap)
+        with node.lock, e.to.lock:
+            # another execute may have extended or removed it meanwhile
+            if len(e.to.edges) > 0 or not node.has_child(e.to):
+                continue
+            node.remove_child(e.to)
+            became_leaf = len(node.edges) == 0
+        usage -= e.nbytes()
+        evicted["leaves"] += 1
+        tree.mark_dirty(node)
+        if became_leaf and node.parent is not None and node.parent.has_child(node):
+            parent_edge = node.get_incoming_edge()
+            heapq.heappush(heap, (parent_edge.last_hit, count, node.parent, parent_edge))
+            count += 1
+    return usage
+
+def _evict_tasks(pairs, usage, budget, evicted):
+    candidates = []
+    for node, e in pairs:
+        with node.lock:
+            if len(e.task_last_used) < 2:
+                continue
+            hottest = max(e.task_last_used.values())
+            for description, last_used in e.task_last_used.items():
+                if last_used < hottest:
+                    candidates.append((last_used, node, e, description))
+    candidates.sort(key=lambda c: c[0])
+    # rows of the removed tasks are released by shrink at the end
+    row_bytes = {}
+    touched = {}
+    for _, node, e, description in candidates:
+        if usage <= budget:
+            break
+        with node.lock:
+            if len(e.tasks) < 2 or description not in e.task_last_used:
+                continue
+            num_tasks = len(e.tasks)
+            if id(e) not in row_bytes:
+                row_bytes[id(e)] = 0
+                buffer = getattr(e, "embedding_buffer", None)
+                if buffer is not None and buffer.data is not None:
+                    row_bytes[id(e)] = buffer.data.shape[1] * buffer.data.element_size() + 1
+            task = next(t for t in e.tasks if t.description == description)
+            node.remove_edge_task(e, task)
+            removed = num_tasks - len(e.tasks)
+        usage -= removed * (TASK_OVERHEAD_BYTES + len(description) + row_bytes[id(e)])
+        evicted["tasks"] += removed
+        touched[id(e)] = (node, e)
+    for node, e in touched.values():
+        if hasattr(e, "shrink"):
+            with node.lock:
+                e.shrink()
+    return usage
+
+def evict(tree, budget):
+    # returns (memory usage after eviction, counts of evicted items)
+    evicted = {"crops": 0, "leaves": 0, "tasks": 0}
+    pairs = collect_edges(tree)
+    usage = _usage(pairs)
+    if usage <= budget:
+        tree.root.memory.set(usage)
+        return usage, evicted
+    usage = _shrink_buffers(pairs, usage, budget)
+    if usage > budget:
+        usage = _evict_crops(pairs, usage, budget, evicted)
+    if usage > budget:
+        usage = _evict_tasks(pairs, usage, budget, evicted)
+    if usage > budget:
+        _evict_leaves(tree, collect_edges(tree), usage, budget, evicted)
+    # the estimates above are per item, measure again
+    usage = memory_usage(tree)
+    tree.root.memory.set(usage)
+    return usage, evicted
@@ -0,0 +1,69 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+# screenshots whose parsed elements are kept
+PARSE_CACHE_SIZE = 32
+# a parsed element belongs to a crop if this fraction of its area lies inside
+MIN_ELEM_OVERLAP = 0.5
+
+def image_key(image):
+    # content hash, identical screens of different tasks share an entry
+    digest = hashlib.blake2b(image.tobytes(), digest_size=16).hexdigest()
+    return f"{image.mode}:{image.width}x{image.height}:{digest}"
+
+def elems_in_bbox(elems, bbox, min_overlap=MIN_ELEM_OVERLAP):
+    # elems: omniparser output, bbox in [0, 1] screen coordinates;
+    # bbox: [x1, y1, x2, y2] in the same coordinates
+    ret = []
+    for elem in elems:
+        x1, y1, x2, y2 = elem["bbox"]
+        area = (x2 - x1) * (y2 - y1)
+        if area <= 0:
+            continue
+        w = min(x2, bbox[2]) - max(x1, bbox[0])
+        h = min(y2, bbox[3]) - max(y1, bbox[1])
+        if w > 0 and h > 0 and w * h >= min_overlap * area:
+            ret.append(elem)
+    return ret
+
+class ParseCache:
+    # bounded lru of omniparser outputs of whole screenshots, keyed by
+    # image_key, so that all candidates of a step share one parse
+    def __init__(self, capacity=PARSE_CACHE_SIZE):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # (image, key) of the last lookup, candidates of one step pass the
+        # same screenshot object and skip hashing it again
+        self.last_key = (None, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key(self, image):
+        last_image, last_key = self.last_key
+        if image is last_image:
+            return last_key
+        key = image_key(image)
+        self.last_key = (image, key)
+        return key
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, elems):
+        with self.lock:
+            self.entries[key] = elems
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.last_key = (None, None)
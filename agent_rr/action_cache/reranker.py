@@ -1,17 +1,30 @@
+import copy
+import threading
+from collections import OrderedDict
 import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM
 from transformers.utils import is_torch_npu_available, is_torch_cuda_available
+from .backend import check_backend, set_num_threads, quantize_int8
 
 class Qwen3Reranker:
     def __init__(self, config):
         path = config.get("path", "Qwen/Qwen3-Reranker-0.6B")
         self.tokenizer = AutoTokenizer.from_pretrained(path, padding_side='left')
-        device = "cpu"
-        if is_torch_cuda_available():
-            device = "cuda:0"
-        elif is_torch_npu_available():
-            device="npu:0"
-        self.model = AutoModelForCausalLM.from_pretrained(path, device_map=device).eval()
+        # backend: see action_cache/backend.py; num_threads: torch cpu threads;
+        # batch_size: max query/document pairs per forward pass
+        self.backend = config.get("backend", "torch")
+        check_backend(self.backend)
+        set_num_threads(config.get("num_threads", None))
+        self.batch_size = config.get("batch_size", 16)
+        if self.backend == "int8":
+            self.model = quantize_int8(AutoModelForCausalLM.from_pretrained(path, torch_dtype=torch.float32).eval())
+        else:
+            device = "cpu"
+            if is_torch_cuda_available():
+                device = "cuda:0"
+            elif is_torch_npu_available():
+                device="npu:0"
+            self.model = AutoModelForCausalLM.from_pretrained(path, device_map=device).eval()
         prefix = "<|im_start|>system\nJudge whether the Document meets the requirements based on the Query and the Instruct provided. Note that the answer can only be \"yes\" or \"no\".<|im_end|>\n<|im_start|>user\n"
         suffix = "<|im_end|>\n<|im_start|>assistant\n<think>\n\n</think>\n\n"
         self.prefix_tokens = self.tokenizer.encode(prefix, add_special_tokens=False)
@@ -20,15 +33,50 @@ class Qwen3Reranker:
         self.token_true_id = self.tokenizer.convert_tokens_to_ids("yes")
         self.instruct_fmt = config.get("instruct_fmt",
                                        "<Instruct>: Given a phone-use task, retrieve similar tasks that shares at least **{n}** steps with the given task\n<Query>: {query} \n<Document>: {document}")
+        self.max_length = 8192
+        # reuse_prefix_kv: run the shared system prompt through the model once
+        # and reuse its key/value cache for every batch
+        self.reuse_prefix_kv = config.get("reuse_prefix_kv", True)
+        self.prefix_cache = None
+        # score_cache_size: max number of memoized (query, document, step) scores, 0 disables it
+        self.score_cache_size = config.get("score_cache_size", 4096)
+        self.score_cache = OrderedDict()
+        # the model and the caches are shared by all threads executing tasks
+        self.lock = threading.Lock()
 
     def rerank(self, query_tasks, document_task, step):
-        input_texts = [self.instruct_fmt.format(n=step, query=query, document=document_task) for query in query_tasks]
-        inputs = self.process_inputs(input_texts)
-        logits = self.compute_logits(inputs)
-        return logits
+        with self.lock:
+            return self._rerank(query_tasks, document_task, step)
+
+    def _rerank(self, query_tasks, document_task, step):
+        keys = [(query, document_task, step) for query in query_tasks]
+        scores = [None] * len(keys)
+        for i, key in enumerate(keys):
+            if key in self.score_cache:
+                self.score_cache.move_to_end(key)
+                scores[i] = self.score_cache[key]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        if not missing:
+            return scores
+        input_texts = [self.instruct_fmt.format(n=step, query=query_tasks[i], document=document_task) for i in missing]
+        new_scores = []
+        for start in range(0, len(input_texts), self.batch_size):
+            new_scores.extend(self.compute_scores(input_texts[start:start + self.batch_size]))
+        for i, score in zip(missing, new_scores):
+            scores[i] = score
+            if self.score_cache_size > 0:
+                self.score_cache[keys[i]] = score
+        while len(self.score_cache) > self.score_cache_size:
+            self.score_cache.popitem(last=False)
+        return scores
+
+    def compute_scores(self, input_texts):
+        if self.reuse_prefix_kv:
+            return self.compute_logits_with_prefix_cache(input_texts)
+        return self.compute_logits(self.process_inputs(input_texts))
 
     def process_inputs(self, input_texts):
-        max_length = 8192
+        max_length = self.max_length
         inputs = self.tokenizer(
             input_texts, padding=False, truncation='longest_first',
             return_attention_mask=False, max_length=max_length - len(self.prefix_tokens) - len(self.suffix_tokens)
@@ -40,12 +88,59 @@ class Qwen3Reranker:
             inputs[key] = inputs[key].to(self.model.device)
         return inputs
 
+    def process_inputs_without_prefix(self, input_texts):
+        # right padded, so that the cached prefix stays at the same positions
+        # in every row; returns the index of the last real token of each row
+        inputs = self.tokenizer(
+            input_texts, padding=False, truncation='longest_first',
+            return_attention_mask=False, max_length=self.max_length - len(self.prefix_tokens) - len(self.suffix_tokens)
+        )
+        input_ids = [ele + self.suffix_tokens for ele in inputs['input_ids']]
+        lengths = [len(ele) for ele in input_ids]
+        batch_size, seq_len, prefix_len = len(input_ids), max(lengths), len(self.prefix_tokens)
+        ids = torch.full((batch_size, seq_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((batch_size, prefix_len + seq_len), dtype=torch.long)
+        attention_mask[:, :prefix_len] = 1
+        for i, ele in enumerate(input_ids):
+            ids[i, :len(ele)] = torch.tensor(ele, dtype=torch.long)
+            attention_mask[i, prefix_len:prefix_len + len(ele)] = 1
+        position_ids = torch.arange(prefix_len, prefix_len + seq_len).unsqueeze(0).expand(batch_size, -1)
+        last_indices = torch.tensor(lengths) - 1
+        device = self.model.device
+        return ids.to(device), attention_mask.to(device), position_ids.to(device), last_indices.to(device)
+
     @torch.no_grad()
-    def compute_logits(self, inputs):
-        batch_scores = self.model(**inputs).logits[:, -1, :]
+    def get_prefix_cache(self):
+        if self.prefix_cache is None:
+            input_ids = torch.tensor([self.prefix_tokens], dtype=torch.long, device=self.model.device)
+            self.prefix_cache = self.model(input_ids=input_ids, use_cache=True).past_key_values
+        return self.prefix_cache
+
+    def _scores_from_logits(self, batch_scores):
         true_vector = batch_scores[:, self.token_true_id]
         false_vector = batch_scores[:, self.token_false_id]
         batch_scores = torch.stack([false_vector, true_vector], dim=1)
         batch_scores = torch.nn.functional.log_softmax(batch_scores, dim=1)
         scores = batch_scores[:, 1].exp().tolist()
         return scores
+
+    @torch.no_grad()
+    def compute_logits(self, inputs):
+        batch_scores = self.model(**inputs).logits[:, -1, :]
+        return self._scores_from_logits(batch_scores)
+
+    @torch.no_grad()
+    def compute_logits_with_prefix_cache(self, input_texts):
+        input_ids, attention_mask, position_ids, last_indices = self.process_inputs_without_prefix(input_texts)
+        # the model appends to the cache in place, keep the shared one intact
+        cache = copy.deepcopy(self.get_prefix_cache())
+        cache.batch_repeat_interleave(input_ids.shape[0])
+        logits = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=cache,
+            use_cache=True
+        ).logits
+        batch_scores = logits[torch.arange(input_ids.shape[0], device=logits.device), last_indices, :]
+        return self._scores_from_logits(batch_scores)
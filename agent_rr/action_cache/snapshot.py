@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import numpy as np
+import torch
+from PIL import Image
+
+from .action import UIElement
+from .buffer import EmbeddingBuffer
+
+SNAPSHOT_VERSION = 2
+TREE_FILE = "tree.json"
+ELEMS_DIR = "elems"
+
+# layout of a snapshot directory:
+#   tree.json                 nodes in bfs order, their edges, actions, tasks,
+#                             keywords and shortcuts, and the files below it uses
+#   embeddings-<sha1>.npy     task embeddings of all fuzzy edges, edge i owns a row range
+#   elems/<sha1>.png          sub_img of target elements
+# data files are named by their content and never overwritten, tree.json is
+# replaced last and is the only switch from the old snapshot to the new one,
+# files it no longer refers to are removed after that. a crash at any point
+# leaves the old or the new snapshot. the embeddings are opened
+# memory-mapped, rows are paged in when first touched
+
+def _write_file(path, write):
+    # under a temporary name first, a content-named file is never partial
+    if os.path.exists(path):
+        return
+    with open(path + ".tmp", "wb") as f:
+        write(f)
+    os.replace(path + ".tmp", path)
+
+def _dump_image(img, path):
+    digest = hashlib.sha1(f"{img.mode}:{img.width}x{img.height}:".encode() + img.tobytes()).hexdigest()
+    image = os.path.join(ELEMS_DIR, f"{digest}.png")
+    _write_file(os.path.join(path, image), lambda f: img.save(f, format="PNG"))
+    return image
+
+def _dump_action(action, path):
+    record = {"name": action.name, "param": action.param, "extra": action.extra, "target_elem": None}
+    elem = action.target_elem
+    if elem is not None:
+        # read once, the crop may be dropped by eviction meanwhile
+        sub_img = elem.sub_img
+        image = _dump_image(sub_img, path) if sub_img is not None else None
+        record["target_elem"] = {"bbox": elem.bbox, "content": elem.content, "image": image}
+    return record
+
+def _load_action(record, action_class, path):
+    action = action_class(name=record["name"], param=record["param"], extra=record["extra"])
+    elem = record["target_elem"]
+    if elem is not None:
+        sub_img = None
+        if elem["image"] is not None:
+            with Image.open(os.path.join(path, elem["image"])) as img:
+                sub_img = img.convert("RGB")
+        action.target_elem = UIElement(elem["bbox"], elem["content"], sub_img)
+    return action
+
+def _to_numpy(embeddings):
+    embeddings = embeddings.detach().cpu()
+    # numpy has no bfloat16
+    if embeddings.dtype == torch.bfloat16:
+        embeddings = embeddings.float()
+    return embeddings.numpy()
+
+def _remove_unused(path, used):
+    # files of earlier snapshots, and temporaries of an interrupted save
+    elems_dir = os.path.join(path, ELEMS_DIR)
+    candidates = [os.path.join(ELEMS_DIR, name) for name in os.listdir(elems_dir)]
+    candidates += [name for name in os.listdir(path) if name.startswith("embeddings") or name == TREE_FILE + ".tmp"]
+    for name in candidates:
+        if name not in used:
+            os.remove(os.path.join(path, name))
+
+def save_tree(tree, path):
+    os.makedirs(os.path.join(path, ELEMS_DIR), exist_ok=True)
+    fuzzy = tree.mode.name == "FUZZY"
+
+    node_ids = {}
+    nodes = []
+    queue = [tree.root]
+    while queue:
+        node = queue.pop(0)
+        node_ids[id(node)] = len(nodes)
+        nodes.append(node)
+        for e in node.edges:
+            queue.append(e.to)
+
+    embeddings = []
+    num_rows = 0
+    node_records = []
+    for node in nodes:
+        edge_records = []
+        for e in node.edges:
+            action_record = _dump_action(e.action, path)
+            edge_record = {
+                "action": action_record,
+                "to": node_ids[id(e.to)],
+                "tasks": [t.description for t in e.tasks],
+            }
+            if fuzzy:
+                live = e.task_embeddings
+                edge_record["keywords"] = list(e.keywords)
+                edge_record["embedding_offset"] = num_rows
+                edge_record["embedding_count"] = live.shape[0]
+                embeddings.append(_to_numpy(live))
+                num_rows += live.shape[0]
+            edge_records.append(edge_record)
+        node_records.append({"split_pin": node.split_pin, "edges": edge_records})
+
+    shortcut_records = []
+    for sc in tree.shortcuts:
+        action_record = _dump_action(sc.template.last_action, path)
+        shortcut_records.append({
+            "split_node": node_ids[id(sc.split_node)],
+            "action_names": sc.template.action_names,
+            "last_action": action_record,
+            "supernode": [node_ids[id(n)] for n in sc.supernode.nodes],
+        })
+
+    embeddings_file = None
+    if embeddings:
+        array = np.ascontiguousarray(np.concatenate(embeddings, axis=0))
+        digest = hashlib.sha1(f"{array.dtype}:{array.shape}:".encode() + array.tobytes()).hexdigest()
+        embeddings_file = f"embeddings-{digest}.npy"
+        _write_file(os.path.join(path, embeddings_file), lambda f: np.save(f, array))
+
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "mode": tree.mode.name,
+        "num_tasks_last_check": tree.num_tasks_last_check,
+        "embeddings": embeddings_file,
+        "nodes": node_records,
+        "shortcuts": shortcut_records,
+    }
+    tree_path = os.path.join(path, TREE_FILE)
+    with open(tree_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(snapshot, f, ensure_ascii=False)
+    os.replace(tree_path + ".tmp", tree_path)
+
+    used = {TREE_FILE, embeddings_file}
+    for node_record in node_records:
+        used.update(e["action"]["target_elem"]["image"] for e in node_record["edges"] if e["action"]["target_elem"] is not None)
+    used.update(sc["last_action"]["target_elem"]["image"] for sc in shortcut_records if sc["last_action"]["target_elem"] is not None)
+    _remove_unused(path, used)
+
+def load_tree(tree, path):
+    # imported here, tree.py imports this module
+    from .tree import ActionTreeEdge, ActionTreeEdgeFuzzy, ShortCut, ShortCutTemplate, SuperNode, Task
+
+    with open(os.path.join(path, TREE_FILE), encoding="utf-8") as f:
+        snapshot = json.load(f)
+    if snapshot["version"] != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version: {snapshot['version']}")
+    if snapshot["mode"] != tree.mode.name:
+        raise ValueError(f"Snapshot mode {snapshot['mode']} does not match tree mode {tree.mode.name}")
+    fuzzy = tree.mode.name == "FUZZY"
+
+    embeddings = None
+    if fuzzy and snapshot["embeddings"] is not None:
+        # copy-on-write mapping: pages are read lazily, and buffers may
+        # compact in place without touching the file
+        embeddings = torch.from_numpy(np.load(os.path.join(path, snapshot["embeddings"]), mmap_mode="c"))
+
+    # the same task shows up on every edge of its trace, share the objects
+    tasks = {}
+    def _get_task(description):
+        if description not in tasks:
+            tasks[description] = Task(description)
+        return tasks[description]
+
+    tree.clear()
+    nodes = [tree.root]
+    node_class = tree.root.__class__
+    for node_id, node_record in enumerate(snapshot["nodes"]):
+        node = nodes[node_id]
+        node.split_pin = node_record["split_pin"]
+        for edge_record in node_record["edges"]:
+            if edge_record["to"] != len(nodes):
+                raise ValueError("Nodes in snapshot are not in bfs order")
+            child = node_class(node)
+            nodes.append(child)
+            action = _load_action(edge_record["action"], tree.action_class, path)
+            edge_tasks = [_get_task(t) for t in edge_record["tasks"]]
+            if fuzzy:
+                start = edge_record["embedding_offset"]
+                end = start + edge_record["embedding_count"]
+                buffer = EmbeddingBuffer.wrap(embeddings[start:end])
+                edge = ActionTreeEdgeFuzzy(action, edge_tasks, child, buffer, list(edge_record["keywords"]))
+            else:
+                edge = ActionTreeEdge(action, edge_tasks, child)
+            node.add_edge(edge)
+
+    for sc_record in snapshot["shortcuts"]:
+        template = ShortCutTemplate(sc_record["action_names"], _load_action(sc_record["last_action"], tree.action_class, path))
+        supernode = SuperNode([nodes[i] for i in sc_record["supernode"]])
+        split_node = nodes[sc_record["split_node"]]
+        tree.node_shortcuts.setdefault(split_node, []).append(ShortCut(split_node, template, supernode))
+    tree.num_tasks_last_check = snapshot["num_tasks_last_check"]
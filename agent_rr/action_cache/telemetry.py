@@ -0,0 +1,141 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+METRIC_PREFIX = "agentrr_"
+# upper bounds in seconds, every histogram also has a +Inf bucket
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # counts[i]: observations in (buckets[i-1], buckets[i]], the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self):
+        return {"buckets": list(self.buckets), "counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+def _matches(key, labels):
+    key = dict(key)
+    return all(key.get(k) == str(v) for k, v in labels.items())
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Telemetry:
+    # counters, gauges and histograms keyed by name and labels, labels with
+    # a None value are left out; safe to update from several threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, _labels_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels_key(labels))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def counter_sum(self, name, **labels):
+        # sum over all counters of name whose labels include labels
+        with self.lock:
+            return sum(v for (n, key), v in self.counters.items() if n == name and _matches(key, labels))
+
+    def histogram_sum(self, name, **labels):
+        with self.lock:
+            return sum(h.sum for (n, key), h in self.histograms.items() if n == name and _matches(key, labels))
+
+    def histogram_count(self, name, **labels):
+        with self.lock:
+            return sum(h.count for (n, key), h in self.histograms.items() if n == name and _matches(key, labels))
+
+    def gauge(self, name, **labels):
+        with self.lock:
+            return self.gauges.get((name, _labels_key(labels)), 0)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "time": time.time(),
+                "counters": [{"name": n, "labels": dict(key), "value": v} for (n, key), v in sorted(self.counters.items())],
+                "gauges": [{"name": n, "labels": dict(key), "value": v} for (n, key), v in sorted(self.gauges.items())],
+                "histograms": [dict(name=n, labels=dict(key), **h.to_dict()) for (n, key), h in sorted(self.histograms.items(), key=lambda item: item[0])],
+            }
+
+    def to_json_line(self):
+        return json.dumps(self.snapshot(), ensure_ascii=False)
+
+    def write_json_line(self, path):
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(self.to_json_line() + "\n")
+
+    def to_prometheus(self):
+        # text exposition format, counters get the _total suffix
+        lines = []
+        with self.lock:
+            for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+                names = sorted({n for n, _ in metrics})
+                for name in names:
+                    metric = METRIC_PREFIX + name + ("_total" if kind == "counter" else "")
+                    lines.append(f"# TYPE {metric} {kind}")
+                    for (n, key), v in sorted(metrics.items()):
+                        if n == name:
+                            lines.append(f"{metric}{_format_labels(key)} {_format_value(v)}")
+            names = sorted({n for n, _ in self.histograms})
+            for name in names:
+                metric = METRIC_PREFIX + name
+                lines.append(f"# TYPE {metric} histogram")
+                for (n, key), h in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(list(h.buckets) + [float("inf")], h.counts):
+                        cumulative += count
+                        lines.append(f"{metric}_bucket{_format_labels(key, [('le', _format_value(float(bound)))])} {cumulative}")
+                    lines.append(f"{metric}_sum{_format_labels(key)} {_format_value(h.sum)}")
+                    lines.append(f"{metric}_count{_format_labels(key)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        # replaced atomically, e.g. for the node exporter's textfile collector
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(path + ".tmp", path)
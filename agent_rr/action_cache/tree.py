@@ -1,7 +1,10 @@
 from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import bisect
+import threading
 import torch
 import time
-from sentence_transformers import util
 try:
     from omniparser.omniparser import Omniparser
 except ImportError as e:
@@ -9,11 +12,26 @@ except ImportError as e:
 
 from .reranker import Qwen3Reranker
 from .embedder import Qwen3Embedder
+from .buffer import EmbeddingBuffer, PackedEmbeddings
+from .ann import IVFIndex, segment_max
+from .snapshot import save_tree, load_tree
+from .eviction import TASK_OVERHEAD_BYTES, MemoryCounter, collect_edges, evict, memory_usage, subtree_usage
+from .telemetry import Telemetry
+from .parse_cache import PARSE_CACHE_SIZE, ParseCache, elems_in_bbox
 from .action import Action, UIElement
 
 EMBEDDER_THRESHOLD = 0.8
 RERANKER_MIN_CONF = 0.75
 
+MIN_SUPERNODE_CAPACITY = 2
+MIN_SHORTCUT_LEN = 2
+MAX_SHORTCUT_LEN = 3
+
+# fuzzy nodes holding at least this many task embeddings are searched through
+# an IVF index instead of a dense matmul
+ANN_THRESHOLD = 20000
+ANN_NPROBE = 8
+
 class MatchMode(Enum):
     EXACT = 1
     FUZZY = 2
@@ -36,12 +54,40 @@ class ActionTreeEdge:
         self.action = action
         self.to = to
         self.tasks = tasks
+        # cache hits on the edge, and when each task was last added or hit,
+        # eviction drops the coldest first
+        self.hit_count = 0
+        self.last_hit = time.time()
+        self.task_last_used = {t.description: self.last_hit for t in tasks}
+        # kept up to date so that nbytes does not have to walk the tasks
+        self.task_bytes = sum(TASK_OVERHEAD_BYTES + len(t.description) for t in tasks)
 
     def add_task(self, task):
         self.tasks.append(task)
+        self.task_last_used[task.description] = time.time()
+        self.task_bytes += TASK_OVERHEAD_BYTES + len(task.description)
 
     def remove_task(self, task_idx):
-        self.tasks.pop(task_idx)
+        task = self.tasks.pop(task_idx)
+        self.task_bytes -= TASK_OVERHEAD_BYTES + len(task.description)
+        self._forget_task(task)
+
+    def _forget_task(self, task):
+        if task not in self.tasks:
+            self.task_last_used.pop(task.description, None)
+
+    def record_hit(self, description):
+        self.hit_count += 1
+        self.last_hit = time.time()
+        if description in self.task_last_used:
+            self.task_last_used[description] = self.last_hit
+
+    def nbytes(self):
+        # rough estimate of the memory held by the edge
+        n = self.task_bytes
+        if self.action.target_elem is not None:
+            n += self.action.target_elem.nbytes()
+        return n
 
     def __str__(self):
         return f"{self.action} {self.tasks}"
@@ -51,23 +97,54 @@ class ActionTreeEdgeFuzzy(ActionTreeEdge):
         l = len(tasks)
         if l == 0:
             raise ValueError("Tasks list is empty")
-        if l != task_embeddings.shape[0]:
+        if l != len(task_embeddings):
             raise ValueError("Tasks list length must match task_embeddings length")
         if l != len(keywords):
             raise ValueError("Tasks list length must match keywords length")
         super().__init__(action, tasks, to)
-        self.task_embeddings = task_embeddings
+        if isinstance(task_embeddings, EmbeddingBuffer):
+            self.embedding_buffer = task_embeddings
+        else:
+            self.embedding_buffer = EmbeddingBuffer(task_embeddings)
+        # buffer row of every task, ascending; rows of removed tasks are
+        # tombstoned in the buffer until it gets compacted
+        self.task_rows = list(range(l))
         self.keywords = keywords
+        # bumped on every change of the embedding buffer, lets the parent
+        # node know when its packed embedding matrix is stale
+        self.version = 0
+
+    @property
+    def task_embeddings(self):
+        return self.embedding_buffer.live()
 
     def add_task(self, task, task_embedding, keyword=""):
-        self.tasks.append(task)
-        self.task_embeddings = torch.cat([self.task_embeddings, task_embedding], dim=0)
+        super().add_task(task)
+        self.task_rows.extend(self.embedding_buffer.append(task_embedding))
         self.keywords.append(keyword)
+        self.version += 1
 
     def remove_task(self, task_idx):
-        self.tasks.pop(task_idx)
-        self.task_embeddings = torch.cat([self.task_embeddings[:task_idx], self.task_embeddings[task_idx+1:]], dim=0)
+        super().remove_task(task_idx)
+        self.embedding_buffer.remove(self.task_rows.pop(task_idx))
         self.keywords.pop(task_idx)
+        if self.embedding_buffer.needs_compaction():
+            self.embedding_buffer.compact()
+            self.task_rows = list(range(len(self.tasks)))
+        self.version += 1
+
+    def shrink(self):
+        # only a compaction renumbers the rows and makes packed copies stale
+        if self.embedding_buffer.shrink():
+            self.task_rows = list(range(len(self.tasks)))
+            self.version += 1
+
+    def nbytes(self):
+        return super().nbytes() + self.embedding_buffer.nbytes()
+
+    def get_task_idx(self, row):
+        # buffer row -> index into tasks and keywords
+        return bisect.bisect_left(self.task_rows, row)
 
     def reset_keyword(self, keyword):
         for i, kw in enumerate(self.keywords):
@@ -123,6 +200,13 @@ class ActionTreeNode:
         self.edges = []
         self.parent = parent
         self.parent_edge_idx = None
+        # task description -> edges holding the task
+        self.task_edges = {}
+        # guards edges, task_edges and the tasks/embeddings of the edges;
+        # every change to a node's outgoing edges goes through its methods
+        self.lock = threading.RLock()
+        # running memory estimate of the whole tree, see MemoryCounter
+        self.memory = parent.memory if parent is not None else MemoryCounter()
         self.screenshot = None
         # if a node is a possible split node, pin it
         self.split_pin = False
@@ -131,40 +215,74 @@ class ActionTreeNode:
         else:
             self.depth = 0
 
+    def _index_task(self, task, edge):
+        self.task_edges.setdefault(task.description, []).append(edge)
+
+    def _unindex_task(self, task, edge):
+        edges = self.task_edges[task.description]
+        for i, e in enumerate(edges):
+            if e is edge:
+                edges.pop(i)
+                break
+        if len(edges) == 0:
+            del self.task_edges[task.description]
+
+    def _get_task_edges(self, task):
+        edges = self.task_edges.get(task.description, [])
+        if len(edges) > 1:
+            edges = sorted(edges, key=lambda e: e.to.parent_edge_idx)
+        return edges
+
+    def has_task(self, edge, task):
+        with self.lock:
+            return edge in self.task_edges.get(task.description, [])
+
+    def add_edge(self, edge):
+        with self.lock:
+            edge.to.parent_edge_idx = len(self.edges)
+            self.edges.append(edge)
+            for t in edge.tasks:
+                self._index_task(t, edge)
+            self.memory.add(edge.nbytes())
+
+    def add_task(self, edge, task, *args):
+        with self.lock:
+            before = edge.nbytes()
+            edge.add_task(task, *args)
+            self._index_task(task, edge)
+            self.memory.add(edge.nbytes() - before)
+
+    def add_task_if_absent(self, edge, task, *args):
+        with self.lock:
+            if not self.has_task(edge, task):
+                self.add_task(edge, task, *args)
+
     def add_child(self, action, task):
-        for e in self.edges:
-            # merge happens here
-            if e.action == action:
-                e.add_task(task)
-                return e.to
-        new_node = ActionTreeNode(self)
-        new_edge = ActionTreeEdge(action, [task], new_node)
-        new_node.parent_edge_idx = len(self.edges)
-        self.edges.append(new_edge)
-        return new_node
+        with self.lock:
+            for e in self.edges:
+                # merge happens here
+                if e.action == action:
+                    self.add_task(e, task)
+                    return e.to
+            new_node = ActionTreeNode(self)
+            self.add_edge(ActionTreeEdge(action, [task], new_node))
+            return new_node
 
     def get_cached_action(self, task):
-        ret = []
-        for e in self.edges:
-            for t in e.tasks:
-                if t == task:
-                    ret.append((e.action, e.to))
-        return ret
+        with self.lock:
+            return [(e.action, e.to) for e in self._get_task_edges(task)]
 
     def _remove_task(self, task):
-        next_node = None
-        for edge_idx, e in enumerate(self.edges):
-            for task_idx, t in enumerate(e.tasks):
-                if t == task:
-                    e.remove_task(task_idx)
-                    next_node = e.to
-                    break
+        with self.lock:
+            edges = self._get_task_edges(task)
+            if len(edges) == 0:
+                return None
+            e = edges[0]
+            self._remove_task_at(e, e.tasks.index(task))
             if len(e.tasks) == 0:
-                self.edges.pop(edge_idx)
+                self._pop_edge(e.to.parent_edge_idx)
                 return None
-            elif next_node is not None:
-                return next_node
-        return None
+            return e.to
 
     def remove_task_trace(self, task):
         node = self
@@ -172,7 +290,8 @@ class ActionTreeNode:
             node = node._remove_task(task)
 
     def get_incoming_edge(self):
-        return self.parent.edges[self.parent_edge_idx]
+        with self.parent.lock:
+            return self.parent.edges[self.parent_edge_idx]
 
     def get_incoming_action(self):
         return self.get_incoming_edge().action
@@ -180,24 +299,76 @@ class ActionTreeNode:
     def remove_child(self, child):
         if child.parent is not self:
             raise ValueError("Not a child of this node")
-        self.edges.pop(child.parent_edge_idx)
+        with self.lock:
+            self._pop_edge(child.parent_edge_idx)
+
+    def remove_edge_task(self, edge, task):
+        # drops every copy of task from edge, and the edge once it is empty
+        with self.lock:
+            for i in reversed(range(len(edge.tasks))):
+                if edge.tasks[i] == task:
+                    self._remove_task_at(edge, i)
+            if len(edge.tasks) == 0 and self.has_child(edge.to):
+                self._pop_edge(edge.to.parent_edge_idx)
+
+    def _remove_task_at(self, edge, task_idx):
+        self._unindex_task(edge.tasks[task_idx], edge)
+        before = edge.nbytes()
+        edge.remove_task(task_idx)
+        self.memory.add(edge.nbytes() - before)
+
+    def record_hit(self, child, description):
+        with self.lock:
+            if self.has_child(child):
+                self.edges[child.parent_edge_idx].record_hit(description)
+
+    def _pop_edge(self, edge_idx):
+        with self.lock:
+            edge = self.edges.pop(edge_idx)
+            for t in edge.tasks:
+                self._unindex_task(t, edge)
+            # the subtree below the edge goes with it
+            self.memory.add(-edge.nbytes() - subtree_usage(edge.to))
+            # children after the popped edge moved one slot to the left
+            for e in self.edges[edge_idx:]:
+                e.to.parent_edge_idx -= 1
+            return edge
+
+    def get_edges(self):
+        # consistent copy of the outgoing edges for readers that walk the tree
+        with self.lock:
+            return list(self.edges)
+
+    def has_child(self, child):
+        with self.lock:
+            return child.parent_edge_idx < len(self.edges) and self.edges[child.parent_edge_idx].to is child
+
+    def is_attached(self, root):
+        node = self
+        while node.parent is not None:
+            if not node.parent.has_child(node):
+                return False
+            node = node.parent
+        return node is root
 
     def try_find_shortcuts(self):
         # assume self is the split node, find the possible merged supernodes
+        min_supernode_capacity = MIN_SUPERNODE_CAPACITY
+        min_shortcut_len, max_shortcut_len = MIN_SHORTCUT_LEN, MAX_SHORTCUT_LEN
 
-        # TODO: use values from config
-        min_supernode_capacity = 2
-        min_shortcut_len, max_shortcut_len = 2, 3
+        # nodes are visited together with the action of their incoming edge,
+        # read from a copy of the parent's edges, so that the search never
+        # indexes into an edge list another thread is changing
 
-        def _can_merge_to_supernode(nodes):
+        def _can_merge_to_supernode(nodes, actions):
             # check incoming edges
             if len(nodes) < min_supernode_capacity:
                 return False
             action = None
-            for n in nodes:
+            for a in actions:
                 if action is None:
-                    action = n.get_incoming_action()
-                elif action != n.get_incoming_action():
+                    action = a
+                elif action != a:
                     return False
             return True
 
@@ -208,83 +379,202 @@ class ActionTreeNode:
                     return False
             return True
 
-        def _dfs(nodes, trace, supernodes, templates):
+        def _dfs(nodes, actions, trace, supernodes, templates):
             cur_len = len(trace)
             if cur_len > 1 and _have_same_parent(nodes):
                 return
             if cur_len > max_shortcut_len:
                 return
-            if cur_len >= min_shortcut_len and _can_merge_to_supernode(nodes):
+            if cur_len >= min_shortcut_len and _can_merge_to_supernode(nodes, actions):
                 # print(nodes)
                 supernodes.append(SuperNode(nodes))
                 action_names = trace[:-1]
-                last_action = nodes[0].get_incoming_action()
+                last_action = actions[0]
                 templates.append(ShortCutTemplate(action_names, last_action))
                 # greedy match for minimizing shortcut length
                 return
             next_layer_nodes = []
             next_actions = []
             for n in nodes:
-                for e in n.edges:
+                for e in n.get_edges():
                     next_layer_nodes.append(e.to)
                     next_actions.append(e.action)
             # group next_layer_nodes by action
             action_group = {}
             for n, a in zip(next_layer_nodes, next_actions):
                 if a.name not in action_group:
-                    action_group[a.name] = []
-                action_group[a.name].append(n)
-            for action_name, group in action_group.items():
+                    action_group[a.name] = ([], [])
+                action_group[a.name][0].append(n)
+                action_group[a.name][1].append(a)
+            for action_name, (group, group_actions) in action_group.items():
                 next_trace = trace + [action_name]
-                _dfs(group, next_trace, supernodes, templates)
+                _dfs(group, group_actions, next_trace, supernodes, templates)
 
         supernodes = []
         templates = []
         trace = []
-        _dfs([self], trace, supernodes, templates)
+        _dfs([self], [None], trace, supernodes, templates)
         shortcuts = [ShortCut(self, t, s) for t, s in zip(templates, supernodes)]
         return shortcuts
 
 class ActionTreeNodeFuzzy(ActionTreeNode):
     def __init__(self, parent=None):
         super().__init__(parent)
+        # live embeddings of all outgoing edges in one PackedEmbeddings,
+        # segment i is edge i. new edges and tasks are appended in place,
+        # removals, compaction and shrinking make it stale (see
+        # _packed_is_stale) and the next lookup rebuilds it
+        self.packed = None
+        self.packed_edges = []
+        self.packed_versions = []
+        # IVFIndex over the embeddings of all outgoing edges, built on the
+        # first lookup above the ann threshold and kept up to date after
+        self.ann_index = None
+
+    def add_edge(self, edge):
+        with self.lock:
+            packed_fresh = self.packed is not None and len(self.packed_edges) == len(self.edges)
+            super().add_edge(edge)
+            if packed_fresh:
+                self.packed_edges.append(edge)
+                self.packed_versions.append(None)
+                self._append_packed(len(self.edges) - 1, edge.task_embeddings)
+            if self.ann_index is not None:
+                before = self.ann_index.nbytes()
+                self.ann_index.add(edge.task_embeddings, [(edge, t, kw) for t, kw in zip(edge.tasks, edge.keywords)])
+                self.memory.add(self.ann_index.nbytes() - before)
+
+    def add_task(self, edge, task, task_embedding, keyword=""):
+        with self.lock:
+            i = edge.to.parent_edge_idx
+            packed_fresh = (self.packed is not None and i < len(self.packed_edges)
+                            and self.packed_edges[i] is edge and self.packed_versions[i] == edge.version)
+            super().add_task(edge, task, task_embedding, keyword)
+            if packed_fresh:
+                self._append_packed(i, task_embedding)
+            if self.ann_index is not None:
+                before = self.ann_index.nbytes()
+                self.ann_index.add(task_embedding, [(edge, task, keyword)])
+                self.memory.add(self.ann_index.nbytes() - before)
+
+    def _remove_task_at(self, edge, task_idx):
+        if self.ann_index is not None:
+            before = self.ann_index.nbytes()
+            self.ann_index.remove(edge, edge.tasks[task_idx])
+            self.memory.add(self.ann_index.nbytes() - before)
+        super()._remove_task_at(edge, task_idx)
+
+    def _pop_edge(self, edge_idx):
+        with self.lock:
+            if self.ann_index is not None:
+                before = self.ann_index.nbytes()
+                self.ann_index.remove_edge(self.edges[edge_idx])
+                self.memory.add(self.ann_index.nbytes() - before)
+            return super()._pop_edge(edge_idx)
 
     def add_child(self, action, task, task_embedding):
         keyword = self._extract_keyword(task, action)
-        for e in self.edges:
-            # merge happens here
-            if e.action == action:
-                e.add_task(task, task_embedding, keyword)
-                return e.to
-        new_node = ActionTreeNodeFuzzy(self)
-        new_edge = ActionTreeEdgeFuzzy(action, [task], new_node, task_embedding, [keyword])
-        new_node.parent_edge_idx = len(self.edges)
-        self.edges.append(new_edge)
-        return new_node
+        with self.lock:
+            for e in self.edges:
+                # merge happens here
+                if e.action == action:
+                    self.add_task(e, task, task_embedding, keyword)
+                    return e.to
+            new_node = ActionTreeNodeFuzzy(self)
+            self.add_edge(ActionTreeEdgeFuzzy(action, [task], new_node, task_embedding, [keyword]))
+            return new_node
 
     def _extract_keyword(self, task, action):
         return ""
 
-    def get_cached_action(self, task, step_embedding):
+    def _packed_is_stale(self):
+        if self.packed is None or len(self.packed_edges) != len(self.edges):
+            return True
+        for e, packed_e, version in zip(self.edges, self.packed_edges, self.packed_versions):
+            if e is not packed_e or e.version != version:
+                return True
+        return False
+
+    def _append_packed(self, edge_idx, embeddings):
+        # the last rows of edge edge_idx were just appended to its buffer,
+        # append them to the packed matrix in place instead of a rebuild
+        edge = self.edges[edge_idx]
+        n = embeddings.shape[0]
+        self.packed.append(edge_idx, embeddings, edge.task_rows[len(edge.task_rows) - n:])
+        self.packed_versions[edge_idx] = edge.version
+
+    def get_packed_embeddings(self):
+        if self._packed_is_stale():
+            self.packed = PackedEmbeddings()
+            # edges loaded from a snapshot may live on another device
+            device = self.edges[0].embedding_buffer.data.device
+            for i, e in enumerate(self.edges):
+                self.packed.append(i, e.task_embeddings.to(device), e.task_rows)
+            self.packed_edges = list(self.edges)
+            self.packed_versions = [e.version for e in self.edges]
+        return self.packed
+
+    def num_task_embeddings(self):
+        return sum(len(e.tasks) for e in self.edges)
+
+    def _get_ann_index(self, ann_config):
+        # None below the threshold, the index is dropped when the node shrinks
+        if ann_config is None:
+            return None
+        size = self.ann_index.size if self.ann_index is not None else self.num_task_embeddings()
+        before = self.ann_index.nbytes() if self.ann_index is not None else 0
+        if size < ann_config["threshold"]:
+            self.ann_index = None
+            self.memory.add(-before)
+            return None
+        if self.ann_index is None or self.ann_index.needs_retrain():
+            embeddings = torch.cat([e.task_embeddings.to(self.edges[0].task_embeddings.device) for e in self.edges], dim=0)
+            entries = [(e, t, kw) for e in self.edges for t, kw in zip(e.tasks, e.keywords)]
+            self.ann_index = IVFIndex(embeddings, entries, ann_config.get("num_lists"), ann_config["nprobe"])
+            self.memory.add(self.ann_index.nbytes() - before)
+        return self.ann_index
+
+    def get_cached_action(self, task, step_embedding, threshold=EMBEDDER_THRESHOLD, ann_config=None):
+        # ann_config: {"threshold", "nprobe", "num_lists"} of the IVF index,
+        # None for an exact search
         ret = []
-        for e in self.edges:
-            hit = util.semantic_search(step_embedding, e.task_embeddings, top_k=1, score_function=util.dot_score)[0]
-            # print(hit)
-            score = hit[0]['score']
-            if score < EMBEDDER_THRESHOLD:
-                continue
-            corpus_id = hit[0]['corpus_id']
-            keyword = e.keywords[corpus_id]
-            if keyword not in task.description:
-                continue
-            hit_task = e.tasks[corpus_id]
-            print(hit_task, score)
-            ret.append((e.action, e.to, keyword, hit_task))
+        with self.lock:
+            if len(self.edges) == 0:
+                return ret
+            ann_index = self._get_ann_index(ann_config)
+            if ann_index is not None:
+                hits = ann_index.query(step_embedding, threshold)
+                # same order as the exact search
+                hits.sort(key=lambda hit: hit[0].to.parent_edge_idx)
+                for e, hit_task, keyword, score in hits:
+                    if keyword not in task.description:
+                        continue
+                    print(hit_task, score)
+                    ret.append((e.action, e.to, keyword, hit_task))
+                return ret
+            packed = self.get_packed_embeddings()
+            embeddings, edge_ids = packed.view()
+            # one matmul for all edges, then the best hit of every edge
+            scores = torch.mm(step_embedding.to(device=embeddings.device, dtype=embeddings.dtype), embeddings.T)[0]
+            max_scores, max_rows = segment_max(scores, edge_ids, len(self.edges))
+            for e, score, row in zip(self.edges, max_scores.tolist(), max_rows.tolist()):
+                if score < threshold:
+                    continue
+                corpus_id = e.get_task_idx(packed.source_rows[row])
+                keyword = e.keywords[corpus_id]
+                if keyword not in task.description:
+                    continue
+                hit_task = e.tasks[corpus_id]
+                print(hit_task, score)
+                ret.append((e.action, e.to, keyword, hit_task))
         return ret
 
     def reset_keyword(self, keyword):
-        for e in self.edges:
-            e.reset_keyword(keyword)
+        with self.lock:
+            for e in self.edges:
+                e.reset_keyword(keyword)
+            if self.ann_index is not None:
+                self.ann_index.reset_keyword(keyword)
 
 
 class ActionTree:
@@ -297,7 +587,10 @@ class ActionTree:
                  embedder_config=None,
                  reranker_config=None,
                  enable_ui_detection=False,
-                 omniparser_config=None):
+                 omniparser_config=None,
+                 speculative=False,
+                 memory_budget=None,
+                 embedder=None):
         self.env = env
         self.agent = agent
         self.done = done
@@ -305,19 +598,57 @@ class ActionTree:
         self.action_class = action_class
         self.enable_ui_detection = enable_ui_detection
         self.generate_only = False
-        self.shortcuts = []
+        # speculative: execute cached actions right away and let the agent
+        # verify them in the background, see _execute_speculative
+        self.speculative = speculative
+        self.verify_executor = ThreadPoolExecutor(thread_name_prefix="speculative-verify") if speculative else None
+        # split node -> shortcuts starting at it
+        self.node_shortcuts = {}
+        # nodes whose shortcuts must be recomputed in the next update_shortcuts
+        self.dirty_nodes = set()
         self.num_tasks_last_check = 0
+        # execute may run from several threads (one per device) on the same
+        # tree: nodes lock their own edges, shortcut_lock guards dirty_nodes,
+        # node_shortcuts and num_tasks_last_check, telemetry has its own.
+        # save, load and clear must not overlap with running executes
+        self.shortcut_lock = threading.Lock()
+        self.omniparser_lock = threading.Lock()
+        # memory_budget: bytes the cached tasks, embeddings and crops may
+        # take, enforced after every execute, None for no limit
+        self.memory_budget = memory_budget
+        self.eviction_lock = threading.Lock()
+        self.telemetry = Telemetry()
         if mode == MatchMode.EXACT:
             self.embedder = None
             self.root = ActionTreeNode()
         elif mode == MatchMode.FUZZY:
             if embedder_config is None:
                 raise ValueError("embedder_config is required for fuzzy matching")
-            self.embedder = Qwen3Embedder(embedder_config)
+            # embedder: an already built embedder (e.g. a stub without a
+            # model) used instead of loading one from embedder_config
+            self.embedder = embedder if embedder is not None else Qwen3Embedder(embedder_config)
             self.root = ActionTreeNodeFuzzy()
+            # threshold: min cosine similarity of a cached task to be a candidate
+            self.embedder_threshold = embedder_config.get("threshold", EMBEDDER_THRESHOLD)
+            # ann_threshold: task embeddings of a node above which it is searched
+            # through an IVF index, None to always search exactly;
+            # ann_nprobe/ann_num_lists: see IVFIndex
+            # ann_measure_recall: also run the exact search on indexed nodes and
+            # count how many of its hits the index found (slow, for benchmarks)
+            ann_threshold = embedder_config.get("ann_threshold", ANN_THRESHOLD)
+            self.ann_config = None
+            if ann_threshold is not None:
+                self.ann_config = {
+                    "threshold": ann_threshold,
+                    "nprobe": embedder_config.get("ann_nprobe", ANN_NPROBE),
+                    "num_lists": embedder_config.get("ann_num_lists", None),
+                }
+            self.ann_measure_recall = embedder_config.get("ann_measure_recall", False)
 
             if reranker_config is not None:
                 self.reranker = Qwen3Reranker(reranker_config)
+                # min_conf: min reranker score of a candidate to be kept
+                self.reranker_min_conf = reranker_config.get("min_conf", RERANKER_MIN_CONF)
             else:
                 self.reranker = None
         else:
@@ -326,113 +657,440 @@ class ActionTree:
         if omniparser_config is not None:
             self.enable_ui_detection = True
             self.omniparser = Omniparser(omniparser_config)
+            # parse_cache_size: screenshots whose parsed elements are kept
+            self.parse_cache = ParseCache(omniparser_config.get("parse_cache_size", PARSE_CACHE_SIZE))
         else:
             self.omniparser = None
+            self.parse_cache = None
 
         self.reset_counter()
 
+    # metrics recorded in self.telemetry, all of them per app if execute
+    # was given one:
+    #   step_seconds{phase}                 histogram of every env, embedding,
+    #                                       detection and inference call
+    #   lookups{depth, result}              hit or miss of every step
+    #   misses{depth, reason}               no_candidate, ui_changed, rejected
+    #                                       (speculation), generate_only, diverged
+    #   reranker_candidates/filtered{depth} fuzzy hits before and dropped by the reranker
+    #   shortcut_activations                last actions predicted by a shortcut
+    #   speculation{decision}               agree, rollback, diverged
+    #   tasks                               executed tasks
+    #   parse_cache{result}                 hit or miss of omniparser outputs
+    # and without app: detection_tier_seconds{tier}, detection_decisions{tier},
+    # evictions{kind}, eviction_runs, plus the gauges of update_gauges
+
     def reset_counter(self):
-        self.env_counter = 0.0
-        self.inference_counter = 0.0
-        self.detection_counter = 0.0
-        self.embedding_counter = 0.0
+        self.telemetry.reset()
+
+    def observe_step(self, phase, seconds, app=None):
+        self.telemetry.observe("step_seconds", seconds, phase=phase, app=app)
+
+    # totals of the former float counters
+
+    @property
+    def env_counter(self):
+        return self.telemetry.histogram_sum("step_seconds", phase="env")
+
+    @property
+    def inference_counter(self):
+        return self.telemetry.histogram_sum("step_seconds", phase="inference")
+
+    @property
+    def detection_counter(self):
+        return self.telemetry.histogram_sum("step_seconds", phase="detection")
+
+    @property
+    def embedding_counter(self):
+        return self.telemetry.histogram_sum("step_seconds", phase="embedding")
+
+    @property
+    def detection_tier_counter(self):
+        return {tier: self.telemetry.histogram_sum("detection_tier_seconds", tier=tier) for tier in ["hash", "thumbnail", "ssim"]}
+
+    @property
+    def detection_tier_decisions(self):
+        return {tier: self.telemetry.counter_sum("detection_decisions", tier=tier) for tier in ["hash", "thumbnail", "ssim", "content"]}
+
+    @property
+    def speculation_decisions(self):
+        return {d: self.telemetry.counter_sum("speculation", decision=d) for d in ["agree", "rollback", "diverged"]}
+
+    @property
+    def eviction_stats(self):
+        stats = {kind: self.telemetry.counter_sum("evictions", kind=kind) for kind in ["crops", "leaves", "tasks"]}
+        stats["runs"] = self.telemetry.counter_sum("eviction_runs")
+        stats["memory_usage"] = self.telemetry.gauge("memory_bytes")
+        return stats
+
+    def hit_rate_by_depth(self, app=None):
+        # depth -> (hits, lookups)
+        hits = {}
+        for c in self.telemetry.snapshot()["counters"]:
+            labels = c["labels"]
+            if c["name"] != "lookups" or (app is not None and labels.get("app") != app):
+                continue
+            depth = int(labels["depth"])
+            h, n = hits.get(depth, (0, 0))
+            hits[depth] = (h + (c["value"] if labels["result"] == "hit" else 0), n + c["value"])
+        return dict(sorted(hits.items()))
+
+    def update_gauges(self):
+        pairs = collect_edges(self)
+        self.telemetry.set("tree_nodes", len(pairs) + 1)
+        self.telemetry.set("tree_edges", len(pairs))
+        self.telemetry.set("tree_tasks", sum(len(e.tasks) for _, e in pairs))
+        self.telemetry.set("shortcuts", len(self.shortcuts))
+        self.telemetry.set("memory_bytes", sum(e.nbytes() for _, e in pairs))
+
+    def write_metrics(self, jsonl_path=None, prometheus_path=None):
+        # appends a json line and/or rewrites a prometheus text file
+        self.update_gauges()
+        if jsonl_path is not None:
+            self.telemetry.write_json_line(jsonl_path)
+        if prometheus_path is not None:
+            self.telemetry.write_prometheus(prometheus_path)
 
     def print_counter(self):
         print(f"env_counter: {self.env_counter}, inference_counter: {self.inference_counter}, detection_counter: {self.detection_counter}, embedding_counter: {self.embedding_counter}")
+        print(f"detection_tier_counter: {self.detection_tier_counter}, detection_tier_decisions: {self.detection_tier_decisions}")
+        if self.speculative:
+            print(f"speculation_decisions: {self.speculation_decisions}")
+        if self.memory_budget is not None:
+            print(f"eviction_stats: {self.eviction_stats}")
+        for depth, (hits, lookups) in self.hit_rate_by_depth().items():
+            print(f"depth {depth}: {hits}/{lookups} hits")
 
     def clear(self):
-        self.shortcuts = []
+        with self.shortcut_lock:
+            self.node_shortcuts = {}
+            self.dirty_nodes = set()
         self.num_tasks_last_check = 0
         self.root = ActionTreeNode() if self.mode == MatchMode.EXACT else ActionTreeNodeFuzzy()
 
-    def target_elem_changed(self, cur_screen, action):
+    def memory_usage(self):
+        return memory_usage(self)
+
+    def enforce_memory_budget(self):
+        if self.memory_budget is None:
+            return
+        if self.root.memory.value <= self.memory_budget:
+            # the running estimate is enough, only walk the tree when over
+            self.telemetry.set("memory_bytes", self.root.memory.value)
+            return
+        with self.eviction_lock:
+            usage, evicted = evict(self, self.memory_budget)
+            self.telemetry.set("memory_bytes", usage)
+            if sum(evicted.values()) == 0:
+                return
+            self.telemetry.inc("eviction_runs")
+            for kind, count in evicted.items():
+                self.telemetry.inc("evictions", count, kind=kind)
+        print(f"evicted {evicted}, memory usage: {usage}")
+        if evicted["leaves"] > 0 or evicted["tasks"] > 0:
+            # evicted root tasks must not hold back the next shortcut update
+            num_tasks = self.get_num_tasks()
+            with self.shortcut_lock:
+                self.num_tasks_last_check = min(self.num_tasks_last_check, num_tasks)
+        if evicted["leaves"] > 0:
+            self.update_shortcuts()
+
+    def save(self, path):
+        save_tree(self, path)
+
+    def load(self, path):
+        # replaces the current cache with the snapshot in path
+        load_tree(self, path)
+
+    def parse_screen(self, screen, app=None):
+        key = self.parse_cache.key(screen)
+        parsed_elems = self.parse_cache.get(key)
+        if parsed_elems is not None:
+            self.telemetry.inc("parse_cache", app=app, result="hit")
+            return parsed_elems
+        with self.omniparser_lock:
+            # another thread may have parsed the same screen meanwhile
+            parsed_elems = self.parse_cache.get(key)
+            if parsed_elems is None:
+                parsed_elems = self.omniparser.parse(screen)
+                self.parse_cache.put(key, parsed_elems)
+                self.telemetry.inc("parse_cache", app=app, result="miss")
+                return parsed_elems
+        self.telemetry.inc("parse_cache", app=app, result="hit")
+        return parsed_elems
+
+    def target_elem_changed(self, cur_screen, action, app=None):
         if action.target_elem is None:
             return False
         if cur_screen is None:
             return False
         target_elem = action.target_elem
         bbox = target_elem.bbox
-        x1, x2 = map(lambda x: x / 1000 * cur_screen.width, (bbox[0], bbox[2]))
-        y1, y2 = map(lambda x: x / 1000 * cur_screen.height, (bbox[1], bbox[3]))
-        cropped_screen = cur_screen.crop((x1, y1, x2, y2))
         if self.omniparser is None:
+            x1, x2 = map(lambda x: x / 1000 * cur_screen.width, (bbox[0], bbox[2]))
+            y1, y2 = map(lambda x: x / 1000 * cur_screen.height, (bbox[1], bbox[3]))
+            cropped_screen = cur_screen.crop((x1, y1, x2, y2))
             new_elem = UIElement(bbox, target_elem.content, cropped_screen)
-            return new_elem != target_elem
+            tier_counter = {}
+            equal, tier = new_elem.compare(target_elem, tier_counter)
+            for k, v in tier_counter.items():
+                self.telemetry.observe("detection_tier_seconds", v, tier=k)
+            self.telemetry.inc("detection_decisions", tier=tier)
+            return not equal
         else:
-            parsed_elems = self.omniparser.parse(cropped_screen)
-
+            # the whole screen is parsed once and shared by all candidates
+            # (and identical screens), each one looks at the elements of its crop
+            parsed_elems = self.parse_screen(cur_screen, app)
+            parsed_elems = elems_in_bbox(parsed_elems, [x / 1000 for x in bbox])
             for elem in parsed_elems:
                 if elem["content"] == target_elem.content:
                     return False
             return True
 
     def get_num_tasks(self):
-        return sum([len(e.tasks) for e in self.root.edges])
+        return sum([len(e.tasks) for e in self.root.get_edges()])
+
+    @property
+    def shortcuts(self):
+        with self.shortcut_lock:
+            return [sc for shortcuts in self.node_shortcuts.values() for sc in shortcuts]
+
+    def get_shortcuts(self, node):
+        with self.shortcut_lock:
+            return self.node_shortcuts.get(node, [])
+
+    def _find_shortcuts(self, node):
+        shortcuts = node.try_find_shortcuts()
+        # last_action cannot be done action
+        return [sc for sc in shortcuts if not self.done(sc.template.last_action)]
+
+    def _publish_shortcuts(self, node, shortcuts):
+        # caller holds shortcut_lock
+        if shortcuts:
+            self.node_shortcuts[node] = shortcuts
+        else:
+            self.node_shortcuts.pop(node, None)
+        node.split_pin = shortcuts != []
 
     def generate_shortcuts(self):
-        # periodically check if there are new shortcuts
-        # use bfs
+        # rebuild shortcuts of the whole tree, use bfs
         queue = [self.root]
-        self.shortcuts = []
+        found = []
+        with self.shortcut_lock:
+            self.dirty_nodes = set()
         while queue:
             node = queue.pop(0)
-            for e in node.edges:
+            for e in node.get_edges():
                 queue.append(e.to)
             if node is self.root:
                 continue
-            shortcuts = node.try_find_shortcuts()
-            # last_action cannot be done action
-            shortcuts = [sc for sc in shortcuts if not self.done(sc.template.last_action)]
-            self.shortcuts.extend(shortcuts)
-            node.split_pin = shortcuts != []
+            found.append((node, self._find_shortcuts(node)))
+        with self.shortcut_lock:
+            self.node_shortcuts = {}
+            for node, shortcuts in found:
+                self._publish_shortcuts(node, shortcuts)
+
+    def mark_dirty(self, node):
+        # shortcuts of a split node only depend on its subtree down to
+        # MAX_SHORTCUT_LEN levels, so an edge change at node can only affect
+        # node itself and its ancestors within that distance
+        with self.shortcut_lock:
+            for _ in range(MAX_SHORTCUT_LEN + 1):
+                if node is None:
+                    break
+                self.dirty_nodes.add(node)
+                node = node.parent
+
+    def update_shortcuts(self):
+        # only recompute shortcuts of nodes marked dirty since the last update.
+        # the search runs without shortcut_lock so that lookups of other
+        # threads are not blocked; nodes marked dirty meanwhile are kept for
+        # the next update
+        with self.shortcut_lock:
+            dirty_nodes = self.dirty_nodes
+            self.dirty_nodes = set()
+        found = []
+        for node in dirty_nodes:
+            if node is self.root or not node.is_attached(self.root):
+                continue
+            found.append((node, self._find_shortcuts(node)))
+        with self.shortcut_lock:
+            for node, shortcuts in found:
+                self._publish_shortcuts(node, shortcuts)
+            # split nodes cut off by remove_task_trace
+            for node in [n for n in self.node_shortcuts if not n.is_attached(self.root)]:
+                del self.node_shortcuts[node]
+
+    def check_consistency(self):
+        # returns a list of problems, empty if parent links, the task index
+        # and the embedding rows of every edge agree with each other
+        problems = []
+        queue = [self.root]
+        while queue:
+            node = queue.pop(0)
+            with node.lock:
+                edges = list(node.edges)
+                index = {k: list(v) for k, v in node.task_edges.items()}
+                for i, e in enumerate(edges):
+                    if e.to.parent is not node or e.to.parent_edge_idx != i:
+                        problems.append(f"{e.to} has a wrong parent link")
+                    for t in e.tasks:
+                        if e not in index.get(t.description, []):
+                            problems.append(f"task {t.description} of {e.to} is not indexed")
+                    if self.mode == MatchMode.FUZZY and not (len(e.tasks) == len(e.keywords) == len(e.task_rows) == len(e.embedding_buffer)):
+                        problems.append(f"{e.to} has {len(e.tasks)} tasks but {len(e.embedding_buffer)} embeddings")
+                for description, indexed in index.items():
+                    for e in indexed:
+                        if e not in edges or description not in [t.description for t in e.tasks]:
+                            problems.append(f"stale index entry {description} at {node}")
+            queue.extend(e.to for e in edges)
+        return problems
+
+    def _add_child(self, node, *args):
+        # add_child that marks node dirty if it got a new edge
+        with node.lock:
+            num_edges = len(node.edges)
+            next_node = node.add_child(*args)
+            changed = len(node.edges) != num_edges
+        if changed:
+            self.mark_dirty(node)
+        return next_node
+
+    def remove_task_trace(self, task):
+        node = self.root
+        while node is not None:
+            with node.lock:
+                num_edges = len(node.edges)
+                next_node = node._remove_task(task)
+                changed = len(node.edges) != num_edges
+            if changed:
+                self.mark_dirty(node)
+            node = next_node
 
-    def execute(self, task_description):
+    def _execute_speculative(self, env, history, task_description, action, app=None):
+        # executes the cached action while the agent generates the action for
+        # the pre-action state, returns the agent's action if it disagrees
+        verify_input = yield ("env", env.get_agent_input_speculative, (history, task_description, action))
+        pending = yield ("agent_start", verify_input)
+        start_time = time.time()
+        yield ("env", env.execute, (action,))
+        end_time = time.time()
+        self.observe_step("env", end_time - start_time, app)
+        start_time = time.time()
+        verified_action = self.action_class(**(yield ("agent_wait", pending)))
+        end_time = time.time()
+        # only the part of the inference not hidden behind execute
+        self.observe_step("inference", end_time - start_time, app)
+        if verified_action == action:
+            return None
+        return verified_action
+
+    def execute(self, task_description, env=None, agent=None, app=None):
+        # env/agent: per-device pair when several threads share this tree
+        # app: label of the metrics recorded for this task
+        env = self.env if env is None else env
+        agent = self.agent if agent is None else agent
+        steps = self._execute_steps(task_description, env, app)
+        result = None
+        while True:
+            try:
+                request = steps.send(result)
+            except StopIteration:
+                return
+            if request[0] == "env":
+                result = request[1](*request[2])
+            elif request[0] == "agent":
+                result = agent.generate(request[1])
+            elif request[0] == "agent_start":
+                result = self.verify_executor.submit(agent.generate, request[1])
+            else:
+                result = request[1].result()
+
+    async def aexecute(self, task_description, env=None, agent=None, app=None):
+        # execute as a coroutine: agent calls are awaited (agent.agenerate) and
+        # env calls run in the loop's default executor, so that one event
+        # loop drives many devices sharing this tree. lookups, embedding and
+        # detection still run on the loop thread
+        env = self.env if env is None else env
+        agent = self.agent if agent is None else agent
+        loop = asyncio.get_running_loop()
+        steps = self._execute_steps(task_description, env, app)
+        result = None
+        while True:
+            try:
+                request = steps.send(result)
+            except StopIteration:
+                return
+            if request[0] == "env":
+                result = await loop.run_in_executor(None, request[1], *request[2])
+            elif request[0] == "agent":
+                result = await agent.agenerate(request[1])
+            elif request[0] == "agent_start":
+                result = asyncio.ensure_future(agent.agenerate(request[1]))
+            else:
+                result = await request[1]
+
+    def _execute_steps(self, task_description, env, app=None):
+        # the steps of a task as a generator that yields every env and agent
+        # call and is sent its result: ("env", fn, args), ("agent",
+        # agent_input), and for speculation ("agent_start", agent_input),
+        # which returns a handle, and ("agent_wait", handle). execute and
+        # aexecute run the calls blocking or on asyncio
         node = self.root
         history = []
         task = Task(task_description)
         if self.mode == MatchMode.FUZZY:
-            start_time = time.time()
-            num_precomute = 16
-            step_embeddings = self.embedder.embed([task_description] * num_precomute, steps=range(1, num_precomute + 1))
-            end_time = time.time()
-            self.embedding_counter += end_time - start_time
-            recompute_times = 0
+            # step embeddings are computed in the background while the
+            # environment is queried and actions are executed
+            step_embeddings = self.embedder.stream(task_description)
 
         tracking_shortcut = False
         shortcut_action = None
+        # set once a rejected speculative action could not be rolled back,
+        # cached actions no longer match the state the task is in
+        diverged = False
 
         while True:
             # candidate (action, next_node) pairs
             action_nodes = []
             depth = node.depth
+            executed = False
+            verified_action = None
+            # the agent disagreed with an executed cached action that could
+            # not be rolled back, a miss that still took the cached edge
+            rejected = False
+            # cached task each candidate was found by, credited with the hit
+            hit_descriptions = None
+
+            start_time = time.time()
+            agent_input = yield ("env", env.get_agent_input, (history, task_description))
+            end_time = time.time()
+            self.observe_step("env", end_time - start_time, app)
 
             start_time = time.time()
 
             if self.mode == MatchMode.EXACT:
                 if shortcut_action is not None:
-                    shortcut_next_node = node.add_child(shortcut_action, task)
+                    shortcut_next_node = self._add_child(node, shortcut_action, task)
                     action_nodes = [(shortcut_action, shortcut_next_node)]
-                    keywords = [shortcut_next_node.get_incoming_edge().keywords[-1]]
                     shortcut_action = None
                 else:
                     action_nodes = node.get_cached_action(task)
             else:
-                if depth >= (recompute_times + 1) * num_precomute:
-                    recompute_times += 1
-                    step_embeddings = self.embedder.embed(
-                        [task_description] * num_precomute,
-                        steps=range(recompute_times * num_precomute + 1, (recompute_times + 1) * num_precomute + 1)
-                    )
-
-                step_embedding = step_embeddings[depth - recompute_times * num_precomute].unsqueeze(0)
+                step_embedding = step_embeddings.get(depth + 1)
 
                 if shortcut_action is not None:
-                    shortcut_next_node = node.add_child(shortcut_action, task, step_embedding)
+                    shortcut_next_node = self._add_child(node, shortcut_action, task, step_embedding)
                     action_nodes = [(shortcut_action, shortcut_next_node)]
                     keywords = [shortcut_next_node.get_incoming_edge().keywords[-1]]
                     shortcut_action = None
                 else:
-                    action_node_keyword_tasks = node.get_cached_action(task, step_embedding)
+                    action_node_keyword_tasks = node.get_cached_action(task, step_embedding, self.embedder_threshold, self.ann_config)
+                    if self.ann_measure_recall and node.ann_index is not None:
+                        exact = node.get_cached_action(task, step_embedding, self.embedder_threshold)
+                        found = set(id(n) for a, n, kw, t in action_node_keyword_tasks)
+                        self.telemetry.inc("ann_exact_hits", len(exact), app=app, depth=depth + 1)
+                        self.telemetry.inc("ann_recalled_hits", len([n for a, n, kw, t in exact if id(n) in found]), app=app, depth=depth + 1)
                     hit_tasks = [t.description for a, n, kw, t in action_node_keyword_tasks]
                     if len(action_node_keyword_tasks) == 0:
                         print(f"No similar task found.")
@@ -440,39 +1098,46 @@ class ActionTree:
                         print(f"Found similar task: {hit_tasks}")
                     if self.reranker is not None and len(hit_tasks) > 0:
                         scores = self.reranker.rerank(query_tasks=hit_tasks, document_task=task_description, step=depth + 1)
-                        indices = [i for i, score in enumerate(scores) if score > RERANKER_MIN_CONF]
+                        indices = [i for i, score in enumerate(scores) if score > self.reranker_min_conf]
                         action_node_keyword_tasks = [action_node_keyword_tasks[i] for i in indices]
+                        self.telemetry.inc("reranker_candidates", len(hit_tasks), app=app, depth=depth + 1)
+                        self.telemetry.inc("reranker_filtered", len(hit_tasks) - len(indices), app=app, depth=depth + 1)
                         if len(indices) != len(hit_tasks):
                             print(f"Reranker filtered tasks: {[hit_tasks[i] for i in range(len(hit_tasks)) if i not in indices]}")
                     action_nodes = [(a, n) for a, n, kw, t in action_node_keyword_tasks]
                     keywords = [kw for a, n, kw, t in action_node_keyword_tasks]
+                    hit_descriptions = [t.description for a, n, kw, t in action_node_keyword_tasks]
             end_time = time.time()
-            self.embedding_counter += end_time - start_time
+            self.observe_step("embedding", end_time - start_time, app)
 
             if node.split_pin and not self.generate_only and not tracking_shortcut:
                 # start tracking possible shortcut
                 print("Start tracking shortcut")
                 tracking_shortcut = True
-                possible_shortcuts = [sc for sc in self.shortcuts if sc.split_node is node]
+                possible_shortcuts = self.get_shortcuts(node)
                 cur_step = 0
 
             # check if the action needs to be generated by model, or we can use cached action
-            needs_generation = len(action_nodes) == 0 or self.generate_only
-
-            start_time = time.time()
-            agent_input = self.env.get_agent_input(history, task_description)
-            end_time = time.time()
-            self.env_counter += end_time - start_time
+            needs_generation = len(action_nodes) == 0 or self.generate_only or diverged
+            if self.generate_only:
+                miss_reason = "generate_only"
+            elif diverged:
+                miss_reason = "diverged"
+            else:
+                miss_reason = "no_candidate"
 
             screenshot = agent_input.get("image", None)
             # if UI changed, we need to generate the action
             if not needs_generation:
+                if hit_descriptions is None:
+                    hit_descriptions = [task_description] * len(action_nodes)
                 if self.enable_ui_detection:
                     start_time = time.time()
                     for i, (a, n) in enumerate(action_nodes):
-                        if not self.target_elem_changed(screenshot, a):
+                        if not self.target_elem_changed(screenshot, a, app):
                             action = a
                             next_node = n
+                            hit_description = hit_descriptions[i]
                             if self.mode == MatchMode.FUZZY:
                                 keyword = keywords[i]
                             break
@@ -480,37 +1145,75 @@ class ActionTree:
                     else:
                         print("warning: target element changed")
                         needs_generation = True
+                        miss_reason = "ui_changed"
 
                     end_time = time.time()
-                    self.detection_counter += end_time - start_time
+                    self.observe_step("detection", end_time - start_time, app)
                 else:
                     action, next_node = action_nodes[0]
+                    hit_description = hit_descriptions[0]
                     if self.mode == MatchMode.FUZZY:
                         keyword = keywords[0]
 
-            if needs_generation:
+            # done actions are not executed, nothing to overlap verification with
+            if not needs_generation and self.speculative and not self.done(action):
+                verified_action = yield from self._execute_speculative(env, history, task_description, action, app)
+                if verified_action is None:
+                    executed = True
+                    decision = "agree"
+                elif (yield ("env", env.rollback, (action,))):
+                    print(f"Speculative action rejected, rolled back: {action} -> {verified_action}")
+                    needs_generation = True
+                    miss_reason = "rejected"
+                    decision = "rollback"
+                else:
+                    print(f"Speculative action rejected, cannot roll back: {action}")
+                    executed = True
+                    diverged = True
+                    rejected = True
+                    miss_reason = "rejected"
+                    decision = "diverged"
+                self.telemetry.inc("speculation", app=app, decision=decision)
+
+            self.telemetry.inc("lookups", app=app, depth=depth + 1, result="miss" if needs_generation or rejected else "hit")
+            if needs_generation or rejected:
                 print("Cache miss")
-                start_time = time.time()
-                agent_output = self.agent.generate(agent_input)
-                end_time = time.time()
-                self.inference_counter += end_time - start_time
-                action = self.action_class(**agent_output)
+                self.telemetry.inc("misses", app=app, depth=depth + 1, reason=miss_reason)
+            if needs_generation:
+                if verified_action is None:
+                    start_time = time.time()
+                    agent_output = yield ("agent", agent_input)
+                    end_time = time.time()
+                    self.observe_step("inference", end_time - start_time, app)
+                    action = self.action_class(**agent_output)
+                else:
+                    action = verified_action
                 # extract target element and store it in action
                 if self.enable_ui_detection:
                     start_time = time.time()
-                    action.extract_target_elem(screenshot, self.omniparser)
+                    if self.omniparser is None:
+                        action.extract_target_elem(screenshot, None)
+                    else:
+                        with self.omniparser_lock:
+                            action.extract_target_elem(screenshot, self.omniparser)
                     end_time = time.time()
-                    self.detection_counter += end_time - start_time
+                    self.observe_step("detection", end_time - start_time, app)
                 if self.mode == MatchMode.EXACT:
-                    next_node = node.add_child(action, task)
+                    next_node = self._add_child(node, action, task)
                 else:
-                    next_node = node.add_child(action, task, step_embedding)
+                    next_node = self._add_child(node, action, task, step_embedding)
             else:
-                print("Cache hit")
-                edge = next_node.get_incoming_edge()
-                # only add similar task to the edge
-                if self.mode == MatchMode.FUZZY and task not in edge.tasks:
-                    edge.add_task(task, step_embedding, keyword)
+                if not rejected:
+                    print("Cache hit")
+                    node.record_hit(next_node, hit_description)
+                # only add similar task to the edge, a rejected action was
+                # executed all the same, the task's trace goes through it
+                if self.mode == MatchMode.FUZZY:
+                    with node.lock:
+                        # next_node may have been cut off by remove_task_trace
+                        # of another thread since the lookup
+                        if node.has_child(next_node):
+                            node.add_task_if_absent(next_node.get_incoming_edge(), task, step_embedding, keyword)
 
             if tracking_shortcut:
                 new_possible_shortcuts = []
@@ -524,6 +1227,7 @@ class ActionTree:
                         if needs_generation:
                             last_action = sc.template.last_action
                             shortcut_action = last_action
+                            self.telemetry.inc("shortcut_activations", app=app)
                         break
                     if check_result == ShortCutCheckResult.MATCH_INTERMEDIATE:
                         new_possible_shortcuts.append(sc)
@@ -538,20 +1242,30 @@ class ActionTree:
                 break
             history.append(action)
 
-            start_time = time.time()
-            self.env.execute(action)
-            end_time = time.time()
-            self.env_counter += end_time - start_time
+            if not executed:
+                start_time = time.time()
+                yield ("env", env.execute, (action,))
+                end_time = time.time()
+                self.observe_step("env", end_time - start_time, app)
 
             node = next_node
 
+        if self.mode == MatchMode.FUZZY:
+            step_embeddings.close()
+        self.telemetry.inc("tasks", app=app)
+
         # periodically generate shortcuts
         if not self.generate_only:
             period = 1
             num_tasks = self.get_num_tasks()
-            if num_tasks - self.num_tasks_last_check >= period:
-                self.num_tasks_last_check = num_tasks
-                self.generate_shortcuts()
+            with self.shortcut_lock:
+                needs_update = num_tasks - self.num_tasks_last_check >= period
+                if needs_update:
+                    self.num_tasks_last_check = num_tasks
+            if needs_update:
+                self.update_shortcuts()
                 print(f"number of shortcuts: {len(self.shortcuts)}")
                 for sc in self.shortcuts:
                     print(f"split_node: {sc.split_node}, template: {sc.template.action_names}, last_action: {sc.template.last_action}, supernode size: {len(sc.supernode.nodes)}")
+
+        self.enforce_memory_budget()
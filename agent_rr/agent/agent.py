@@ -1,7 +1,11 @@
 from enum import Enum
 import json
+import openai
 from openai import OpenAI
 import io, base64
+import asyncio, random, threading, time
+import httpx
+from action_cache.telemetry import Telemetry
 
 class Agent:
     def __init__(self):
@@ -10,11 +14,61 @@ class Agent:
     def generate(self, agent_input):
         pass
 
+    async def agenerate(self, agent_input):
+        # used by ActionTree.aexecute, agents without real async io block the
+        # event loop for the duration of generate
+        return self.generate(agent_input)
+
 
 class ReplayLevel(Enum):
     ALL = 1
     REASONING = 2
 
+GROUNDER_QUERY_FMT = '''
+Based on the screenshot, user's intent and the description of the target UI element, provide the bounding box of the element using **absolute coordinates**.
+User's intent: {reasoning}
+Target element's description: {description}
+Your output should be a JSON object with the following format:
+{{"bbox": [x1, y1, x2, y2]}}'''
+
+def encode_image(image):
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG")
+    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+
+def image_payload(agent_input):
+    # environments that pass the Frame of the image let every request of
+    # the step share its encoding
+    frame = agent_input.get("frame", None)
+    if frame is not None:
+        return frame.base64()
+    return encode_image(agent_input["image"])
+
+def build_messages(base64_image, query):
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "image_url","image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
+                {"type": "text", "text": query},
+            ],
+        }
+    ]
+
+def parse_decider_response(decider_response, action_dict):
+    # fills action_dict, returns the grounder query or None if the action
+    # needs no grounding
+    decider_json = json.loads(decider_response)
+    reasoning = decider_json["reasoning"]
+    action = decider_json["action"]
+    param = decider_json["parameters"]
+    action_dict["name"] = action
+    action_dict["parameters"] = param
+    action_dict["extra"] = {"reasoning": reasoning, "decider_raw_output": decider_response}
+    if action in ["click", "longclick"]:
+        return GROUNDER_QUERY_FMT.format(reasoning=reasoning, description=param["target_element"])
+    return None
+
 class RemoteMultiLevelGeneralAgent(Agent):
     def __init__(self, decider_url, grounder_url):
         super().__init__()
@@ -27,44 +81,18 @@ class RemoteMultiLevelGeneralAgent(Agent):
         else:
             replay_level = ReplayLevel.ALL
         
-        image = agent_input["image"]
-        buffered = io.BytesIO()
-        image.save(buffered, format="JPEG")
-        base64_image = base64.b64encode(buffered.getvalue()).decode('utf-8')
+        base64_image = image_payload(agent_input)
         query = agent_input["query"]
 
         action_dict = {}
         if replay_level == ReplayLevel.ALL:
             response = self.decider_client.chat.completions.create(
                 model="",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "image_url","image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
-                            {"type": "text", "text": query},
-                        ],
-                    }
-                ],
+                messages=build_messages(base64_image, query),
                 temperature=0
             )
-            decider_response = response.choices[0].message.content
-            decider_json = json.loads(decider_response)
-            reasoning = decider_json["reasoning"]
-            action = decider_json["action"]
-            param = decider_json["parameters"]
-            action_dict["name"] = action
-            action_dict["parameters"] = param
-            action_dict["extra"] = {"reasoning": reasoning, "decider_raw_output": decider_response}
-            if action in ["click", "longclick"]:
-                target_element = param["target_element"]
-                query = '''
-Based on the screenshot, user's intent and the description of the target UI element, provide the bounding box of the element using **absolute coordinates**.
-User's intent: {reasoning}
-Target element's description: {description}
-Your output should be a JSON object with the following format:
-{{"bbox": [x1, y1, x2, y2]}}'''.format(reasoning=reasoning, description=target_element)
-            else:
+            query = parse_decider_response(response.choices[0].message.content, action_dict)
+            if query is None:
                 return action_dict
         
         # do grounding
@@ -72,18 +100,137 @@ Your output should be a JSON object with the following format:
         # case 2: replaying cached reasoning
         grounder_response = self.grounder_client.chat.completions.create(
             model="",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "image_url","image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
-                        {"type": "text", "text": query},
-                    ],
-                }
-            ],
+            messages=build_messages(base64_image, query),
             temperature=0
         )
         grounder_response = grounder_response.choices[0].message.content
         grounder_json = json.loads(grounder_response)
         action_dict["parameters"]["bbox"] = grounder_json["bbox"]
         return action_dict
+
+# errors worth another attempt, anything else (e.g. a 400) fails right away
+RETRYABLE_ERRORS = (openai.APIConnectionError, openai.APITimeoutError, openai.RateLimitError, openai.InternalServerError)
+
+class AsyncRemoteMultiLevelGeneralAgent(Agent):
+    # same protocol as RemoteMultiLevelGeneralAgent on asyncio: one pooled
+    # http client per endpoint shared by all callers, at most
+    # max_concurrency requests in flight per endpoint, per-request timeout
+    # and retries with exponential backoff and full jitter.
+    # agenerate is the coroutine, e.g. for ActionTree.aexecute driving many
+    # devices on one event loop; generate runs it on the agent's own event
+    # loop thread, so that many executor threads share the pool. clients
+    # and semaphores belong to the loop they were created on, so every loop
+    # that runs agenerate gets its own set (and its own max_concurrency),
+    # created on first use; aclose releases the set of the running loop
+    def __init__(self, decider_url, grounder_url, max_concurrency=16, timeout=60.0, max_retries=3,
+                 backoff_base=0.5, backoff_max=8.0, telemetry=None):
+        super().__init__()
+        self.urls = {"decider": decider_url, "grounder": grounder_url}
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # per-call latency in agent_call_seconds{endpoint, outcome}, retries
+        # in agent_retries{endpoint}
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
+        # event loop -> (clients, semaphores) by endpoint
+        self.loop_states = {}
+        self.state_lock = threading.Lock()
+        self.loop = None
+        self.loop_thread = None
+        self.loop_lock = threading.Lock()
+
+    def _get_state(self):
+        loop = asyncio.get_running_loop()
+        with self.state_lock:
+            if loop not in self.loop_states:
+                clients, semaphores = {}, {}
+                for endpoint, url in self.urls.items():
+                    http_client = openai.DefaultAsyncHttpxClient(
+                        limits=httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency))
+                    # retries are ours, so that they are jittered and counted
+                    clients[endpoint] = openai.AsyncOpenAI(api_key="0", base_url=url, timeout=self.timeout, max_retries=0,
+                                                           http_client=http_client)
+                    semaphores[endpoint] = asyncio.Semaphore(self.max_concurrency)
+                self.loop_states[loop] = (clients, semaphores)
+            return self.loop_states[loop]
+
+    async def _complete(self, endpoint, base64_image, query):
+        clients, semaphores = self._get_state()
+        client = clients[endpoint]
+        for attempt in range(self.max_retries + 1):
+            async with semaphores[endpoint]:
+                start_time = time.time()
+                try:
+                    response = await client.chat.completions.create(
+                        model="",
+                        messages=build_messages(base64_image, query),
+                        temperature=0
+                    )
+                except RETRYABLE_ERRORS as e:
+                    self.telemetry.observe("agent_call_seconds", time.time() - start_time, endpoint=endpoint, outcome="retryable_error")
+                    if attempt == self.max_retries:
+                        raise
+                    error = e
+                except Exception:
+                    self.telemetry.observe("agent_call_seconds", time.time() - start_time, endpoint=endpoint, outcome="error")
+                    raise
+                else:
+                    self.telemetry.observe("agent_call_seconds", time.time() - start_time, endpoint=endpoint, outcome="ok")
+                    return response.choices[0].message.content
+            # outside the semaphore, a backing off call does not hold a slot
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+            print(f"{endpoint} call failed ({error!r}), retrying in {delay:.2f}s")
+            self.telemetry.inc("agent_retries", endpoint=endpoint)
+            await asyncio.sleep(delay)
+
+    async def agenerate(self, agent_input):
+        replay_level = agent_input.get("replay_level", ReplayLevel.ALL)
+        base64_image = image_payload(agent_input)
+        query = agent_input["query"]
+
+        action_dict = {}
+        if replay_level == ReplayLevel.ALL:
+            # the grounder query depends on the decider's reasoning, the two
+            # calls of one step stay sequential
+            decider_response = await self._complete("decider", base64_image, query)
+            query = parse_decider_response(decider_response, action_dict)
+            if query is None:
+                return action_dict
+
+        grounder_response = await self._complete("grounder", base64_image, query)
+        grounder_json = json.loads(grounder_response)
+        action_dict["parameters"]["bbox"] = grounder_json["bbox"]
+        return action_dict
+
+    def _get_loop(self):
+        with self.loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.loop_thread = threading.Thread(target=self.loop.run_forever, name="agent-event-loop", daemon=True)
+                self.loop_thread.start()
+            return self.loop
+
+    def generate(self, agent_input):
+        # blocking, callable from any thread except the loop's own
+        return asyncio.run_coroutine_threadsafe(self.agenerate(agent_input), self._get_loop()).result()
+
+    async def aclose(self):
+        # closes the clients of the running loop, call before it ends
+        with self.state_lock:
+            state = self.loop_states.pop(asyncio.get_running_loop(), None)
+        if state is not None:
+            for client in state[0].values():
+                await client.close()
+
+    def close(self):
+        # stops the agent's own loop, see aclose for the loops of callers
+        with self.loop_lock:
+            if self.loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self.aclose(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
+            self.loop.close()
+            self.loop = None
@@ -5,6 +5,7 @@ import requests
 import time
 
 from .agent import ReplayLevel
+from .frame import Frame
 
 class Environment:
     def __init__(self):
@@ -14,11 +15,23 @@ class Environment:
         pass
 
     def get_agent_input_speculative(self, history, task_description, draft_action):
+        # agent input for verifying draft_action against the current
+        # (pre-action) state while draft_action is being executed, so it
+        # must not change the state itself
         pass
 
     def execute(self, action):
         pass
 
+    def rollback(self, action):
+        # undo an action executed speculatively, returns whether it was undone
+        return False
+
+    def check_health(self):
+        # whether the device behind the environment can take tasks, see
+        # agent/pool.py
+        return True
+
 
 def request_screenshot(url):
     body = {"action": "screenshot", "param": {}}
@@ -30,6 +43,14 @@ def request_screenshot(url):
     else:
         return None
 
+def request_frame(url, factor=1.0, resample=Image.LANCZOS, draft=False):
+    body = {"action": "screenshot", "param": {}}
+    response = requests.post(url, json=body)
+    if response.status_code == 200:
+        return Frame.decode(response.json()['data']['image'], factor, resample, draft)
+    else:
+        return None
+
 class MultiLevelGeneralEnvironment(Environment):
     def __init__(self, agent, replay_level=ReplayLevel.ALL):
         super().__init__()
@@ -60,7 +81,13 @@ Your output should be a JSON object with the following format:
         pass
 
     def get_agent_input(self, history, task_description):
-        image = self.get_screenshot()
+        return self._build_agent_input(self.get_screenshot(), history, task_description)
+
+    def get_agent_input_speculative(self, history, task_description, draft_action):
+        # the model derives the action on its own and is not shown the draft
+        return self.get_agent_input(history, task_description)
+
+    def _build_agent_input(self, image, history, task_description):
         if len(history) == 0:
             history_str = "(No history)"
         else:
@@ -72,22 +99,41 @@ Your output should be a JSON object with the following format:
         pass
 
 class RemoteMultiLevelGeneralEnvironment(MultiLevelGeneralEnvironment):
-    def __init__(self, agent, replay_level=ReplayLevel.ALL, url="http://localhost:8766/adb"):
+    def __init__(self, agent, replay_level=ReplayLevel.ALL, url="http://localhost:8766/adb", resample=Image.LANCZOS, draft=False):
         super().__init__(agent, replay_level)
         self.url = url
-        self.last_screenshot = None
+        self.last_frame = None
         self.factor = 0.5
+        # filter of the downscale to factor, e.g. Image.BILINEAR is cheaper;
+        # draft: jpeg decoder downscaling, see Frame.decode
+        self.resample = resample
+        self.draft = draft
+
+    @property
+    def last_screenshot(self):
+        return self.last_frame.image if self.last_frame is not None else None
 
     def get_screenshot(self):
-        image = request_screenshot(self.url)
-
-        if image is not None:
-            width, height = image.size
-            new_width = int(width * self.factor)
-            new_height = int(height * self.factor)
-            image = image.resize((new_width, new_height), Image.LANCZOS)
-        self.last_screenshot = image
-        return image
+        self.last_frame = request_frame(self.url, self.factor, self.resample, self.draft)
+        return self.last_screenshot
+
+    def check_health(self, timeout=5):
+        body = {"action": "screenshot", "param": {}}
+        response = requests.post(self.url, json=body, timeout=timeout)
+        return response.status_code == 200
+
+    def _build_agent_input(self, image, history, task_description):
+        agent_input = super()._build_agent_input(image, history, task_description)
+        if self.last_frame is not None and image is self.last_frame.image:
+            agent_input["frame"] = self.last_frame
+        return agent_input
+
+    def get_agent_input_speculative(self, history, task_description, draft_action):
+        # last_screenshot was taken by get_agent_input of this step, before
+        # draft_action, no need for another round trip
+        if self.last_screenshot is None:
+            return super().get_agent_input_speculative(history, task_description, draft_action)
+        return self._build_agent_input(self.last_screenshot, history, task_description)
     
     def execute(self, action):
         name = action.name
@@ -98,6 +144,7 @@ class RemoteMultiLevelGeneralEnvironment(MultiLevelGeneralEnvironment):
             )
             agent_input = {
                 "image": self.last_screenshot,
+                "frame": self.last_frame,
                 "query": query,
                 "replay_level": self.replay_level
             }
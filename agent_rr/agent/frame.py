@@ -0,0 +1,49 @@
+from PIL import Image
+import base64
+import io
+import threading
+
+class Frame:
+    # one screenshot at the scale the agent sees it: decoded pixels for the
+    # action cache and the base64 jpeg payload for the model, each computed
+    # once however many requests (decider, grounder, verification) use it
+    def __init__(self, image, encoded=None):
+        self.image = image
+        self._encoded = encoded
+        self.lock = threading.Lock()
+
+    @classmethod
+    def decode(cls, encoded_image, factor=1.0, resample=Image.LANCZOS, draft=False):
+        # encoded_image: base64 png/jpeg as sent by the device server.
+        # draft: let the jpeg decoder downscale first, much faster but the
+        # pixels differ from a plain resample of the full image
+        image = Image.open(io.BytesIO(base64.b64decode(encoded_image)))
+        source_format = image.format
+        size = (int(image.width * factor), int(image.height * factor))
+        if draft and size != image.size:
+            # jpeg only: the decoder scales down by a power of two for free,
+            # the resize below only covers what is left
+            image.draft("RGB", size)
+        image = image.convert("RGB")
+        if image.size != size:
+            n = image.width / size[0]
+            if resample == Image.BOX and n == int(n) and image.height // int(n) == size[1]:
+                # same box filter, without the generic resampling kernel
+                image = image.reduce(int(n))
+            else:
+                image = image.resize(size, resample)
+        # an unscaled jpeg can be sent as it came
+        encoded = encoded_image if source_format == "JPEG" and factor == 1.0 else None
+        return cls(image, encoded)
+
+    @property
+    def size(self):
+        return self.image.size
+
+    def base64(self):
+        with self.lock:
+            if self._encoded is None:
+                buffered = io.BytesIO()
+                self.image.save(buffered, format="JPEG")
+                self._encoded = base64.b64encode(buffered.getvalue()).decode('utf-8')
+            return self._encoded
@@ -0,0 +1,210 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+
+# seconds between health checks of the devices, and how often a task is
+# retried on another device after its device failed
+HEALTH_INTERVAL = 30.0
+MAX_TASK_ATTEMPTS = 3
+
+class Device:
+    def __init__(self, name, env, agent=None):
+        self.name = name
+        self.env = env
+        self.agent = agent
+        self.healthy = True
+        self.busy = False
+        # app of the last task, the device is likely still in it
+        self.last_app = None
+        self.busy_seconds = 0.0
+        self.num_tasks = 0
+        self.num_failures = 0
+        self.num_app_switches = 0
+
+class DevicePool:
+    # devices (one env each, e.g. RemoteMultiLevelGeneralEnvironment per
+    # adb bridge url) with a background health check; unhealthy devices get
+    # no tasks until a check passes again
+    def __init__(self, devices, health_interval=HEALTH_INTERVAL):
+        self.devices = devices
+        self.health_interval = health_interval
+        self.condition = threading.Condition()
+        self.start_time = time.time()
+        self.stopped = threading.Event()
+        self.health_thread = None
+
+    def check(self, device):
+        try:
+            healthy = bool(device.env.check_health())
+        except Exception as e:
+            print(f"health check of {device.name} failed: {e!r}")
+            healthy = False
+        with self.condition:
+            if healthy and not device.healthy:
+                print(f"device {device.name} is back")
+            device.healthy = healthy
+            self.condition.notify_all()
+        return healthy
+
+    def _health_loop(self):
+        while not self.stopped.wait(self.health_interval):
+            for device in self.devices:
+                # a busy device proves itself by finishing its task
+                if not device.busy:
+                    self.check(device)
+
+    def start(self):
+        self.start_time = time.time()
+        for device in self.devices:
+            self.check(device)
+        self.stopped.clear()
+        self.health_thread = threading.Thread(target=self._health_loop, name="device-health", daemon=True)
+        self.health_thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.health_thread is not None:
+            self.health_thread.join()
+            self.health_thread = None
+
+    def utilization(self):
+        elapsed = max(1e-9, time.time() - self.start_time)
+        return {d.name: {
+            "healthy": d.healthy,
+            "utilization": d.busy_seconds / elapsed,
+            "tasks": d.num_tasks,
+            "failures": d.num_failures,
+            "app_switches": d.num_app_switches,
+        } for d in self.devices}
+
+    def print_utilization(self):
+        for name, stats in self.utilization().items():
+            print(f"device {name}: utilization {stats['utilization']:.1%}, {stats['tasks']} tasks, "
+                  f"{stats['failures']} failures, {stats['app_switches']} app switches, healthy {stats['healthy']}")
+
+class TaskScheduler:
+    # spreads (app, task) pairs over the devices of a pool, one worker
+    # thread per device; a device keeps taking tasks of its last app while
+    # there are any (app affinity), then moves to the app with the most
+    # tasks left. run_fn(device, app, task) runs one task; if it raises and
+    # the device fails its health check, the task goes back to the queue
+    # for another device
+    def __init__(self, pool, run_fn, max_task_attempts=MAX_TASK_ATTEMPTS):
+        self.pool = pool
+        self.run_fn = run_fn
+        self.max_task_attempts = max_task_attempts
+
+    def _next_task(self, device):
+        # caller holds pool.condition
+        if device.last_app in self.queues and self.queues[device.last_app]:
+            app = device.last_app
+        else:
+            app = max(self.queues, key=lambda a: len(self.queues[a]))
+            if not self.queues[app]:
+                return None
+        task, attempts = self.queues[app].popleft()
+        return app, task, attempts
+
+    def _fail_pending(self, error):
+        # caller holds pool.condition
+        for app, tasks in self.queues.items():
+            self.errors.extend((app, task, error) for task, _ in tasks)
+            tasks.clear()
+        self.num_pending = 0
+
+    def _worker(self, device):
+        condition = self.pool.condition
+        while True:
+            with condition:
+                while True:
+                    if self.num_pending == 0:
+                        return
+                    if device.healthy:
+                        item = self._next_task(device)
+                        if item is not None:
+                            break
+                    elif self.num_running == 0 and self.pool.health_thread is None and not any(d.healthy for d in self.pool.devices):
+                        # nothing left that could bring a device back
+                        self._fail_pending(RuntimeError("no healthy device"))
+                        condition.notify_all()
+                        return
+                    condition.wait()
+                app, task, attempts = item
+                device.busy = True
+                self.num_running += 1
+                if device.last_app is not None and device.last_app != app:
+                    device.num_app_switches += 1
+                device.last_app = app
+            start_time = time.time()
+            error = None
+            try:
+                self.run_fn(device, app, task)
+            except Exception as e:
+                error = e
+            busy_seconds = time.time() - start_time
+            device_failed = error is not None and not self.pool.check(device)
+            with condition:
+                device.busy = False
+                device.busy_seconds += busy_seconds
+                self.num_running -= 1
+                if device_failed:
+                    device.num_failures += 1
+                    print(f"device {device.name} failed on task {task}: {error!r}")
+                    if attempts + 1 < self.max_task_attempts:
+                        # front of the queue, it already waited its turn
+                        self.queues[app].appendleft((task, attempts + 1))
+                    else:
+                        self.errors.append((app, task, error))
+                        self.num_pending -= 1
+                else:
+                    device.num_tasks += 1
+                    if error is not None:
+                        self.errors.append((app, task, error))
+                    self.num_pending -= 1
+                condition.notify_all()
+
+    def run(self, app_tasks):
+        # app_tasks: (app, task) pairs, tasks of one app keep their order;
+        # returns the (app, task, exception) of every failed task
+        self.queues = OrderedDict()
+        for app, task in app_tasks:
+            self.queues.setdefault(app, deque()).append((task, 0))
+        self.num_pending = sum(len(q) for q in self.queues.values())
+        self.num_running = 0
+        self.errors = []
+        if self.num_pending == 0:
+            return self.errors
+        threads = [threading.Thread(target=self._worker, args=(device,), name=f"device-{device.name}") for device in self.pool.devices]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return self.errors
+
+async def run_device_tasks(devices, app_tasks, run_fn):
+    # asyncio counterpart of TaskScheduler.run, without health checks and
+    # app affinity: one coroutine per device on the running loop takes the
+    # next (app, task) pair whenever it is free. run_fn(device, app, task)
+    # is a coroutine (e.g. around ActionTree.aexecute); returns the
+    # (app, task, exception) of every failed task
+    queue = deque(app_tasks)
+    errors = []
+
+    async def _worker(device):
+        while queue:
+            app, task = queue.popleft()
+            device.busy = True
+            start_time = time.time()
+            try:
+                await run_fn(device, app, task)
+            except Exception as e:
+                errors.append((app, task, e))
+                device.num_failures += 1
+            else:
+                device.num_tasks += 1
+            device.busy = False
+            device.busy_seconds += time.time() - start_time
+
+    await asyncio.gather(*(_worker(device) for device in devices))
+    return errors
@@ -0,0 +1,116 @@
+import argparse, json, random, time
+import torch
+from run_experiment import MybenchTasks, _percentile
+from action_cache.embedder import Qwen3Embedder
+from action_cache.reranker import Qwen3Reranker
+from action_cache.tree import EMBEDDER_THRESHOLD, RERANKER_MIN_CONF
+
+# latency and score drift of a cpu backend (see action_cache/backend.py)
+# against the fp32 models, on task descriptions of the benchmark data
+
+def _latency(times, num_items):
+    return {
+        "per_item_mean": sum(times) / max(1, num_items),
+        "per_batch_p50": _percentile(times, 0.5),
+        "per_batch_p95": _percentile(times, 0.95),
+    }
+
+def _timed_batches(fn, model, items, batch_size):
+    # fn(model, batch); the model is passed in so that the caller can drop
+    # its last reference before loading the next one
+    outputs, times = [], []
+    for start in range(0, len(items), batch_size):
+        start_time = time.time()
+        outputs.append(fn(model, items[start:start + batch_size]))
+        times.append(time.time() - start_time)
+    return outputs, times
+
+def compare_embedders(tasks, steps, reference_config, config, batch_size):
+    items = [(task, step) for step in steps for task in tasks]
+    results = {}
+    embeddings = {}
+    for name, c in (("fp32", reference_config), ("test", config)):
+        embedder = Qwen3Embedder(c)
+        outputs, times = _timed_batches(lambda model, batch: model.embed([t for t, _ in batch], [s for _, s in batch]).float().cpu(), embedder, items, batch_size)
+        embeddings[name] = torch.cat(outputs)
+        results[name] = _latency(times, len(items))
+        del embedder
+    reference, test = embeddings["fp32"], embeddings["test"]
+    # similarities within each step, these are what the tree thresholds
+    agree, top1, max_drift, drifts = 0, 0, 0.0, []
+    for i in range(len(steps)):
+        rows = slice(i * len(tasks), (i + 1) * len(tasks))
+        s_ref = reference[rows] @ reference[rows].T
+        s_test = test[rows] @ test[rows].T
+        s_ref.fill_diagonal_(-1)
+        s_test.fill_diagonal_(-1)
+        drift = (s_ref - s_test).abs()
+        max_drift = max(max_drift, drift.max().item())
+        drifts.append(drift.mean().item())
+        agree += ((s_ref >= EMBEDDER_THRESHOLD) == (s_test >= EMBEDDER_THRESHOLD)).float().mean().item()
+        top1 += (s_ref.argmax(dim=1) == s_test.argmax(dim=1)).float().mean().item()
+    results["drift"] = {
+        "embedding_cosine_min": torch.nn.functional.cosine_similarity(reference, test).min().item(),
+        "similarity_abs_diff_mean": sum(drifts) / len(drifts),
+        "similarity_abs_diff_max": max_drift,
+        "threshold_agreement": agree / len(steps),
+        "top1_agreement": top1 / len(steps),
+    }
+    return results
+
+def compare_rerankers(pairs, step, reference_config, config, batch_size):
+    results = {}
+    scores = {}
+    for name, c in (("fp32", reference_config), ("test", config)):
+        reranker = Qwen3Reranker(c)
+        # one document with several queries per call, like ActionTree.execute
+        outputs, times = _timed_batches(lambda model, batch: model.rerank([q for q, _ in batch], batch[0][1], step), reranker, pairs, batch_size)
+        scores[name] = [score for output in outputs for score in output]
+        results[name] = _latency(times, len(pairs))
+        del reranker
+    reference, test = torch.tensor(scores["fp32"]), torch.tensor(scores["test"])
+    drift = (reference - test).abs()
+    results["drift"] = {
+        "score_abs_diff_mean": drift.mean().item(),
+        "score_abs_diff_max": drift.max().item(),
+        "threshold_agreement": ((reference >= RERANKER_MIN_CONF) == (test >= RERANKER_MIN_CONF)).float().mean().item(),
+    }
+    return results
+
+def main(args):
+    random.seed(args.seed)
+    tasks = [task for tts in MybenchTasks(args.data_path).get_app_task_trajectories().values() for task, _ in tts]
+    tasks = sorted(set(tasks))
+    random.shuffle(tasks)
+    tasks = tasks[:args.num_tasks]
+    options = {"backend": args.backend, "num_threads": args.num_threads, "batch_size": args.batch_size}
+    report = {"args": vars(args), "num_tasks": len(tasks)}
+    # caches off, every call is a forward pass
+    embedder_config = {"path": args.embedder_path, "cache_size": 0}
+    report["embedder"] = compare_embedders(tasks, args.steps, embedder_config, dict(embedder_config, **options), args.batch_size)
+    print(json.dumps(report["embedder"], indent=2))
+    if args.reranker_path is not None:
+        reranker_config = {"path": args.reranker_path, "score_cache_size": 0}
+        # every document against a few other tasks, grouped by document
+        pairs = [(q, d) for d in tasks for q in random.sample(tasks, min(len(tasks), args.queries_per_document))]
+        report["reranker"] = compare_rerankers(pairs, 1, reranker_config, dict(reranker_config, **options), args.queries_per_document)
+        print(json.dumps(report["reranker"], indent=2))
+    with open(args.report, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--embedder_path', type=str, required=True)
+    parser.add_argument('--reranker_path', type=str, default=None)
+    parser.add_argument('--data_path', type=str, required=True)
+    parser.add_argument('--backend', choices=['torch', 'int8'], default='int8',
+                        help="Backend compared against the fp32 models.")
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_tasks', type=int, default=200)
+    parser.add_argument('--steps', nargs='+', type=int, default=[1, 2, 3])
+    parser.add_argument('--queries_per_document', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--report', type=str, default="backend_report.json")
+    args = parser.parse_args()
+    main(args)
@@ -1,16 +1,20 @@
 from train.task_template import get_app_task_trajectories
 from agent.agent import Agent
 from agent.env import Environment
-import os, random, math
+from agent.pool import Device, DevicePool, TaskScheduler, run_device_tasks
+import os, random, math, time, json, itertools, contextlib, asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from action_cache.action import Action
-from action_cache.tree import ActionTree, Task, MatchMode
+from action_cache.tree import ActionTree, Task, MatchMode, EMBEDDER_THRESHOLD, RERANKER_MIN_CONF, ANN_THRESHOLD, ANN_NPROBE
 
 class MybenchTasks:
-    def __init__(self, data_path):
+    # sample_size: at most that many tasks per template, sampled with seed
+    def __init__(self, data_path, sample_size=None, seed=0):
         self.app_task_trajectories = {}
         for root, _, files in os.walk(data_path):
             if 'templates.json' in files:
-                domain_app_task_trajectories = get_app_task_trajectories(root)
+                domain_app_task_trajectories = get_app_task_trajectories(root, sample_size, seed)
                 for app, tasks in domain_app_task_trajectories.items():
                     if app not in self.app_task_trajectories:
                         self.app_task_trajectories[app] = []
@@ -90,8 +94,12 @@ class MybenchEnvironment(Environment):
         self.cur_task = task_description
         return {"task": task_description, "history": history}
 
+    def get_agent_input_speculative(self, history, task_description, draft_action):
+        return {"task": task_description, "history": history}
+
     def execute(self, action):
         print(f"env executing: {action}")
+        self.last_state = (self.cur_execute_cnt, self.cur_success)
         self.cur_execute_cnt += 1
         step = self.agent.task_step[self.cur_task]
         if step >= len(self.agent.task_trajectory[self.cur_task]):
@@ -103,6 +111,11 @@ class MybenchEnvironment(Environment):
             print(f"incorrect: {action} != {ground_truth} in step {step}")
             self.cur_success = False
 
+    def rollback(self, action):
+        print(f"env rolling back: {action}")
+        self.cur_execute_cnt, self.cur_success = self.last_state
+        return True
+
     def check_done(self):
         step = self.agent.task_step[self.cur_task]
         self.cur_execute_cnt += 1
@@ -117,9 +130,233 @@ class MybenchEnvironment(Environment):
             print("incorrect: done mismatch")
         self.agent.reset_cur_task(account=self.cur_success)
 
+def redistribute_tasks(tasks, distribution):
+    tasks = list(tasks)
+    random.shuffle(tasks)
+    if distribution == 'uniform':
+        return tasks
+    elif distribution == 'power_law':
+        num_task20 = math.ceil(0.2 * len(tasks))
+        task20 = tasks[:num_task20]
+        task80 = tasks[num_task20:]
+        redistributed_tasks = task20 * 16 + task80
+        random.shuffle(redistributed_tasks)
+        return redistributed_tasks
+    else:
+        raise ValueError(f"Unknown distribution: {distribution}")
+
+def run_task(tree, env, agent, task, app=None):
+    print(f"Current task: {task}")
+    tree.execute(task, env, agent, app)
+    finish_task(tree, env, agent, task)
+
+async def arun_task(tree, env, agent, task, app=None):
+    # run_task through ActionTree.aexecute
+    print(f"Current task: {task}")
+    await tree.aexecute(task, env, agent, app)
+    finish_task(tree, env, agent, task)
+
+def finish_task(tree, env, agent, task):
+    env.check_done()
+    if not env.cur_success:
+        tree.remove_task_trace(Task(task))
+    agent.task_step[task] = -1
+    env.reset_cur_task()
+    env.total_task_cnt += 1
+
+def run_tasks_parallel(tree, pool, tasks, app=None):
+    # every device of the pool has its own env and agent, all of them share
+    # the tree
+    scheduler = TaskScheduler(pool, lambda device, app, task: run_task(tree, device.env, device.agent, task, app))
+    errors = scheduler.run([(app, task) for task in tasks])
+    pool.print_utilization()
+    check_parallel_run(tree, errors)
+
+def run_tasks_async(tree, pool, tasks, app=None):
+    # as run_tasks_parallel, with every device a coroutine on one event
+    # loop instead of a thread
+    pool.start_time = time.time()
+    errors = asyncio.run(run_device_tasks(pool.devices, [(app, task) for task in tasks],
+                                          lambda device, app, task: arun_task(tree, device.env, device.agent, task, app)))
+    pool.print_utilization()
+    check_parallel_run(tree, errors)
+
+def check_parallel_run(tree, errors):
+    for _, task, e in errors:
+        print(f"worker failed on task {task}: {e!r}")
+    problems = tree.check_consistency()
+    for problem in problems:
+        print(f"inconsistent tree: {problem}")
+    if errors or problems:
+        raise RuntimeError(f"{len(errors)} failed tasks, {len(problems)} tree inconsistencies")
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def run_benchmark_app(app, configs, args):
+    # runs in a worker process: every config on the tasks of one app, the
+    # models are loaded once per match mode and the tree is cleared in between
+    tasks = MybenchTasks(args["data_path"], args["sample_size"], args["sample_seed"])
+    agent = MybenchAgent(tasks)
+    env = MybenchEnvironment(agent)
+    trees = {}
+    ann_configs = {}
+    task_trajectories = tasks.get_app_task_trajectories()[app]
+    results = []
+    for config in configs:
+        result = dict(config, app=app)
+        try:
+            mode = MatchMode[config["mode"].upper()]
+            if mode not in trees:
+                embedder_config, reranker_config = None, None
+                if mode == MatchMode.FUZZY:
+                    # recall of the ann index against the exact search is part of the report
+                    embedder_config = {"path": args["embedder_path"], "ann_nprobe": args["ann_nprobe"], "ann_measure_recall": True}
+                    if args["reranker_path"] is not None:
+                        reranker_config = {"path": args["reranker_path"]}
+                trees[mode] = ActionTree(env, agent, Action, done=lambda a: a.name == 'done', mode=mode,
+                                         embedder_config=embedder_config, reranker_config=reranker_config)
+                ann_configs[mode] = getattr(trees[mode], "ann_config", None)
+            tree = trees[mode]
+            tree.clear()
+            tree.reset_counter()
+            env.reset_cnt()
+            agent.reset_cnt()
+            if mode == MatchMode.FUZZY:
+                tree.embedder_threshold = config["embedder_threshold"]
+                if tree.reranker is not None:
+                    tree.reranker_min_conf = config["reranker_min_conf"]
+                # ann_threshold None: exact search only, the baseline
+                if config["ann_threshold"] is None:
+                    tree.ann_config = None
+                else:
+                    tree.ann_config = dict(ann_configs[mode], threshold=config["ann_threshold"])
+            random.seed(config["seed"])
+            redistributed_tasks = redistribute_tasks([t for t, _ in task_trajectories], config["distribution"])
+            task_times = []
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                for task in redistributed_tasks:
+                    start_time = time.time()
+                    run_task(tree, env, agent, task, app)
+                    task_times.append(time.time() - start_time)
+            lookups = tree.telemetry.counter_sum("lookups")
+            hits = tree.telemetry.counter_sum("lookups", result="hit")
+            # every step would be a model call without the cache, speculative
+            # verification counts as a call
+            model_calls = tree.telemetry.histogram_count("step_seconds", phase="inference")
+            ann_exact_hits = tree.telemetry.counter_sum("ann_exact_hits")
+            ann_recalled_hits = tree.telemetry.counter_sum("ann_recalled_hits")
+            result.update({
+                "num_tasks": env.total_task_cnt,
+                "correct_tasks": env.correct_task_cnt,
+                "accuracy": env.correct_task_cnt / max(1, env.total_task_cnt),
+                "steps": lookups,
+                "hits": hits,
+                "hit_rate": hits / max(1, lookups),
+                "hit_rate_by_depth": {d: h / n for d, (h, n) in tree.hit_rate_by_depth().items()},
+                "model_calls": model_calls,
+                "model_calls_saved": lookups - model_calls,
+                "model_calls_saved_ratio": (lookups - model_calls) / max(1, lookups),
+                "shortcut_activations": tree.telemetry.counter_sum("shortcut_activations"),
+                "ann_exact_hits": ann_exact_hits,
+                "ann_recalled_hits": ann_recalled_hits,
+                # None when no node was large enough for the index
+                "ann_recall": ann_recalled_hits / ann_exact_hits if ann_exact_hits else None,
+                "wall_time": sum(task_times),
+                "time_per_task_mean": sum(task_times) / max(1, len(task_times)),
+                "time_per_task_p50": _percentile(task_times, 0.5),
+                "time_per_task_p95": _percentile(task_times, 0.95),
+            })
+        except Exception as e:
+            result["error"] = repr(e)
+        results.append(result)
+    return results
+
+def summarize_benchmark(results):
+    # totals over apps and seeds for every swept config
+    keys = ["mode", "distribution", "embedder_threshold", "reranker_min_conf", "ann_threshold"]
+    groups = {}
+    for r in results:
+        if "error" in r:
+            continue
+        groups.setdefault(tuple(r[k] for k in keys), []).append(r)
+    summary = []
+    for group_key, rs in groups.items():
+        steps = sum(r["steps"] for r in rs)
+        num_tasks = sum(r["num_tasks"] for r in rs)
+        saved = sum(r["model_calls_saved"] for r in rs)
+        wall_time = sum(r["wall_time"] for r in rs)
+        ann_exact_hits = sum(r["ann_exact_hits"] for r in rs)
+        summary.append(dict(zip(keys, group_key), **{
+            "runs": len(rs),
+            "num_tasks": num_tasks,
+            "accuracy": sum(r["correct_tasks"] for r in rs) / max(1, num_tasks),
+            "hit_rate": sum(r["hits"] for r in rs) / max(1, steps),
+            "model_calls": sum(r["model_calls"] for r in rs),
+            "model_calls_saved": saved,
+            "model_calls_saved_ratio": saved / max(1, steps),
+            "time_per_task_mean": wall_time / max(1, num_tasks),
+            "ann_recall": sum(r["ann_recalled_hits"] for r in rs) / ann_exact_hits if ann_exact_hits else None,
+        }))
+    return summary
+
+def optional_int(value):
+    # argparse type, "none" for None
+    return None if value.lower() == "none" else int(value)
+
+def benchmark(args):
+    # headless: one worker process per app, every app runs the whole sweep
+    configs = []
+    for mode, distribution, seed in itertools.product(args.match_modes, args.distributions, args.seeds):
+        if mode == 'exact':
+            # thresholds only apply to fuzzy matching
+            configs.append({"mode": mode, "distribution": distribution, "seed": seed,
+                            "embedder_threshold": None, "reranker_min_conf": None, "ann_threshold": None})
+            continue
+        for embedder_threshold, reranker_min_conf, ann_threshold in itertools.product(args.embedder_thresholds, args.reranker_min_confs, args.ann_thresholds):
+            configs.append({"mode": mode, "distribution": distribution, "seed": seed,
+                            "embedder_threshold": embedder_threshold, "reranker_min_conf": reranker_min_conf,
+                            "ann_threshold": ann_threshold})
+    apps = list(MybenchTasks(args.data_path, args.sample_size, args.sample_seed).get_app_task_trajectories().keys())
+    worker_args = {"data_path": args.data_path, "embedder_path": args.embedder_path, "reranker_path": args.reranker_path,
+                   "ann_nprobe": args.ann_nprobe, "sample_size": args.sample_size, "sample_seed": args.sample_seed}
+    num_processes = args.num_processes or len(apps)
+    start_time = time.time()
+    results = []
+    # spawn, forked workers cannot use cuda
+    with ProcessPoolExecutor(max_workers=num_processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {app: executor.submit(run_benchmark_app, app, configs, worker_args) for app in apps}
+        for app, future in futures.items():
+            app_results = future.result()
+            results.extend(app_results)
+            print(f"{app}: {len(app_results)} runs done")
+    report = {
+        "args": vars(args),
+        "wall_time": time.time() - start_time,
+        "summary": summarize_benchmark(results),
+        "results": results,
+    }
+    with open(args.report, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    for s in report["summary"]:
+        print(s)
+    failed = [r for r in results if "error" in r]
+    for r in failed:
+        print(f"failed: {r}")
+    return report
+
 def main(args):
-    agent = MybenchAgent(MybenchTasks(args.data_path))
+    tasks = MybenchTasks(args.data_path, args.sample_size, args.sample_seed)
+    agent = MybenchAgent(tasks)
     env = MybenchEnvironment(agent)
+    devices = [Device("0", env, agent)]
+    for i in range(1, args.num_workers):
+        worker_agent = MybenchAgent(tasks)
+        devices.append(Device(str(i), MybenchEnvironment(worker_agent), worker_agent))
+    pool = DevicePool(devices)
     tree = ActionTree(env, agent, Action, done=lambda a: a.name == 'done',
                       mode=MatchMode.FUZZY,
                       embedder_config={
@@ -127,44 +364,88 @@ def main(args):
                       },
                       reranker_config={
                           "path": args.reranker_path
-                      })
+                      },
+                      speculative=args.speculative,
+                      memory_budget=args.memory_budget_mb * 2**20 if args.memory_budget_mb is not None else None)
 
     app_task_trajectories = agent.tasks.get_app_task_trajectories()
     for app, task_trajectories in app_task_trajectories.items():
-        tree.clear()
-        tasks = [t for t, _ in task_trajectories]
-        random.shuffle(tasks)
-        redistributed_tasks = []
-        if args.distribution == 'uniform':
-            redistributed_tasks = tasks
-        elif args.distribution == 'power_law':
-            num_task20 = math.ceil(0.2 * len(tasks))
-            task20 = tasks[:num_task20]
-            task80 = tasks[num_task20:]
-            redistributed_tasks = task20 * 16 + task80
-            random.shuffle(redistributed_tasks)
+        snapshot_path = None
+        if args.snapshot_dir is not None:
+            snapshot_path = os.path.join(args.snapshot_dir, app)
+        if snapshot_path is not None and os.path.exists(os.path.join(snapshot_path, "tree.json")):
+            tree.load(snapshot_path)
+        else:
+            tree.clear()
+        redistributed_tasks = redistribute_tasks([t for t, _ in task_trajectories], args.distribution)
+        if len(devices) == 1:
+            for task in redistributed_tasks:
+                run_task(tree, env, agent, task, app)
+        elif args.async_workers:
+            run_tasks_async(tree, pool, redistributed_tasks, app)
         else:
-            raise ValueError(f"Unknown distribution: {args.distribution}")
-        for task in redistributed_tasks:
-            print(f"Current task: {task}")
-            tree.execute(task)
-            env.check_done()
-            if not env.cur_success:
-                tree.root.remove_task_trace(Task(task))
-            agent.task_step[task] = -1
-            env.reset_cur_task()
-            env.total_task_cnt += 1
+            pool.start()
+            try:
+                run_tasks_parallel(tree, pool, redistributed_tasks, app)
+            finally:
+                pool.stop()
+        if snapshot_path is not None:
+            tree.save(snapshot_path)
+        if args.metrics_dir is not None:
+            os.makedirs(args.metrics_dir, exist_ok=True)
+            tree.write_metrics(os.path.join(args.metrics_dir, "metrics.jsonl"), os.path.join(args.metrics_dir, "metrics.prom"))
         print(f"Current app: {app}")
-        env.print_cnt()
-        agent.print_cnt()
+        for device in devices:
+            device.env.print_cnt()
+            device.agent.print_cnt()
+        tree.print_counter()
         input("Press enter to continue")
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('--embedder_path', type=str, required=True)
-    parser.add_argument('--reranker_path', type=str, required=True)
+    parser.add_argument('--embedder_path', type=str, default=None,
+                        help="Required unless every benchmark mode is exact.")
+    parser.add_argument('--reranker_path', type=str, default=None,
+                        help="Required outside benchmark mode, optional for the fuzzy benchmark.")
     parser.add_argument('--data_path', type=str, required=True)
     parser.add_argument('--distribution', choices=['uniform', 'power_law'], default='uniform')
+    parser.add_argument('--snapshot_dir', type=str, default=None,
+                        help="Load each app's action tree from <snapshot_dir>/<app> if present, and save it back after the app finishes.")
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help="Number of parallel executors (one env/agent pair each) sharing the action tree.")
+    parser.add_argument('--async_workers', action='store_true',
+                        help="Run the executors as coroutines on one event loop (ActionTree.aexecute) instead of one thread each.")
+    parser.add_argument('--speculative', action='store_true',
+                        help="Execute cached actions right away and verify them with the agent in the background.")
+    parser.add_argument('--memory_budget_mb', type=float, default=None,
+                        help="Evict cold crops, leaves and tasks to keep the action tree below this size.")
+    parser.add_argument('--metrics_dir', type=str, default=None,
+                        help="After each app, append the cache metrics to <metrics_dir>/metrics.jsonl and rewrite <metrics_dir>/metrics.prom.")
+    parser.add_argument('--benchmark', action='store_true',
+                        help="Run the sweep below without interaction, one process per app, and write a json report.")
+    parser.add_argument('--report', type=str, default="benchmark_report.json")
+    parser.add_argument('--num_processes', type=int, default=None,
+                        help="Benchmark worker processes, defaults to one per app.")
+    parser.add_argument('--match_modes', nargs='+', choices=['fuzzy', 'exact'], default=['fuzzy'])
+    parser.add_argument('--distributions', nargs='+', choices=['uniform', 'power_law'], default=['uniform', 'power_law'])
+    parser.add_argument('--embedder_thresholds', nargs='+', type=float, default=[EMBEDDER_THRESHOLD])
+    parser.add_argument('--reranker_min_confs', nargs='+', type=float, default=[RERANKER_MIN_CONF])
+    parser.add_argument('--seeds', nargs='+', type=int, default=[0])
+    parser.add_argument('--ann_thresholds', nargs='+', type=optional_int, default=[ANN_THRESHOLD],
+                        help="Benchmark: task embeddings of a fuzzy node above which it is searched through the ANN index, none to disable it.")
+    parser.add_argument('--ann_nprobe', type=int, default=ANN_NPROBE)
+    parser.add_argument('--sample_size', type=int, default=None,
+                        help="Expand at most this many tasks per template (default: all).")
+    parser.add_argument('--sample_seed', type=int, default=0,
+                        help="Seed of the template sampling, see --sample_size.")
     args = parser.parse_args()
-    main(args)
+    if args.benchmark:
+        if 'fuzzy' in args.match_modes and args.embedder_path is None:
+            parser.error("--embedder_path is required for the fuzzy benchmark")
+    elif args.embedder_path is None or args.reranker_path is None:
+        parser.error("--embedder_path and --reranker_path are required")
+    if args.benchmark:
+        benchmark(args)
+    else:
+        main(args)
@@ -0,0 +1,150 @@
+import argparse, asyncio, contextlib, io, random, sys, time
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from run_experiment import MybenchTasks, MybenchAgent, MybenchEnvironment, run_task, arun_task
+from agent.pool import Device, DevicePool, TaskScheduler, run_device_tasks
+from action_cache.action import Action
+from action_cache.embedder import Qwen3Embedder
+from action_cache.tree import ActionTree, MatchMode
+
+# concurrency stress test of a shared action tree: executor threads run
+# interleaved, overlapping tasks of each app through one exact-match and one
+# fuzzy-match tree, then the tree must be consistent and every task must
+# have executed exactly its trajectory. needs no model and no input, exits
+# 1 on failure
+
+class RecordingEnvironment(MybenchEnvironment):
+    def __init__(self, agent):
+        super().__init__(agent)
+        self.executed = []
+
+    def execute(self, action):
+        self.executed.append(action)
+        super().execute(action)
+
+class TrajectoryEmbedder(Qwen3Embedder):
+    # deterministic stand-in for the embedding model: the step n embedding of
+    # a task is the one-hot vector of its first n actions (the done action
+    # after the last one), so a fuzzy hit is exactly a cached task with the
+    # same next action, and a wrong hit shows up as a wrong executed action
+    def __init__(self, task_trajectories):
+        self.trajectories = dict(task_trajectories)
+        prefixes = set()
+        for trajectory in self.trajectories.values():
+            for n in range(1, len(trajectory) + 2):
+                prefixes.add(self._prefix(trajectory, n))
+        self.prefix_index = {prefix: i for i, prefix in enumerate(sorted(prefixes))}
+        self.dim = len(self.prefix_index)
+        self.cache = None
+        self.stream_first_chunk = 4
+        self.stream_chunk_size = 16
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="step-embedding")
+
+    @staticmethod
+    def _prefix(trajectory, n):
+        prefix = tuple(str(action) for action in trajectory[:n])
+        return prefix + ("done",) if n > len(trajectory) else prefix
+
+    def _encode(self, tasks, steps):
+        embeddings = torch.zeros(len(tasks), self.dim)
+        for i, (task, step) in enumerate(zip(tasks, steps)):
+            trajectory = self.trajectories[task]
+            # steps past the end are computed ahead by the stream, never looked up
+            if step <= len(trajectory) + 1:
+                embeddings[i, self.prefix_index[self._prefix(trajectory, step)]] = 1.0
+        return embeddings
+
+def stress_app(tasks, app, task_trajectories, mode, num_workers, repeat, hot_ratio, async_workers=False):
+    # hot tasks run many times, so several executors race on the same paths
+    devices = []
+    for i in range(num_workers):
+        agent = MybenchAgent(tasks)
+        devices.append(Device(str(i), RecordingEnvironment(agent), agent))
+    if mode == MatchMode.EXACT:
+        tree = ActionTree(devices[0].env, devices[0].agent, Action, done=lambda a: a.name == 'done', mode=mode)
+    else:
+        tree = ActionTree(devices[0].env, devices[0].agent, Action, done=lambda a: a.name == 'done', mode=mode,
+                          embedder_config={}, embedder=TrajectoryEmbedder(task_trajectories))
+    names = [task for task, _ in task_trajectories]
+    random.shuffle(names)
+    num_hot = max(1, int(len(names) * hot_ratio))
+    schedule = (names[:num_hot] * 8 + names[num_hot:]) * repeat
+    random.shuffle(schedule)
+    expected = dict(task_trajectories)
+    mismatches = []
+
+    def run_fn(device, app, task):
+        device.env.executed = []
+        run_task(tree, device.env, device.agent, task, app)
+        if device.env.executed != expected[task]:
+            mismatches.append((task, device.env.executed, expected[task]))
+
+    async def arun_fn(device, app, task):
+        device.env.executed = []
+        await arun_task(tree, device.env, device.agent, task, app)
+        if device.env.executed != expected[task]:
+            mismatches.append((task, device.env.executed, expected[task]))
+
+    if async_workers:
+        errors = asyncio.run(run_device_tasks(devices, [(app, task) for task in schedule], arun_fn))
+    else:
+        pool = DevicePool(devices)
+        pool.start()
+        try:
+            errors = TaskScheduler(pool, run_fn).run([(app, task) for task in schedule])
+        finally:
+            pool.stop()
+    tree.update_shortcuts()
+    return {
+        "tasks": len(schedule),
+        "errors": errors,
+        "mismatches": mismatches,
+        "problems": tree.check_consistency(),
+        "correct": sum(d.env.correct_task_cnt for d in devices),
+        "generated": sum(d.agent.generate_cnt for d in devices),
+        "steps": sum(len(expected[task]) for task in schedule),
+    }
+
+def main(args):
+    random.seed(args.seed)
+    tasks = MybenchTasks(args.data_path, args.sample_size, args.seed)
+    failed = False
+    for app, task_trajectories in tasks.get_app_task_trajectories().items():
+        for mode in [MatchMode.EXACT, MatchMode.FUZZY]:
+            start_time = time.time()
+            log = io.StringIO()
+            with contextlib.redirect_stdout(sys.stdout if args.verbose else log):
+                result = stress_app(tasks, app, task_trajectories, mode, args.num_workers, args.repeat, args.hot_ratio, args.async_workers)
+            print(f"{app} {mode.name}: {result['tasks']} tasks on {args.num_workers} workers in {time.time() - start_time:.2f}s, "
+                  f"{result['correct']} correct, {result['generated']} model calls")
+            for _, task, e in result["errors"]:
+                print(f"  failed task {task}: {e!r}")
+            for task, executed, trajectory in result["mismatches"][:10]:
+                print(f"  wrong actions for {task}: {[str(a) for a in executed]} != {[str(a) for a in trajectory]}")
+            for problem in result["problems"]:
+                print(f"  inconsistent tree: {problem}")
+            try:
+                assert result["problems"] == [], "tree inconsistent"
+                assert not result["errors"], "tasks failed"
+                assert not result["mismatches"], "tasks executed wrong actions"
+                assert result["correct"] == result["tasks"], "tasks not completed"
+                assert result["generated"] < result["steps"], "no cache hits"
+            except AssertionError as e:
+                print(f"  FAILED: {e}")
+                failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_path', type=str, default="train/train_data_example")
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=30,
+                        help="Times every task is scheduled (hot tasks 8 times as often).")
+    parser.add_argument('--hot_ratio', type=float, default=0.2)
+    parser.add_argument('--async_workers', action='store_true',
+                        help="Run the executors as coroutines on one event loop (ActionTree.aexecute) instead of threads.")
+    parser.add_argument('--sample_size', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help="Show the executor output.")
+    args = parser.parse_args()
+    sys.exit(main(args))
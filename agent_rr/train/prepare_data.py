@@ -1,12 +1,15 @@
 import json, os, itertools
 import random
-from sklearn.model_selection import train_test_split
 import re
+from concurrent.futures import ProcessPoolExecutor
 
-from .task_template import get_app_task_trajectories
+from .task_template import get_app, get_app_task_trajectories
+from .shards import ShardedJsonlWriter, in_test_split, iter_jsonl, merge_shards
 
 NUM_NEGATIVE = 10
 MAX_REPEAT_TIMES = 10
+# fraction of the train split held out as test set when there is no test path
+TEST_RATIO = 0.1
 EMBEDDING_QUERY_FORMAT = "Instruct: Given a phone-use task, retrieve similar tasks that shares at least **{n}** steps with the given task\nQuery:{query}"
 EMBEDDING_INSTRUCT_FORMAT = "Instruct: Represent this phone-use task for level **{n}**\nQuery:{query}"
 
@@ -21,60 +24,132 @@ def get_lshare(trajectory1, trajectory2):
         k += 1
     return l_share
 
-def single_split_embedding(path):
-    task_trajectories = []
-    app_tasks = {}
-    for root, _, files in os.walk(path):
-        if 'templates.json' in files:
-            app_task_trajectories = get_app_task_trajectories(root)
-            app_tasks.update({app: list(set(task for task, _ in app_task_trajectories[app])) for app in app_task_trajectories})
-            task_trajectories.extend(list(set((task, tuple(trajectory)) for app in app_task_trajectories for task, trajectory in app_task_trajectories[app])))
-    entries = []
+class TrieNode:
+    def __init__(self):
+        self.children = {}
+        # indices of the trajectories through this node, i.e. sharing its
+        # first depth actions
+        self.members = []
+        # memoized task sets, see task_sets
+        self.positive_tasks = None
+        self.negative_tasks = {}
+
+class TrajectoryTrie:
+    def __init__(self):
+        self.root = TrieNode()
+
+    def insert(self, idx, trajectory):
+        # returns the nodes of trajectory, path[n - 1] is its node at depth n
+        node = self.root
+        path = []
+        for action in trajectory:
+            if action not in node.children:
+                node.children[action] = TrieNode()
+            node = node.children[action]
+            node.members.append(idx)
+            path.append(node)
+        return path
+
+def task_sets(task_trajectories, tasks=None, other_tasks=frozenset()):
+    # for every task and level n: the tasks sharing at least n steps with
+    # it (positives, itself included), and the tasks sharing fewer steps
+    # (negatives) - all tasks at n = 1, tasks of the same app above.
+    # other_tasks: tasks of apps not in task_trajectories, they share no
+    # step with any of them and are only negatives at n = 1
+    # same result as comparing every pair with get_lshare, but the tasks
+    # sharing n steps with a trajectory are exactly the members of its trie
+    # node at depth n, so each node's sets are built once and shared by all
+    # of its members. tasks: only compute the sets of these tasks.
+    # the returned sets may be shared between tasks, do not modify them
     task_positives = {}
     task_negatives = {}
     task_app = {}
-    for i, j in itertools.combinations(range(len(task_trajectories)), 2):
-        task1, trajectory1 = task_trajectories[i]
-        task2, trajectory2 = task_trajectories[j]
-        app1 = trajectory1[0].split(' ')[1].replace("<", "").replace(">", "")
-        app2 = trajectory2[0].split(' ')[1].replace("<", "").replace(">", "")
-        task_app[task1] = app1
-        task_app[task2] = app2
-        is_same_app = app1 == app2
-        l_share = get_lshare(trajectory1, trajectory2)
-        if task1 not in task_positives:
-            task_positives[task1] = {}
-            task_negatives[task1] = {}
-        if task2 not in task_positives:
-            task_positives[task2] = {}
-            task_negatives[task2] = {}
-        for n in range(1, len(trajectory1) + 1):
-            if n not in task_positives[task1]:
-                task_positives[task1][n] = set([task1])
-            if n not in task_negatives[task1]:
-                task_negatives[task1][n] = set()
-            if l_share >= n:
-                task_positives[task1][n].add(task2)
-            elif n == 1 or is_same_app:
-                task_negatives[task1][n].add(task2)
-        for n in range(1, len(trajectory2) + 1):
-            if n not in task_positives[task2]:
-                task_positives[task2][n] = set([task2])
-            if n not in task_negatives[task2]:
-                task_negatives[task2][n] = set()
-            if l_share >= n:
-                task_positives[task2][n].add(task1)
-            elif n == 1 or is_same_app:
-                task_negatives[task2][n].add(task1)
+    if len(task_trajectories) < 2 and not other_tasks:
+        return task_positives, task_negatives, task_app
+    trie = TrajectoryTrie()
+    paths = [trie.insert(i, trajectory) for i, (_, trajectory) in enumerate(task_trajectories)]
+    apps = [get_app(trajectory) for _, trajectory in task_trajectories]
+    all_indices = set(range(len(task_trajectories)))
+    app_indices = {}
+    for i, app in enumerate(apps):
+        app_indices.setdefault(app, set()).add(i)
+    for i, (task, _) in enumerate(task_trajectories):
+        if tasks is not None and task not in tasks:
+            continue
+        task_app[task] = apps[i]
+        positives = task_positives.setdefault(task, {})
+        negatives = task_negatives.setdefault(task, {})
+        for n, node in enumerate(paths[i], 1):
+            if node.positive_tasks is None:
+                node.positive_tasks = set(task_trajectories[j][0] for j in node.members)
+            universe = None if n == 1 else apps[i]
+            if universe not in node.negative_tasks:
+                indices = all_indices if n == 1 else app_indices[apps[i]]
+                node.negative_tasks[universe] = set(task_trajectories[j][0] for j in indices.difference(node.members))
+                if n == 1:
+                    node.negative_tasks[universe] |= other_tasks
+            # the node's sets as long as the task has one trajectory
+            if n not in positives:
+                positives[n] = node.positive_tasks
+            else:
+                positives[n] = positives[n] | node.positive_tasks
+            if n not in negatives:
+                negatives[n] = node.negative_tasks[universe]
+            else:
+                negatives[n] = negatives[n] | node.negative_tasks[universe]
+    return task_positives, task_negatives, task_app
+
+def get_domain_dirs(path):
+    return [root for root, _, files in os.walk(path) if 'templates.json' in files]
+
+def load_domains(domain_dirs, sample_size=None, seed=0):
+    # (task, trajectory) pairs of the domains, the tasks of every app, and
+    # the tasks of every domain dir. sample_size: at most that many tasks
+    # per template
+    task_trajectories = []
+    app_tasks = {}
+    domain_tasks = {}
+    for root in domain_dirs:
+        app_task_trajectories = get_app_task_trajectories(root, sample_size, seed)
+        # sorted, so that the sampling only depends on the seed
+        app_tasks.update({app: sorted(set(task for task, _ in app_task_trajectories[app])) for app in app_task_trajectories})
+        task_trajectories.extend(sorted(set((task, tuple(trajectory)) for app in app_task_trajectories for task, trajectory in app_task_trajectories[app])))
+        domain_tasks[root] = set(task for app in app_task_trajectories for task, _ in app_task_trajectories[app])
+    return task_trajectories, app_tasks, domain_tasks
+
+def load_split(path, sample_size=None, seed=0):
+    # load_domains of all domains under path
+    return load_domains(get_domain_dirs(path), sample_size, seed)
+
+def domain_app_tasks(domain_dir, sample_size=None, seed=0):
+    # the tasks of every app of a domain, see load_app_index
+    return load_domains([domain_dir], sample_size, seed)[1]
+
+def load_app_index(domain_dirs, num_workers=None, sample_size=None, seed=0):
+    # task names of every app of the split (as load_split) and of every
+    # domain, one pass over the domains in worker processes. this is all an
+    # embedding job needs from the domains other than its own
+    app_tasks = {}
+    domain_tasks = {}
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        for d, tasks in zip(domain_dirs, executor.map(domain_app_tasks, domain_dirs, [sample_size] * len(domain_dirs), [seed] * len(domain_dirs))):
+            app_tasks.update(tasks)
+            domain_tasks[d] = tasks
+    return app_tasks, domain_tasks
+
+def iter_embedding_entries(task_trajectories, app_tasks, tasks=None, other_tasks=frozenset()):
+    # entries of tasks (all tasks if None), one task at a time
+    task_positives, task_negatives, task_app = task_sets(task_trajectories, tasks, other_tasks)
     for task in task_positives.keys():
         positive = task_positives[task]
         negative = task_negatives[task]
         for n in positive.keys():
             if len(positive[n]) == 1:
-                positive[n] |= set([f"请{task}", f"请你{task}", f"请帮我{task}", f"帮我{task}", f"请你帮我{task}"])
+                positive[n] = positive[n] | set([f"请{task}", f"请你{task}", f"请帮我{task}", f"帮我{task}", f"请你帮我{task}"])
             if len(negative[n]) == 0 and n > 1:
                 # sample some tasks from other apps
                 other_apps = [app for app in app_tasks if app != task_app[task]]
+                negative[n] = set()
                 for app in other_apps:
                     sample_num = (10 * NUM_NEGATIVE + len(negative[n]) - 1) // len(other_apps)
                     sample_num = min(sample_num, len(app_tasks[app]))
@@ -85,10 +160,9 @@ def single_split_embedding(path):
             repeat_times = (repeat_times + NUM_NEGATIVE - 1) // NUM_NEGATIVE
             repeat_times = max(1, repeat_times)
             start = 0
-            rejected = list(negative[n])
+            rejected = sorted(negative[n])
             random.shuffle(rejected)
-            old_num_entries = len(entries)
-            for positive_task in positive[n]:
+            for positive_task in sorted(positive[n]):
                 # query = EMBEDDING_QUERY_FORMAT.format(n=n, query=task)
                 query = EMBEDDING_INSTRUCT_FORMAT.format(n=n, query=task)
                 # response = positive_task
@@ -98,51 +172,113 @@ def single_split_embedding(path):
                         start = 0
                     end = start + NUM_NEGATIVE
                     end = min(end, len(rejected))
-                    entries.append({
+                    yield {
                         "query": query,
                         "response": response,
                         # "rejected_response": [rejected[start:end]]
                         "rejected_response": [EMBEDDING_INSTRUCT_FORMAT.format(n=n, query=t) for t in rejected[start:end]],
-                    })
+                    }
                     start = end
-            # print(f"Increment: {len(entries) - old_num_entries}")
-    return entries
-
-
-def balance_embedding(entries):
-    level_entries = {}
-    for entry in entries:
-        match = re.search(r'\*\*(\d+)\*\*', entry['query'])
-        if match:
-            n = int(match.group(1))
-            if n not in level_entries:
-                level_entries[n] = []
-            level_entries[n].append(entry)
-    max_len = max(len(level_entries[n]) for n in level_entries)
-    for n in level_entries:
-        if len(level_entries[n]) < max_len // 2:
-            multiplier = max_len // 2 // len(level_entries[n])
-            level_entries[n] = level_entries[n] * multiplier
-    ret = []
-    for n in level_entries:
-        ret.extend(level_entries[n])
-    return ret
-
-def embedding_main(train_path, test_path):
-    entries_train = single_split_embedding(train_path)
-    if test_path is None:
-        entries_train, entries_test = train_test_split(entries_train, test_size=0.1, random_state=42)
-    else:
-        entries_test = single_split_embedding(test_path)
-    entries_train = balance_embedding(entries_train)
-    # random.shuffle(entries_train)
-    # random.shuffle(entries_test)
-    with open('embedding_mybench_data.jsonl', 'w', encoding='utf-8') as f:
-        for entry in entries_train:
-            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
-    with open('embedding_mybench_data_test.jsonl', 'w', encoding='utf-8') as f:
-        for entry in entries_test:
-            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+def single_split_embedding(path, sample_size=None, seed=0):
+    task_trajectories, app_tasks, _ = load_split(path, sample_size, seed)
+    return list(iter_embedding_entries(task_trajectories, app_tasks))
+
+def iter_domain_embedding_entries(domain_dir, app_tasks, domain_app_index, sample_size=None, seed=0):
+    # entries of the tasks of domain_dir, with the same sets as over the
+    # whole split. domain_app_index: the task names of every app of every
+    # domain (see load_app_index). only the domains sharing an app with
+    # domain_dir (itself included) can share steps with its tasks, their
+    # trajectories are loaded, the tasks of all other domains are negatives
+    sharing = [d for d in domain_app_index if domain_app_index[d].keys() & domain_app_index[domain_dir].keys()]
+    other_tasks = set(task for d in domain_app_index if d not in sharing for tasks in domain_app_index[d].values() for task in tasks)
+    task_trajectories, _, domain_tasks = load_domains(sharing, sample_size, seed)
+    return iter_embedding_entries(task_trajectories, app_tasks, domain_tasks[domain_dir], other_tasks)
+
+def get_level(entry):
+    match = re.search(r'\*\*(\d+)\*\*', entry['query'])
+    return int(match.group(1)) if match else None
+
+def level_multipliers(level_counts):
+    # levels with less than half the entries of the largest one are
+    # repeated up to about that half
+    max_len = max(level_counts.values())
+    multipliers = {}
+    for n, count in level_counts.items():
+        multipliers[n] = 1
+        if count < max_len // 2:
+            multipliers[n] = max_len // 2 // count
+    return multipliers
+
+def upsample_shard(path, multipliers, prefix):
+    # the extra copies of the entries of a shard, see level_multipliers
+    writer = ShardedJsonlWriter(prefix)
+    for entry in iter_jsonl(path):
+        for _ in range(multipliers.get(get_level(entry), 1) - 1):
+            writer.write(entry)
+    return writer.close()
+
+def write_shards(make_entries, args, prefix, seed, test_ratio=0.0, count_key=None):
+    # runs in a worker process: streams the entries of make_entries(*args)
+    # into train (and test, a test_ratio fraction) shards; returns the shard
+    # paths of both splits and the count of train entries per count_key
+    # seeded by the job, not by where its shards go
+    random.seed(f"{seed}:{os.path.basename(prefix)}")
+    writers = {"train": ShardedJsonlWriter(f"{prefix}-train"), "test": ShardedJsonlWriter(f"{prefix}-test")}
+    counts = {}
+    for entry in make_entries(*args):
+        line = json.dumps(entry, ensure_ascii=False)
+        split = "test" if test_ratio > 0 and in_test_split(line, test_ratio) else "train"
+        writers[split].write_line(line)
+        if split == "train" and count_key is not None:
+            key = count_key(entry)
+            counts[key] = counts.get(key, 0) + 1
+    return {split: writer.close() for split, writer in writers.items()}, counts
+
+def run_shard_jobs(jobs, num_workers):
+    # jobs: write_shards arguments; returns (train shards, test shards, counts)
+    train_shards, test_shards, counts = [], [], {}
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        for shards, job_counts in executor.map(write_shards, *zip(*jobs)):
+            train_shards.extend(shards["train"])
+            test_shards.extend(shards["test"])
+            for key, count in job_counts.items():
+                counts[key] = counts.get(key, 0) + count
+    return train_shards, test_shards, counts
+
+def remove_empty_dir(path):
+    if os.path.isdir(path) and not os.listdir(path):
+        os.rmdir(path)
+
+def domain_embedding_jobs(path, prefix, seed, test_ratio, count_key=None, num_workers=None, sample_size=None):
+    # one job per domain. a job loads the trajectories of its domain and of
+    # the domains sharing one of its apps, the rest of the split is passed
+    # in as task names from the index. every job refers to the same index,
+    # the per-domain sets are built in the workers
+    domain_dirs = get_domain_dirs(path)
+    app_tasks, domain_app_index = load_app_index(domain_dirs, num_workers, sample_size, seed)
+    return [(iter_domain_embedding_entries, (d, app_tasks, domain_app_index, sample_size, seed), f"{prefix}-{k:04d}", seed, test_ratio, count_key)
+            for k, d in enumerate(domain_dirs)]
+
+def embedding_main(train_path, test_path, output_dir='.', num_workers=None, seed=0, sample_size=None):
+    # one job per domain, entries go straight to shards in output_dir/shards
+    # and are merged at the end, nothing is kept in memory
+    shard_dir = os.path.join(output_dir, 'shards')
+    test_ratio = TEST_RATIO if test_path is None else 0.0
+    jobs = domain_embedding_jobs(train_path, os.path.join(shard_dir, 'embedding'), seed, test_ratio, get_level, num_workers, sample_size)
+    if test_path is not None:
+        jobs += domain_embedding_jobs(test_path, os.path.join(shard_dir, 'embedding-test'), seed, 1.0, None, num_workers, sample_size)
+    train_shards, test_shards, level_counts = run_shard_jobs(jobs, num_workers)
+    # balance by the train counts, upsampled copies are one more pass over the shards
+    multipliers = level_multipliers(level_counts) if level_counts else {}
+    if any(m > 1 for m in multipliers.values()):
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            prefixes = [path[:-len('.jsonl')] + '-extra' for path in train_shards]
+            for extra_shards in executor.map(upsample_shard, train_shards, [multipliers] * len(train_shards), prefixes):
+                train_shards.extend(extra_shards)
+    merge_shards(train_shards, os.path.join(output_dir, 'embedding_mybench_data.jsonl'))
+    merge_shards(test_shards, os.path.join(output_dir, 'embedding_mybench_data_test.jsonl'))
+    remove_empty_dir(shard_dir)
 
 RERANKER_SYSTEM = "Judge whether the Document meets the requirements based on the Query and the Instruct provided. Note that the answer can only be \"yes\" or \"no\"."
 POSITIVE_TOKEN = "yes"
@@ -151,7 +287,6 @@ RERANKER_INPUT_FORMAT = "<Instruct>: Given a phone-use task, retrieve similar ta
 RERANKER_OUTPUT_FORMAT = "<think>\n\n</think>\n\n{token}"
 
 def single_app_reranker(task_trajectory_pairs):
-    entries = []
     max_len = max(len(trajectory) for _, trajectory in task_trajectory_pairs)
     for i, j in itertools.combinations(range(len(task_trajectory_pairs)), 2):
         task1, trajectory1 = task_trajectory_pairs[i]
@@ -162,32 +297,26 @@ def single_app_reranker(task_trajectory_pairs):
             input_text1 = RERANKER_INPUT_FORMAT.format(n=n, query=task1, document=task2)
             input_text2 = RERANKER_INPUT_FORMAT.format(n=n, query=task2, document=task1)
             output_text = RERANKER_OUTPUT_FORMAT.format(token=token)
-            entries.extend([
-                {
+            for input_text in [input_text1, input_text2]:
+                yield {
                     "system": RERANKER_SYSTEM,
                     "input": input_text,
                     "output": output_text
                 }
-                for input_text in [input_text1, input_text2]
-            ])
-    return entries
 
-def single_domain_reranker(domain_dir):
-    app_task_trajectories = get_app_task_trajectories(domain_dir)
-    entries = []
+def single_domain_reranker(domain_dir, sample_size=None, seed=0):
+    app_task_trajectories = get_app_task_trajectories(domain_dir, sample_size, seed)
     for app in app_task_trajectories:
-        entries.extend(single_app_reranker(app_task_trajectories[app]))
-    return entries
+        yield from single_app_reranker(app_task_trajectories[app])
 
-def cross_app_step1_reranker(path):
+def cross_app_step1_reranker(path, sample_size=None, seed=0):
     app_tasks = {}
     task_app = {}
     for root, _, files in os.walk(path):
         if 'templates.json' in files:
-            app_task_trajectories = get_app_task_trajectories(root)
-            app_tasks.update({app: list(set(task for task, _ in app_task_trajectories[app])) for app in app_task_trajectories})
+            app_task_trajectories = get_app_task_trajectories(root, sample_size, seed)
+            app_tasks.update({app: sorted(set(task for task, _ in app_task_trajectories[app])) for app in app_task_trajectories})
             task_app.update({task: app for app in app_task_trajectories for task, _ in app_task_trajectories[app]})
-    entries = []
     for task in task_app:
         app = task_app[task]
         other_apps = [a for a in app_tasks if a != app]
@@ -198,34 +327,29 @@ def cross_app_step1_reranker(path):
             for sampled_task in sampled_tasks:
                 input_text = RERANKER_INPUT_FORMAT.format(n=1, query=task, document=sampled_task)
                 output_text = RERANKER_OUTPUT_FORMAT.format(token=NEGATIVE_TOKEN)
-                entries.append({
+                yield {
                     "system": RERANKER_SYSTEM,
                     "input": input_text,
                     "output": output_text
-                })
-    return entries
+                }
 
-def reranker_main(train_path, test_path):
-    entries_train = []
-    entries_test = []
-    for root, _, files in os.walk(train_path):
-        if 'templates.json' in files:
-            entries_train.extend(single_domain_reranker(root))
-    entries_train.extend(cross_app_step1_reranker(train_path))
-    if test_path is None:
-        entries_train, entries_test = train_test_split(entries_train, test_size=0.1, random_state=42)
-    else:
-        for root, _, files in os.walk(test_path):
-            if 'templates.json' in files:
-                entries_test.extend(single_domain_reranker(root))
-        entries_test.extend(cross_app_step1_reranker(test_path))
-
-    with open('reranker_mybench_data.jsonl', 'w', encoding='utf-8') as f:
-        for entry in entries_train:
-            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
-    with open('reranker_mybench_data_test.jsonl', 'w', encoding='utf-8') as f:
-        for entry in entries_test:
-            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+def reranker_jobs(path, prefix, seed, test_ratio, sample_size=None):
+    # one job per domain plus one for the cross-app negatives of the split
+    jobs = [(single_domain_reranker, (d, sample_size, seed), f"{prefix}-{k:04d}", seed, test_ratio)
+            for k, d in enumerate(get_domain_dirs(path))]
+    jobs.append((cross_app_step1_reranker, (path, sample_size, seed), f"{prefix}-cross", seed, test_ratio))
+    return jobs
+
+def reranker_main(train_path, test_path, output_dir='.', num_workers=None, seed=0, sample_size=None):
+    shard_dir = os.path.join(output_dir, 'shards')
+    test_ratio = TEST_RATIO if test_path is None else 0.0
+    jobs = reranker_jobs(train_path, os.path.join(shard_dir, 'reranker'), seed, test_ratio, sample_size)
+    if test_path is not None:
+        jobs += reranker_jobs(test_path, os.path.join(shard_dir, 'reranker-test'), seed, 1.0, sample_size)
+    train_shards, test_shards, _ = run_shard_jobs(jobs, num_workers)
+    merge_shards(train_shards, os.path.join(output_dir, 'reranker_mybench_data.jsonl'))
+    merge_shards(test_shards, os.path.join(output_dir, 'reranker_mybench_data_test.jsonl'))
+    remove_empty_dir(shard_dir)
 
 if __name__ == '__main__':
     import argparse
@@ -236,13 +360,22 @@ if __name__ == '__main__':
                         help="Path to the training data directory.")
     parser.add_argument('--test_path', type=str, default='train/test_data',
                         help="Path to the test data directory.")
+    parser.add_argument('--output_dir', type=str, default='.',
+                        help="Directory to write the jsonl files to.")
+    parser.add_argument('--num_workers', type=int, default=None,
+                        help="Number of worker processes, one domain each at a time (default: cpu count).")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed of the negative sampling, per domain.")
+    parser.add_argument('--sample_size', type=int, default=None,
+                        help="Expand at most this many tasks per template, sampled with --seed (default: all).")
     args = parser.parse_args()
+    kwargs = dict(output_dir=args.output_dir, num_workers=args.num_workers, seed=args.seed, sample_size=args.sample_size)
     if args.task == 'embedding':
-        embedding_main(args.train_path, args.test_path)
+        embedding_main(args.train_path, args.test_path, **kwargs)
     elif args.task == 'reranker':
-        reranker_main(args.train_path, args.test_path)
+        reranker_main(args.train_path, args.test_path, **kwargs)
     elif args.task == 'both':
-        embedding_main(args.train_path, args.test_path)
-        reranker_main(args.train_path, args.test_path)
+        embedding_main(args.train_path, args.test_path, **kwargs)
+        reranker_main(args.train_path, args.test_path, **kwargs)
     else:
         print("Invalid task specified. Use 'embedding' or 'reranker' or 'both'.")
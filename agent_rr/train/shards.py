@@ -0,0 +1,64 @@
+import json, os, shutil, zlib
+
+MAX_SHARD_ENTRIES = 100000
+
+def in_test_split(line, test_ratio):
+    # deterministic per entry and without seeing the other entries;
+    # identical entries always land in the same split
+    return zlib.crc32(line.encode('utf-8')) % 10000 < test_ratio * 10000
+
+class ShardedJsonlWriter:
+    # writes entries to <prefix>-00000.jsonl, <prefix>-00001.jsonl, ...,
+    # starting a new shard every max_entries entries
+    def __init__(self, prefix, max_entries=MAX_SHARD_ENTRIES):
+        self.prefix = prefix
+        self.max_entries = max_entries
+        self.paths = []
+        self.file = None
+        self.shard_entries = 0
+        self.num_entries = 0
+
+    def _next_shard(self):
+        if self.file is not None:
+            self.file.close()
+        path = f"{self.prefix}-{len(self.paths):05d}.jsonl"
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.file = open(path, 'w', encoding='utf-8')
+        self.paths.append(path)
+        self.shard_entries = 0
+
+    def write_line(self, line):
+        if self.file is None or self.shard_entries >= self.max_entries:
+            self._next_shard()
+        self.file.write(line + '\n')
+        self.shard_entries += 1
+        self.num_entries += 1
+
+    def write(self, entry):
+        self.write_line(json.dumps(entry, ensure_ascii=False))
+
+    def close(self):
+        # returns the paths of the shards written
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        return self.paths
+
+def iter_jsonl(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+def merge_shards(paths, out_path, remove=True):
+    # concatenates the shards into out_path without loading them
+    dirname = os.path.dirname(out_path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(out_path, 'wb') as out:
+        for path in paths:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out)
+            if remove:
+                os.remove(path)
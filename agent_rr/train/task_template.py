@@ -1,6 +1,7 @@
-import os, itertools, json
+import os, itertools, json, math, random
 
-def get_task_templates(raw_template):
+def get_template_slots(raw_template):
+    # the parenthesized (a|b|NULL) parts of a task template
     results = []
     left_pos = 0
     while True:
@@ -21,20 +22,27 @@ def get_task_templates(raw_template):
         })
 
         left_pos = right + 1
-    combinations = itertools.product(*[result['contents'] for result in results])
-    task_templates = []
-    for combination in combinations:
-        segments = []
-        last_left = 0
-        for i, content in enumerate(combination):
-            left = results[i]['left']
-            right = results[i]['right']
-            segments.append(raw_template[last_left:left])
-            segments.append(content)
-            last_left = right + 1
-        segments.append(raw_template[last_left:])
-        task_templates.append(''.join(segments))
-    return task_templates
+    return results
+
+def fill_task_template(raw_template, results, combination):
+    segments = []
+    last_left = 0
+    for i, content in enumerate(combination):
+        left = results[i]['left']
+        right = results[i]['right']
+        segments.append(raw_template[last_left:left])
+        segments.append(content)
+        last_left = right + 1
+    segments.append(raw_template[last_left:])
+    return ''.join(segments)
+
+def iter_task_templates(raw_template):
+    results = get_template_slots(raw_template)
+    for combination in itertools.product(*[result['contents'] for result in results]):
+        yield fill_task_template(raw_template, results, combination)
+
+def get_task_templates(raw_template):
+    return list(iter_task_templates(raw_template))
 
 def get_trajectory(trajectory_template, fmt):
     trajectory = []
@@ -47,42 +55,103 @@ def get_trajectory(trajectory_template, fmt):
         trajectory.append(act)
     return trajectory
 
-def get_app_task_trajectories(domain_dir):
-    with open(os.path.join(domain_dir, "templates.json"), encoding='utf-8') as f:
-        templates = json.load(f)
-    print(f"Domain: {domain_dir}")
-    task_trajectories = {}
-    for template in templates:
-        raw_task_template = template["task"]
-        trajectory_template = template["trajectory"]
-        task_templates = get_task_templates(raw_task_template)
-        candidates = template["candidates"]
-        dependency = template.get("dependency", "no")
-        keys = list(candidates.keys())
-
-        if dependency == "one-to-one":
-            combinations = zip(*[candidates[k] for k in keys])
-        elif dependency == "no":
-            combinations = itertools.product(*[candidates[k] for k in keys])
-        else:
-            print(f"Unknonw dependency type: {dependency}")
-            continue
-
-        for combination in combinations:
+def product_at(sizes, index):
+    # the index-th element of itertools.product over sequences of these
+    # sizes, as indices into each sequence (the last one varies fastest)
+    digits = []
+    for size in reversed(sizes):
+        index, digit = divmod(index, size)
+        digits.append(digit)
+    return digits[::-1]
+
+def template_expansion(template):
+    # (number of candidate combinations, task template slots) without
+    # expanding anything; None if the template cannot be expanded
+    candidates = template["candidates"]
+    dependency = template.get("dependency", "no")
+    if dependency == "one-to-one":
+        num_combinations = min((len(v) for v in candidates.values()), default=0)
+    elif dependency == "no":
+        num_combinations = math.prod(len(v) for v in candidates.values())
+    else:
+        print(f"Unknonw dependency type: {dependency}")
+        return None
+    return num_combinations, get_template_slots(template["task"])
+
+def count_template_tasks(template):
+    expansion = template_expansion(template)
+    if expansion is None:
+        return 0
+    num_combinations, results = expansion
+    return num_combinations * math.prod(len(result['contents']) for result in results)
+
+def iter_template_task_trajectories(template, sample_size=None, seed=0):
+    # (task, trajectory) pairs of one template in itertools.product order,
+    # each built when it is needed. with sample_size, a uniform sample of
+    # that many of them, the same for the same template and seed
+    expansion = template_expansion(template)
+    if expansion is None:
+        return
+    num_combinations, results = expansion
+    raw_task_template = template["task"]
+    trajectory_template = template["trajectory"]
+    candidates = template["candidates"]
+    dependency = template.get("dependency", "no")
+    keys = list(candidates.keys())
+    content_sizes = [len(result['contents']) for result in results]
+    num_task_templates = math.prod(content_sizes)
+    total = num_combinations * num_task_templates
+    if sample_size is None or sample_size >= total:
+        indices = range(total)
+    else:
+        # sampling a range does not build it
+        indices = sorted(random.Random(f"{seed}:{raw_task_template}").sample(range(total), sample_size))
+    last_combination_index = None
+    for index in indices:
+        combination_index, task_template_index = divmod(index, num_task_templates)
+        if combination_index != last_combination_index:
+            if dependency == "one-to-one":
+                combination = [candidates[k][combination_index] for k in keys]
+            else:
+                combination = [candidates[k][i] for k, i in zip(keys, product_at([len(candidates[k]) for k in keys], combination_index))]
             fmt = {}
             for i, k in enumerate(keys):
                 fmt[k] = combination[i]
             trajectory = get_trajectory(trajectory_template, fmt)
-            for task_template in task_templates:
-                task = task_template.format(**fmt)
-                task_trajectories[task] = trajectory
+            last_combination_index = combination_index
+        contents = [results[i]['contents'][j] for i, j in enumerate(product_at(content_sizes, task_template_index))]
+        task_template = fill_task_template(raw_task_template, results, contents)
+        yield task_template.format(**fmt), trajectory
+
+def load_templates(domain_dir):
+    with open(os.path.join(domain_dir, "templates.json"), encoding='utf-8') as f:
+        return json.load(f)
+
+def count_domain_tasks(domain_dir):
+    # number of (task, trajectory) pairs of the domain, tasks of several
+    # templates counted once per template
+    return sum(count_template_tasks(template) for template in load_templates(domain_dir))
+
+def iter_domain_task_trajectories(domain_dir, sample_size=None, seed=0):
+    # sample_size: at most that many tasks per template, see
+    # iter_template_task_trajectories
+    for template in load_templates(domain_dir):
+        yield from iter_template_task_trajectories(template, sample_size, seed)
+
+def get_app(trajectory):
+    return trajectory[0].split(' ')[1].replace("<", "").replace(">", "")
+
+def get_app_task_trajectories(domain_dir, sample_size=None, seed=0):
+    print(f"Domain: {domain_dir}")
+    task_trajectories = {}
+    for task, trajectory in iter_domain_task_trajectories(domain_dir, sample_size, seed):
+        task_trajectories[task] = trajectory
     # print(task_trajectories)
     app_task_trajectories = {}
     for task, trajectory in task_trajectories.items():
-        app = trajectory[0].split(' ')[1]
-        app = app.replace("<", "").replace(">", "")
+        app = get_app(trajectory)
         if app not in app_task_trajectories:
             app_task_trajectories[app] = []
         app_task_trajectories[app].append((task, trajectory))
 
-    return app_task_trajectories
\ No newline at end of file
+    return app_task_trajectories
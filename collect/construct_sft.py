@@ -4,6 +4,8 @@ from typing import List
 from PIL import Image
 import random
 import argparse
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
 import re
@@ -85,25 +87,246 @@ def create_entries_for_one_step(num_repeat, instruction, output, image_path):
     )
     return [entry] * num_repeat
 
-def resize_and_copy_image(part, img_path, data_path, out_path, factor, do_copy=False):
+SHARD_SIZE = 100000
+
+def collapse_repeats(entries):
+    # create_entries_for_one_step 的重复条目是同一个对象，合并为 (entry, 重复次数)，保持首次出现的顺序
+    counts = {}
+    unique_entries = []
+    for entry in entries:
+        if id(entry) not in counts:
+            counts[id(entry)] = 0
+            unique_entries.append(entry)
+        counts[id(entry)] += 1
+    return [(entry, counts[id(entry)]) for entry in unique_entries]
+
+class JsonlShardWriter:
+    """按行写入 <prefix>-00000.jsonl, <prefix>-00001.jsonl, ...，每个分片最多 shard_size 行"""
+    def __init__(self, prefix, shard_size=SHARD_SIZE):
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.paths = []
+        self.file = None
+        self.shard_lines = 0
+
+    def write(self, line):
+        if self.file is None or self.shard_lines >= self.shard_size:
+            if self.file is not None:
+                self.file.close()
+            path = f"{self.prefix}-{len(self.paths):05d}.jsonl"
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.file = open(path, "w", encoding="UTF-8")
+            self.paths.append(path)
+            self.shard_lines = 0
+        self.file.write(line + "\n")
+        self.shard_lines += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        return self.paths
+
+class EntryStream:
+    """代替条目列表：extend 时直接写入分片。repeat_mode 为 weight 时重复条目只写一行并带 weight 字段，
+    为 expand 时写入时展开。len 为展开后的条目数，与列表模式一致"""
+    def __init__(self, prefix, repeat_mode="weight", shard_size=SHARD_SIZE):
+        self.writer = JsonlShardWriter(prefix, shard_size)
+        self.repeat_mode = repeat_mode
+        self.count = 0
+        self.num_lines = 0
+
+    def write(self, entry_dict, num_repeat):
+        self.count += num_repeat
+        if self.repeat_mode == "weight":
+            self.writer.write(json.dumps(dict(entry_dict, weight=num_repeat), ensure_ascii=False))
+            self.num_lines += 1
+        else:
+            line = json.dumps(entry_dict, ensure_ascii=False)
+            for _ in range(num_repeat):
+                self.writer.write(line)
+            self.num_lines += num_repeat
+
+    def extend(self, entries):
+        for entry, num_repeat in collapse_repeats(entries):
+            self.write(asdict(entry), num_repeat)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        # (条目, 重复次数)，只能在 close 之后读取
+        for path in self.writer.paths:
+            with open(path, "r", encoding="UTF-8") as f:
+                for line in f:
+                    entry_dict = json.loads(line)
+                    yield entry_dict, entry_dict.pop("weight", 1)
+
+def dataset_of(key):
+    # decider_no_history_entries_train -> mobimind_decider_train
+    kind = key.split("_")[0]
+    kind = kind if kind in ("e2e", "grounder") else "decider"
+    split = key.rsplit("_", 1)[1]
+    return f"mobimind_{kind}_{split}"
+
+DATASET_DIR_RE = re.compile(r"mobimind_(decider|e2e|grounder)_[^_]+")
+
+def clear_shards(path):
+    # 删除目录下的 jsonl 分片，目录为空时一并删除
+    if not os.path.isdir(path):
+        return
+    for name in os.listdir(path):
+        if name.endswith(".jsonl"):
+            os.remove(os.path.join(path, name))
+    if not os.listdir(path):
+        os.rmdir(path)
+
+class StreamingSftWriter:
+    """把每类条目写入 <out_path>/<数据集>/<类别>-xxxxx.jsonl 分片，metadata.json 由写入时的计数生成"""
+    def __init__(self, out_path, repeat_mode="weight", shard_size=SHARD_SIZE):
+        self.out_path = out_path
+        self.repeat_mode = repeat_mode
+        self.shard_size = shard_size
+        self.tmp_path = os.path.join(out_path, "tmp")
+        self.streams = {}
+        # 先清掉上次构建的分片：分片变少时旧分片不会被覆盖，会混进数据集目录
+        clear_shards(self.tmp_path)
+        for name in os.listdir(out_path):
+            if DATASET_DIR_RE.fullmatch(name):
+                clear_shards(os.path.join(out_path, name))
+
+    def stream(self, key, temporary=False):
+        # 同一数据集内的分片按创建顺序排列；temporary 的条目需经 subsample 写入最终分片
+        prefix = os.path.join(self.tmp_path if temporary else os.path.join(self.out_path, dataset_of(key)), key)
+        stream = EntryStream(prefix, self.repeat_mode, self.shard_size)
+        if not temporary:
+            self.streams[key] = stream
+        return stream
+
+    def subsample(self, tmp_stream, key, num_entries):
+        # 从展开后的条目中均匀抽取 num_entries 条，按原顺序写入 key 的分片
+        tmp_stream.writer.close()
+        selected = sorted(random.sample(range(len(tmp_stream)), num_entries))
+        stream = self.stream(key)
+        start = 0
+        i = 0
+        for entry_dict, num_repeat in tmp_stream:
+            end = start + num_repeat
+            num_selected = 0
+            while i < len(selected) and selected[i] < end:
+                num_selected += 1
+                i += 1
+            if num_selected > 0:
+                stream.write(entry_dict, num_selected)
+            start = end
+        for path in tmp_stream.writer.paths:
+            os.remove(path)
+        return stream
+
+    def close(self):
+        datasets = {}
+        for key, stream in self.streams.items():
+            paths = stream.writer.close()
+            datasets.setdefault(dataset_of(key), []).extend(os.path.relpath(path, self.out_path) for path in paths)
+        if os.path.isdir(self.tmp_path) and not os.listdir(self.tmp_path):
+            os.rmdir(self.tmp_path)
+        data = {key: len(stream) for key, stream in self.streams.items()}
+        data.update({
+            "repeat_mode": self.repeat_mode,
+            "lines": {key: stream.num_lines for key, stream in self.streams.items()},
+            "shards": datasets
+        })
+        with open(os.path.join(self.out_path, "metadata.json"), "w", encoding="UTF-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        return data
+
+RESIZE_MANIFEST = "resize_manifest.json"
+
+def resize_image(img_path, out_img_path, factor):
+    pil_img = Image.open(img_path)
+    width, height = pil_img.size
+    new_width = int(width * factor)
+    new_height = int(height * factor)
+    resized_img = pil_img.resize((new_width, new_height), Image.LANCZOS)
+    resized_img.save(out_img_path)
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+def resize_job(img_path, out_img_path, factor, cached):
+    # 在子进程中运行：源图内容哈希和缩放因子都与上次构建的记录一致且输出存在时跳过
+    # 源文件大小和修改时间未变时沿用记录的哈希，不再读取文件
+    stat = os.stat(img_path)
+    if cached is not None and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+        content_hash = cached["hash"]
+    else:
+        content_hash = file_hash(img_path)
+    record = dict(source=os.path.abspath(img_path), hash=content_hash, factor=factor, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    skipped = (cached is not None and cached["hash"] == content_hash and cached["factor"] == factor
+               and os.path.exists(out_img_path))
+    if not skipped:
+        resize_image(img_path, out_img_path, factor)
+    return record, skipped
+
+class ImageResizer:
+    """收集需要缩放的图片，最后用进程池统一处理，并通过 manifest 跳过上次构建中未变化的图片"""
+    def __init__(self, out_path, num_workers=None):
+        self.out_path = out_path
+        self.num_workers = num_workers
+        self.manifest_path = os.path.join(out_path, RESIZE_MANIFEST)
+        self.jobs = {}
+
+    def add(self, img_path, out_img_path, factor):
+        self.jobs[os.path.basename(out_img_path)] = (img_path, out_img_path, factor)
+
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path, "r", encoding="UTF-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"读取 {self.manifest_path} 失败：{e}，重新处理所有图片。")
+            return {}
+
+    def run(self):
+        manifest = self.load_manifest()
+        names = list(self.jobs.keys())
+        img_paths, out_img_paths, factors = zip(*self.jobs.values()) if names else ((), (), ())
+        cached = [manifest.get(name) if manifest.get(name, {}).get("source") == os.path.abspath(img_path) else None
+                  for name, img_path in zip(names, img_paths)]
+        new_manifest = {}
+        num_skipped = 0
+        with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+            results = executor.map(resize_job, img_paths, out_img_paths, factors, cached, chunksize=64)
+            for name, (record, skipped) in tqdm(zip(names, results), total=len(names), desc="resizing images"):
+                new_manifest[name] = record
+                num_skipped += skipped
+        # 只保留本次构建的图片
+        with open(self.manifest_path, "w", encoding="UTF-8") as f:
+            json.dump(new_manifest, f, ensure_ascii=False)
+        print(f"resized {len(names) - num_skipped} images, {num_skipped} unchanged")
+        self.jobs = {}
+
+def resize_and_copy_image(part, img_path, data_path, out_path, factor, do_copy=False, resizer=None):
     relative_path = os.path.relpath(img_path, data_path)
     safe_filename = relative_path.replace(os.sep, "_").replace(":", "_")
     safe_filename = f"{part}_{safe_filename}"
     out_relpath = os.path.join(out_path, safe_filename)
 
     # Resize image并保存在同一目录下
+    # 给定 resizer 时只登记，由 resizer.run() 统一处理
     if do_copy:
-        pil_img = Image.open(img_path)
-        width, height = pil_img.size
-        new_width = int(width * factor)
-        new_height = int(height * factor)
-        resized_img = pil_img.resize((new_width, new_height), Image.LANCZOS)
-        resized_img.save(out_relpath)
+        if resizer is None:
+            resize_image(img_path, out_relpath, factor)
+        else:
+            resizer.add(img_path, out_relpath, factor)
 
     out_abspath = os.path.abspath(out_relpath)
     return out_abspath
 
-def construct_ss_data(single_step_data_path, out_path, factor=0.5, train_ratio=0.9):
+def construct_ss_data(single_step_data_path, out_path, factor=0.5, train_ratio=0.9, resizer=None):
     if not os.path.exists(single_step_data_path):
         return [], [], [], []
 
@@ -140,7 +363,7 @@ def construct_ss_data(single_step_data_path, out_path, factor=0.5, train_ratio=0
                 augment_rule = augment_data(react, rules)
 
                 img_path = os.path.join(root, f"{i}.jpg")
-                out_abspath = resize_and_copy_image("ss", img_path, single_step_data_path, out_path, factor, do_copy=True)
+                out_abspath = resize_and_copy_image("ss", img_path, single_step_data_path, out_path, factor, do_copy=True, resizer=resizer)
 
                 reasoning = react["reasoning"]
                 action = react["function"]["name"]
@@ -181,7 +404,7 @@ def construct_ss_data(single_step_data_path, out_path, factor=0.5, train_ratio=0
                 augment_rule = augment_data(react, rules)
 
                 img_path = os.path.join(root, f"{i}.jpg")
-                out_abspath = resize_and_copy_image("ss", img_path, single_step_data_path, out_path, factor, do_copy=True)
+                out_abspath = resize_and_copy_image("ss", img_path, single_step_data_path, out_path, factor, do_copy=True, resizer=resizer)
 
                 reasoning = react["reasoning"]
                 action = react["function"]["name"]
@@ -205,7 +428,7 @@ def construct_ss_data(single_step_data_path, out_path, factor=0.5, train_ratio=0
 
     return decider_ss_entry_train, decider_ss_entry_val, grounder_ss_entry_train, grounder_ss_entry_val
 
-def create_grounder_entries_for_one_trace(react_data, actions, root, data_path, out_path, factor, rules, is_train, do_copy=False):
+def create_grounder_entries_for_one_trace(react_data, actions, root, data_path, out_path, factor, rules, is_train, do_copy=False, resizer=None):
     grounder_entries = []
 
     for i, react in enumerate(react_data, 1):
@@ -213,7 +436,7 @@ def create_grounder_entries_for_one_trace(react_data, actions, root, data_path,
         grounder_aug_num_repeat = augment_num_repeat("grounder", augment_rule, is_train)
 
         img_path = os.path.join(root, f"{i}.jpg")
-        out_abspath = resize_and_copy_image("main", img_path, data_path, out_path, factor, do_copy)
+        out_abspath = resize_and_copy_image("main", img_path, data_path, out_path, factor, do_copy, resizer)
 
         reasoning = react["reasoning"]
         action_type = react["function"]["name"]
@@ -241,7 +464,7 @@ def create_grounder_entries_for_one_trace(react_data, actions, root, data_path,
                 ))
     return grounder_entries
 
-def create_decider_entries_for_one_task(task, react_data, actions, root, data_path, out_path, factor, rules, unexpected_img_safe_abspaths, is_train, do_copy=False, e2e=False):
+def create_decider_entries_for_one_task(task, react_data, actions, root, data_path, out_path, factor, rules, unexpected_img_safe_abspaths, is_train, do_copy=False, e2e=False, resizer=None):
     # decider
     normal_entries = []
     no_history_entries = []
@@ -259,7 +482,7 @@ def create_decider_entries_for_one_task(task, react_data, actions, root, data_pa
         reason_no_history_aug_num_repeat = augment_num_repeat("decider_no_history", augment_rule, is_train)
 
         img_path = os.path.join(root, f"{i}.jpg")
-        out_abspath = resize_and_copy_image("main", img_path, data_path, out_path, factor, do_copy)
+        out_abspath = resize_and_copy_image("main", img_path, data_path, out_path, factor, do_copy, resizer)
 
         # 获取相关参数
         reasoning = react["reasoning"]
@@ -342,8 +565,10 @@ def create_decider_entries_for_one_task(task, react_data, actions, root, data_pa
 
     return normal_entries, no_history_entries, terminate_entries
 
-def construct_ds(data_path, single_step_data_path, unexpected_img_path, out_path, factor=0.5, train_ratio=0.9, e2e=False):
+def construct_ds(data_path, single_step_data_path, unexpected_img_path, out_path, factor=0.5, train_ratio=0.9, e2e=False, num_workers=None,
+                 output_format="json", repeat_mode="weight", shard_size=SHARD_SIZE):
     os.makedirs(out_path, exist_ok=True)
+    resizer = ImageResizer(out_path, num_workers)
     
     e2e_entries_train = []
     e2e_terminate_entries_train = []
@@ -365,6 +590,26 @@ def construct_ds(data_path, single_step_data_path, unexpected_img_path, out_path
     decider_no_history_entries_val = []
     grounder_entries_val = []
 
+    # jsonl 格式：条目直接写入分片，不在内存中累积
+    writer = None
+    if output_format == "jsonl":
+        writer = StreamingSftWriter(out_path, repeat_mode, shard_size)
+        decider_entries_train = writer.stream("decider_entries_train")
+        decider_no_history_entries_train = writer.stream("decider_no_history_entries_train")
+        terminate_entries_train = writer.stream("terminate_entries_train", temporary=True)
+        grounder_entries_train = writer.stream("grounder_entries_train")
+        decider_entries_val = writer.stream("decider_entries_val")
+        decider_no_history_entries_val = writer.stream("decider_no_history_entries_val")
+        terminate_entries_val = writer.stream("terminate_entries_val", temporary=True)
+        grounder_entries_val = writer.stream("grounder_entries_val")
+        if e2e:
+            e2e_entries_train = writer.stream("e2e_entries_train")
+            e2e_no_history_entries_train = writer.stream("e2e_no_history_entries_train")
+            e2e_terminate_entries_train = writer.stream("e2e_terminate_entries_train")
+            e2e_entries_val = writer.stream("e2e_entries_val")
+            e2e_no_history_entries_val = writer.stream("e2e_no_history_entries_val")
+            e2e_terminate_entries_val = writer.stream("e2e_terminate_entries_val")
+
     augment_config_path = os.path.join(os.path.dirname(__file__), 'augment_config.json')
     rules = load_augmentation_rules(augment_config_path)
 
@@ -376,7 +621,7 @@ def construct_ds(data_path, single_step_data_path, unexpected_img_path, out_path
 
         unexpected_img_safe_abspaths = []
         for unexpected_img_path in unexpected_img_paths:
-            out_abspath = resize_and_copy_image("unexpected", unexpected_img_path, unexpected_img_dir, out_path, factor, do_copy=True)
+            out_abspath = resize_and_copy_image("unexpected", unexpected_img_path, unexpected_img_dir, out_path, factor, do_copy=True, resizer=resizer)
             unexpected_img_safe_abspaths.append(out_abspath)
     else:
         unexpected_img_safe_abspaths = []
@@ -431,7 +676,7 @@ def construct_ds(data_path, single_step_data_path, unexpected_img_path, out_path
         is_train = random.random() < train_ratio
         for i, task in enumerate(tasks):
             normal_entries, no_history_entries, terminate_entries = create_decider_entries_for_one_task(
-                task, react_data, actions, root, data_path, out_path, factor, rules, unexpected_img_safe_abspaths, is_train, do_copy=(i == 0), e2e=False
+                task, react_data, actions, root, data_path, out_path, factor, rules, unexpected_img_safe_abspaths, is_train, do_copy=(i == 0), e2e=False, resizer=resizer
             )
             if i != 0:
                 normal_entries = random.sample(normal_entries, len(normal_entries) * 2 // 3 )
@@ -458,13 +703,27 @@ def construct_ds(data_path, single_step_data_path, unexpected_img_path, out_path
                     e2e_no_history_entries_val.extend(e2e_history_entries)
                     e2e_terminate_entries_val.extend(e2e_terminate_entries)
 
-        grounder_entries = create_grounder_entries_for_one_trace(react_data, actions, root, data_path, out_path, factor, rules, is_train, do_copy=False)
+        grounder_entries = create_grounder_entries_for_one_trace(react_data, actions, root, data_path, out_path, factor, rules, is_train, do_copy=False, resizer=resizer)
         if is_train:
             grounder_entries_train.extend(grounder_entries)
         else:
             grounder_entries_val.extend(grounder_entries)
 
-    decider_ss_entry_train, decider_ss_entry_val, grounder_ss_entry_train, grounder_ss_entry_val = construct_ss_data(single_step_data_path, out_path, factor, train_ratio)
+    decider_ss_entry_train, decider_ss_entry_val, grounder_ss_entry_train, grounder_ss_entry_val = construct_ss_data(single_step_data_path, out_path, factor, train_ratio, resizer)
+    resizer.run()
+
+    if writer is not None:
+        # 终止样本按决策条目数降采样，单步数据排在最后，顺序与 json 格式一致
+        writer.subsample(terminate_entries_train, "terminate_entries_train", min(len(decider_entries_train) // 75, len(terminate_entries_train)))
+        writer.subsample(terminate_entries_val, "terminate_entries_val", min(len(decider_entries_val) // 75, len(terminate_entries_val)))
+        writer.stream("decider_ss_entry_train").extend(decider_ss_entry_train)
+        writer.stream("grounder_ss_entry_train").extend(grounder_ss_entry_train)
+        writer.stream("decider_ss_entry_val").extend(decider_ss_entry_val)
+        writer.stream("grounder_ss_entry_val").extend(grounder_ss_entry_val)
+        writer.close()
+        for key, stream in writer.streams.items():
+            print(f"{key}: {len(stream)}")
+        return
 
     # 合并训练集数据
     terminate_entries_train = random.sample(terminate_entries_train, min(len(decider_entries_train) // 75, len(terminate_entries_train)))
@@ -571,6 +830,10 @@ if __name__ == "__main__":
     parser.add_argument("--factor", type=float, default=0.5, help="resize factor for images (default: 0.5)")
     parser.add_argument("--train_ratio", type=float, default=0.9, help="ratio of training data (default: 0.9)")
     parser.add_argument('--e2e',action='store_true',help='construct e2e dataset')
+    parser.add_argument("--num_workers", type=int, default=None, help="number of image resizing processes (default: cpu count)")
+    parser.add_argument("--output_format", choices=["json", "jsonl"], default="json", help="json: one file per dataset; jsonl: streamed shards (default: json)")
+    parser.add_argument("--repeat_mode", choices=["weight", "expand"], default="weight", help="jsonl only: store repeats as a weight field or as repeated lines (default: weight)")
+    parser.add_argument("--shard_size", type=int, default=SHARD_SIZE, help=f"jsonl only: lines per shard (default: {SHARD_SIZE})")
     args = parser.parse_args()
     construct_ds(
         data_path=args.data_path,
@@ -579,5 +842,9 @@ if __name__ == "__main__":
         out_path=args.out_path,
         factor=args.factor,
         train_ratio=args.train_ratio,
-        e2e=args.e2e
+        e2e=args.e2e,
+        num_workers=args.num_workers,
+        output_format=args.output_format,
+        repeat_mode=args.repeat_mode,
+        shard_size=args.shard_size
     )